@@ -0,0 +1,305 @@
+"""
+Local Tushare stand-in for the benchmarks
+Author: Yanzhong(Eric) Huang
+
+A small HTTP server speaking the Tushare protocol (POST `/{api_name}` with
+`{api_name, token, params, fields}`, answering `{code, msg, data: {fields,
+items, has_more}}`), so `tushare_download` and the update functions run
+unchanged against it (`BAGELTUSHARE_HTTP_URL`, see `tushare_api.py`).
+
+The rows are generated from the ORM models of `database.py`, so every table
+has its real columns:
+
+- `stock_basic` `n_codes` listed codes
+- `trade_cal` every calendar day, open on weekdays
+- tables with a `trade_date` (`daily`, `adj_factor`, ...) one row per code and
+  trade date, by `trade_date`, or by `ts_code` + `start_date` / `end_date`
+- financial statements (`income`, `balancesheet`, ...) one report per code
+  and quarter, by `ts_code` + `start_date` / `end_date` (on `ann_date`), or
+  by `period` on the VIP endpoint (`income_vip`, ...)
+
+`FakeConfig` sets the latency of a call, the calls per minute allowed per
+token and API, the share of calls failing with a transient error, and the
+row limit of the APIs (responses are capped and paged with `offset` /
+`limit` like Tushare). `GET /stats` returns the calls served.
+
+    with FakeTushare(FakeConfig(n_codes=500, latency=0.05)) as server:
+        os.environ['BAGELTUSHARE_HTTP_URL'] = server.url
+"""
+
+import json
+import multiprocessing as mp
+import random
+import threading
+import zlib
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.request import urlopen
+
+import pandas as pd
+from sqlalchemy import Date, Float, Integer
+
+from src.bageltushare.database import Base
+from src.bageltushare.planner import VIP_APIS
+from src.bageltushare.tushare_api import ROW_LIMITS, DEFAULT_ROW_LIMIT
+
+
+@dataclass
+class FakeConfig:
+    """
+    The data and behaviour of the fake server.
+
+    :param n_codes: Number of listed codes.
+    :param start_date: First date of the calendar and the data (YYYYMMDD).
+    :param end_date: Last date of the calendar and the data (YYYYMMDD).
+    :param latency: Seconds per call.
+    :param jitter: The latency varies by +- this fraction.
+    :param calls_per_minute: Calls allowed per token and API in a minute, 0 for no limit.
+    :param error_rate: Share of the calls failing with a transient error.
+    :param row_limits: Max rows of one response, per API.
+    :param seed: Seed of the generated values and errors.
+    """
+    n_codes: int = 300
+    start_date: str = '20230101'
+    end_date: str = '20241231'
+    latency: float = 0.05
+    jitter: float = 0.5
+    calls_per_minute: float = 0
+    error_rate: float = 0.0
+    row_limits: dict[str, int] = field(default_factory=lambda: dict(ROW_LIMITS))
+    seed: int = 0
+
+
+def _ymd(d: date) -> str:
+    return d.strftime('%Y%m%d')
+
+
+class FakeData:
+    """
+    Generates the rows of the fake APIs, deterministic for a config.
+    """
+
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.codes = [f'{600000 + i:06d}.SH' if i % 2 == 0 else f'{i:06d}.SZ' for i in range(config.n_codes)]
+        self.days = [d.date() for d in pd.date_range(config.start_date, config.end_date, freq='D')]
+        self.trade_dates = [_ymd(d) for d in self.days if d.weekday() < 5]
+        self.periods = [_ymd(q.end_time.date()) for q in
+                        pd.period_range(config.start_date, config.end_date, freq='Q')
+                        if _ymd(q.end_time.date()) <= config.end_date]
+
+    @staticmethod
+    def columns(api_name: str) -> list[tuple[str, object]]:
+        table = Base.metadata.tables.get(api_name)
+        if table is None:
+            return []
+        return [(column.name, column.type) for column in table.columns if column.name != 'id']
+
+    def _value(self, name: str, kind: object, key: str):
+        # cheap deterministic values from a hash of (row key, column)
+        h = zlib.crc32(f'{key}.{name}.{self.config.seed}'.encode())
+        if isinstance(kind, Float):
+            return round(1 + h % 1_000_000 / 100, 2)
+        if isinstance(kind, Integer):
+            return h % 2
+        if isinstance(kind, Date):
+            return self.config.start_date
+        return name[:4] + str(h % 100)
+
+    def _rows(self, api_name: str, keys: list[dict], fields: list[str]) -> list[list]:
+        kinds = dict(self.columns(api_name))
+        rows = []
+        for fixed in keys:
+            row_key = '.'.join(str(v) for v in fixed.values())
+            rows.append([fixed[name] if name in fixed else self._value(name, kinds[name], row_key)
+                         for name in fields])
+        return rows
+
+    def query(self, api_name: str, params: dict, fields: list[str]) -> tuple[list[str], list[list]]:
+        """
+        Returns the (fields, rows) of a call, raises KeyError for an unknown API.
+        """
+        api_name = {vip: api for api, vip in VIP_APIS.items()}.get(api_name, api_name)
+        columns = [name for name, _ in self.columns(api_name)]
+        if not columns:
+            raise KeyError(api_name)
+        fields = [f for f in fields if f in columns] or columns
+        start = params.get('start_date') or '00000000'
+        end = params.get('end_date') or '99999999'
+
+        if api_name == 'stock_basic':
+            keys = [{'ts_code': code, 'symbol': code[:6], 'exchange': 'SSE' if code.endswith('SH') else 'SZSE',
+                     'list_status': 'L', 'list_date': self.config.start_date, 'delist_date': None}
+                    for code in self.codes]
+            return fields, self._rows(api_name, keys, fields)
+        if api_name == 'trade_cal':
+            rows = []
+            for d in self.days:
+                if start <= _ymd(d) <= end:
+                    row = {'exchange': params.get('exchange') or 'SSE', 'cal_date': _ymd(d),
+                           'is_open': int(d.weekday() < 5), 'pretrade_date': _ymd(d - timedelta(days=1))}
+                    rows.append([row.get(f) for f in fields])
+            return fields, rows
+
+        codes = [params['ts_code']] if params.get('ts_code') else self.codes
+        if 'trade_date' in columns:
+            dates = [params['trade_date']] if params.get('trade_date') else \
+                [d for d in self.trade_dates if start <= d <= end]
+            keys = [{'ts_code': code, 'trade_date': d} for d in dates for code in codes]
+        elif 'end_date' in columns:
+            periods = [params['period']] if params.get('period') else self.periods
+            keys = []
+            for period in periods:
+                ann_date = _ymd(pd.Timestamp(period).date() + timedelta(days=30))
+                if params.get('period') or start <= ann_date <= end:
+                    keys += [{'ts_code': code, 'ann_date': ann_date, 'f_ann_date': ann_date,
+                              'end_date': period, 'report_type': '1'} for code in codes]
+        else:
+            keys = [{'ts_code': code} for code in codes]
+        return fields, self._rows(api_name, keys, fields)
+
+
+class _State:
+    """
+    Counters and rate limit windows of the server, shared by its threads.
+    """
+
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.rows = 0
+        self.throttled = 0
+        self.errors = 0
+        self.windows: dict[tuple[str, str], deque] = defaultdict(deque)
+        self.random = random.Random(config.seed)
+
+    def admit(self, token: str, api_name: str) -> str | None:
+        """
+        Counts a call, returns the error message of a throttled or failed call.
+        """
+        with self.lock:
+            self.calls += 1
+            if self.config.calls_per_minute > 0:
+                now = time()
+                window = self.windows[(token, api_name)]
+                while window and window[0] <= now - 60:
+                    window.popleft()
+                if len(window) >= self.config.calls_per_minute:
+                    self.throttled += 1
+                    return f'抱歉，您每分钟最多访问该接口{self.config.calls_per_minute:g}次'
+                window.append(now)
+            if self.random.random() < self.config.error_rate:
+                self.errors += 1
+                return '服务器繁忙，请稍后重试'
+        return None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': self.calls, 'rows': self.rows, 'throttled': self.throttled, 'errors': self.errors}
+
+
+def _handler(data: FakeData, state: _State) -> type:
+    config = data.config
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like api.waditu.com
+        disable_nagle_algorithm = True  # headers and body are separate writes
+
+        def _send(self, body: dict) -> None:
+            raw = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self) -> None:
+            self._send(state.stats())
+
+        def do_POST(self) -> None:
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            api_name, params = payload['api_name'], dict(payload.get('params') or {})
+            if config.latency:
+                sleep(config.latency * (1 + config.jitter * (2 * random.random() - 1)))
+
+            error = state.admit(payload.get('token', ''), api_name)
+            if error is not None:
+                code = 40203 if '每分钟' in error else -1
+                return self._send({'code': code, 'msg': error, 'data': None})
+            fields = [f for f in (payload.get('fields') or '').split(',') if f]
+            try:
+                fields, rows = data.query(api_name, params, fields)
+            except KeyError:
+                return self._send({'code': 40101, 'msg': '请指定正确的接口名', 'data': None})
+
+            row_limit = config.row_limits.get(api_name, DEFAULT_ROW_LIMIT)
+            offset = int(params.get('offset') or 0)
+            limit = min(int(params.get('limit') or row_limit), row_limit)
+            page = rows[offset:offset + limit]
+            with state.lock:
+                state.rows += len(page)
+            self._send({'code': 0, 'msg': '', 'data': {'fields': fields, 'items': page,
+                                                       'has_more': offset + limit < len(rows)}})
+
+        def log_message(self, *args) -> None:
+            pass
+
+    return Handler
+
+
+def serve(config: FakeConfig, port: int = 0, ready=None) -> None:
+    """
+    Serves the fake API until the process is stopped.
+
+    :param config: The fake data and behaviour.
+    :param port: The port to listen on, 0 picks a free port.
+    :param ready: A queue receiving the port once listening, optional.
+    """
+    data = FakeData(config)
+    server = ThreadingHTTPServer(('127.0.0.1', port), _handler(data, _State(config)))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+class FakeTushare:
+    """
+    Runs `serve` in its own process, so the server does not compete with the
+    benchmarked code for the GIL.
+    """
+
+    def __init__(self, config: FakeConfig | None = None) -> None:
+        self.config = config or FakeConfig()
+        self.url = ''
+        self._process: mp.Process | None = None
+
+    def __enter__(self) -> 'FakeTushare':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        ready = mp.Queue()
+        self._process = mp.Process(target=serve, args=(self.config, 0, ready), daemon=True)
+        self._process.start()
+        self.url = f'http://127.0.0.1:{ready.get(timeout=60)}'
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def stats(self) -> dict:
+        """
+        Returns the calls, rows, throttled calls and injected errors served so far.
+        """
+        with urlopen(f'{self.url}/stats') as res:
+            return json.loads(res.read())
@@ -0,0 +1,189 @@
+"""
+Offline benchmarks of the download and update functions
+Author: Yanzhong(Eric) Huang
+
+Runs `download`, `update_by_date` and `update_by_code` against the local
+Tushare stand-in (`fake_tushare.py`) and a SQLite database in a temporary
+directory, no token, network or MySQL needed. From the repository root:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --codes 1000 --latency 0.1 --error-rate 0.02 --json base.json
+    python -m benchmarks.run --baseline base.json  # compare with a previous run
+
+Every benchmark runs in a fresh process and reports:
+
+- `seconds`, `rows/s` (rows written to the table), `calls/s` (calls served)
+- `peak MB` of the benchmark process and of its largest worker process (Unix)
+- the throttled calls and injected errors of the server
+
+The same config gives the same data, so the numbers of two commits compare.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from src.bageltushare import create_all_tables, download, update_by_date, update_by_code
+from src.bageltushare import rate_limit, tushare_api
+from src.bageltushare.rate_limit import set_rate_limit
+from .fake_tushare import FakeConfig, FakeTushare
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# (name, function, api_name), in order: the updates need trade_cal and stock_basic
+BENCHMARKS = [
+    ('download', 'download', 'trade_cal'),
+    ('download', 'download', 'stock_basic'),
+    ('update_by_date', 'update_by_date', 'daily'),
+    ('update_by_code', 'update_by_code', 'income'),
+]
+
+
+def _peak_mb() -> tuple[float | None, float | None]:
+    """
+    Peak RSS of this process and of its largest (finished) child process.
+    """
+    if resource is None:
+        return None, None
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return own, children or None
+
+
+def _count(engine, table_name: str) -> int:
+    with engine.connect() as conn:
+        return conn.execute(text(f'SELECT COUNT(*) FROM {table_name}')).scalar()
+
+
+def _bench(function: str, api_name: str, db_url: str, end_date: str, args: dict, results) -> None:
+    """
+    Runs one benchmark, in its own process.
+    """
+    if args['quiet']:
+        # the output of this process and of its workers
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    engine = create_engine(db_url)
+    set_rate_limit(api_name, args['client_calls_per_minute'])
+    before = _count(engine, api_name)
+    start = perf_counter()
+    if function == 'download':
+        download(engine, 'bench', api_name)
+    else:
+        update = update_by_date if function == 'update_by_date' else update_by_code
+        update(engine, 'bench', api_name, end_date=pd.Timestamp(end_date),
+               max_workers=args['workers'], mode=args['mode'])
+    seconds = perf_counter() - start
+    rows = _count(engine, api_name) - before
+    peak, worker_peak = _peak_mb()
+    engine.dispose()
+    results.put({'seconds': seconds, 'rows': rows, 'peak_mb': peak, 'worker_peak_mb': worker_peak})
+
+
+def run(config: FakeConfig,
+        workers: int = 10,
+        mode: str = 'fixed',
+        client_calls_per_minute: float = 0,
+        quiet: bool = True) -> list[dict]:
+    """
+    Runs the benchmarks against a fresh fake server and database.
+
+    :param config: The data and behaviour of the fake server.
+    :param workers: `max_workers` of the updates.
+    :param mode: `mode` of the updates ('fixed' or 'auto').
+    :param client_calls_per_minute: The rate limit of the client, 0 for none.
+    :param quiet: Silence the progress output of the benchmarked functions.
+    :return: One result per benchmark.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp, FakeTushare(config) as server:
+        # the environment for spawned processes, the module attributes for forked ones
+        os.environ['BAGELTUSHARE_HTTP_URL'] = tushare_api.HTTP_URL = server.url
+        os.environ['BAGELTUSHARE_RATE_LIMIT_DIR'] = rate_limit.RATE_LIMIT_DIR = os.path.join(tmp, 'rate_limit')
+        db_url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+
+        engine = create_engine(db_url)
+        create_all_tables(engine)
+        engine.dispose()
+
+        args = {'workers': workers, 'mode': mode, 'client_calls_per_minute': client_calls_per_minute,
+                'quiet': quiet}
+        for name, function, api_name in BENCHMARKS:
+            served = server.stats()
+            queue = mp.Queue()
+            # a new process per benchmark, for its peak memory, started like the workers
+            process = mp.Process(target=_bench, args=(function, api_name, db_url, config.end_date, args, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            after = server.stats()
+            calls = after['calls'] - served['calls']
+            result.update(name=name, api_name=api_name, calls=calls,
+                          rows_per_s=result['rows'] / result['seconds'],
+                          calls_per_s=calls / result['seconds'],
+                          throttled=after['throttled'] - served['throttled'],
+                          errors=after['errors'] - served['errors'])
+            results.append(result)
+            _print_result(result)
+    return results
+
+
+def _mb(value: float | None) -> str:
+    return '-' if value is None else f'{value:.0f}'
+
+
+def _print_result(result: dict, baseline: dict | None = None) -> None:
+    line = (f"{result['name']:<15} {result['api_name']:<12} {result['seconds']:>8.2f}s "
+            f"{result['rows']:>9} rows {result['rows_per_s']:>10.0f} rows/s "
+            f"{result['calls']:>6} calls {result['calls_per_s']:>7.1f} calls/s "
+            f"peak {_mb(result['peak_mb'])} MB / worker {_mb(result['worker_peak_mb'])} MB "
+            f"throttled {result['throttled']} errors {result['errors']}")
+    if baseline is not None and baseline['rows_per_s']:
+        line += f" ({result['rows_per_s'] / baseline['rows_per_s']:.2f}x baseline rows/s)"
+    print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmarks against a local Tushare stand-in')
+    parser.add_argument('--codes', type=int, default=300, help='listed codes')
+    parser.add_argument('--start', default='20230101', help='first date of the data (YYYYMMDD)')
+    parser.add_argument('--end', default='20241231', help='last date of the data (YYYYMMDD)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per call of the server')
+    parser.add_argument('--server-cpm', type=float, default=0, help='calls per minute allowed by the server')
+    parser.add_argument('--client-cpm', type=float, default=0, help='rate limit of the client')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls failing')
+    parser.add_argument('--workers', type=int, default=10, help='max_workers of the updates')
+    parser.add_argument('--mode', default='fixed', help="'fixed' or 'auto'")
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results of a previous --json')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the updates')
+    args = parser.parse_args()
+
+    config = FakeConfig(n_codes=args.codes, start_date=args.start, end_date=args.end, latency=args.latency,
+                        calls_per_minute=args.server_cpm, error_rate=args.error_rate)
+    results = run(config, args.workers, args.mode, args.client_cpm, quiet=not args.verbose)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r['name'], r['api_name']): r for r in json.load(f)['results']}
+        print('\nCompared with', args.baseline)
+        for result in results:
+            _print_result(result, baseline.get((result['name'], result['api_name'])))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
-from .database import get_engine, create_all_tables, create_index
-from .download import download, update_by_code, update_by_date
-from .tushare_api import tushare_download
\ No newline at end of file
+from .database import get_engine, create_all_tables, create_index, create_unique_key, check_unique_key
+from .download import download, update_by_code, update_by_date, repair_by_date
+from .async_download import update_by_code_async, update_by_date_async
+from .tushare_api import tushare_download
+from .concurrency import AIMDController
+from .token_pool import TokenPool
+from .metrics import get_metrics, serve_metrics, write_prometheus
+from .cache import enable_cache, disable_cache
+from .transport import record_to, replay_from, reset_transport
@@ -0,0 +1,246 @@
+"""
+Asyncio download engine
+Author: Yanzhong(Eric) Huang
+
+Async variants of the update functions in `download.py`, for a workload that
+is almost entirely network-bound:
+
+- `update_by_date_async` same outcome as `update_by_date`
+- `update_by_code_async` same outcome as `update_by_code`
+
+A single process drives up to `max_concurrency` in-flight Tushare requests
+(a semaphore bounds them), and one `BatchWriter` appends the downloaded
+frames to the database in large batches, so no worker process, pandas import
+or engine is created per worker. The log entries are written in batches by
+one `LogSink` (see `log_sink.py`). A request keeps its slot of the semaphore
+until its frame is queued for the writer, and the writer has a `MemoryBudget`
+of `memory_mb` (see `writer.py`): when the database lags, `put` blocks, the
+slots stay taken and no new request starts. Both are coroutines:
+
+    asyncio.run(update_by_code_async(engine, token, 'income', max_concurrency=200))
+"""
+
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic
+
+import pandas as pd
+from sqlalchemy.engine import Engine
+
+from .database import SyncState
+from .log_sink import LogSink, INFO, ERROR
+from .convert import convert_frame
+from .download import MEMORY_MB, _apply_rate_limit, _check_rate_limit, _plan_update, _prepare_run
+from .metrics import get_metrics, export
+from .planner import Plan
+from .token_pool import TokenPool, tokens_of
+from .retry import RetryPolicy, classify_error
+from .tushare_api import get_client, tushare_download
+from .writer import BatchWriter, MemoryBudget
+
+
+async def _fetch(executor: ThreadPoolExecutor,
+                 semaphore: asyncio.Semaphore,
+                 sink: LogSink,
+                 token: str | TokenPool,
+                 api_name: str,
+                 label: str,
+                 sync_key: str,
+                 params: dict,
+                 fields: list[str] | None,
+                 retry: int) -> pd.DataFrame | None:
+    """
+    Downloads one request, retrying in case of failure with the `RetryPolicy`
+    of `retry.py`.
+
+    A task waiting to retry does not take a slot of the semaphore. A task that
+    returns a DataFrame still holds its slot, the caller releases it once the
+    frame is queued for the writer.
+
+    :return: The converted DataFrame, or None (slot released) if all retries
+        failed. The result is logged to `sink`.
+    """
+    loop = asyncio.get_running_loop()
+    metrics = get_metrics()
+    policy = RetryPolicy(max_attempts=retry)
+    start = monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        await semaphore.acquire()
+        try:
+            df = await loop.run_in_executor(executor, tushare_download, token, api_name, params, fields)
+            with metrics.timer(api_name, 'convert_seconds'):
+                df = convert_frame(df, api_name)  # type: ignore
+            sink.log(api_name, f'Downloaded {api_name} for {label}', event='fetch', sync_key=sync_key,
+                     row_count=len(df), duration=monotonic() - start)
+            return df
+        except Exception as e:
+            semaphore.release()
+            metrics.inc(api_name, 'errors', kind=classify_error(e))
+            delay = policy.delay(attempt, e, monotonic() - start)
+            if delay is None:
+                error_msg = f'Error downloading {api_name} for {label} ({classify_error(e)}): {e}'
+                sink.log(api_name, f'{error_msg}\n{traceback.format_exc()}', level=ERROR, event='fetch',
+                         sync_key=sync_key, duration=monotonic() - start, error_class=classify_error(e))
+                print(f'Error downloading {api_name} for {label}, giving up.')
+                return None
+            metrics.inc(api_name, 'retries')
+            metrics.observe(api_name, 'retry_sleep_seconds', delay)
+            print(f'Error downloading {api_name} for {label} ({classify_error(e)}): {e}, '
+                  f'retrying in {delay:.0f}s...')
+            await asyncio.sleep(delay)
+
+
+async def _run(engine: Engine,
+               token: str | TokenPool,
+               plan: Plan,
+               params: dict | None,
+               fields: list[str] | None,
+               retry: int,
+               max_concurrency: int,
+               write_mode: str = 'append',
+               memory_mb: float | None = MEMORY_MB) -> None:
+    """
+    Runs the tasks of the plan, each a (label, params, sync record), and hands
+    the results to a single `BatchWriter` with a `MemoryBudget` of `memory_mb`.
+    """
+    api_name = plan.api_name
+    write_mode = _prepare_run(engine, plan, write_mode)
+
+    loop = asyncio.get_running_loop()
+    start = monotonic()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    for pool_token in tokens_of(token):
+        get_client(pool_token, pool_maxsize=max_concurrency)
+
+    failed = 0
+    budget = MemoryBudget(memory_mb) if memory_mb else None
+    with LogSink(engine) as sink:
+        with (ThreadPoolExecutor(max_workers=max_concurrency) as executor,
+              BatchWriter(engine, api_name, write_mode=write_mode, log_sink=sink, budget=budget) as writer):
+
+            async def run_job(label: str, task_params: dict, record: tuple[str, str, str]) -> None:
+                nonlocal failed
+                print(f'Updating {api_name} for {label}')
+                df = await _fetch(executor, semaphore, sink, token, plan.endpoint or api_name, label, record[0],
+                                  {**(params or {}), **task_params}, fields, retry)
+                if df is None:
+                    failed += 1
+                    await loop.run_in_executor(None, writer.fail, record)
+                    return
+                try:
+                    # blocks while the writer queue is full or the frame does not fit in the budget,
+                    # the slot stays taken meanwhile so no new request starts
+                    await loop.run_in_executor(None, writer.put, df, record)
+                finally:
+                    semaphore.release()
+
+            await asyncio.gather(*(run_job(*task) for task in plan.tasks))
+        sink.log(api_name, f'{len(plan.tasks)} {plan.strategy} requests, {failed} failed',
+                 level=ERROR if failed else INFO, event='update', row_count=writer.rows_written,
+                 duration=monotonic() - start)
+    export()
+
+
+async def update_by_date_async(engine: Engine,
+                               token: str | TokenPool,
+                               api_name: str,
+                               params: dict | None = None,
+                               fields: list[str] | None = None,
+                               end_date: datetime = datetime.now(),
+                               max_concurrency: int = 100,
+                               retry: int = 3,
+                               calls_per_minute: int | None = None,
+                               write_mode: str = 'append',
+                               resume: bool = True,
+                               mode: str = 'fixed',
+                               memory_mb: float | None = MEMORY_MB) -> dict:
+    """
+    Async variant of `update_by_date`, one request per trade date.
+
+    :param engine: The database engine used to execute queries and perform updates.
+    :param token: The authentication token required to access the API, or a `TokenPool`.
+    :param api_name: The name of the API from which the data is being fetched.
+    :param params: Optional dictionary of additional parameters to be sent in the query.
+    :param fields: Optional list of specific fields to retrieve from the API.
+    :param end_date: The ending date for the data update. Defaults to the current datetime.
+    :param max_concurrency: The maximum number of in-flight requests. Defaults to 100.
+    :param retry: Number of retry attempts for failed API calls. Defaults to 3.
+    :param calls_per_minute: Rate limit of the API (of its VIP endpoint for a
+        by-period plan), None keeps the current setting.
+    :param write_mode: 'append' (default), 'ignore' or 'upsert', see `writer.py`.
+    :param resume: Resume with the dates of `sync_state` left pending or failed by
+        a previous run. Defaults to True.
+    :param mode: 'fixed' (default) or 'auto', see `update_by_date`.
+    :param memory_mb: Memory budget in MB of the downloaded frames not written yet,
+        see `update_by_date`. Defaults to `MEMORY_MB`.
+    :return: The metrics of this update, see `update_by_date`.
+    :raises ValueError: If `calls_per_minute` is given with a `TokenPool`.
+    """
+    _check_rate_limit(token, calls_per_minute)
+    SyncState.__table__.create(engine, checkfirst=True)
+
+    with get_metrics().run() as run:
+        plan = _plan_update(engine, api_name, end_date, 'by_date', mode, resume)
+        _apply_rate_limit(plan, calls_per_minute)
+        if not plan.tasks:
+            print(f'{api_name} already up to date')
+        else:
+            print(f'Start updating {api_name} to {end_date} ({len(plan.tasks)} {plan.strategy} requests)')
+            await _run(engine, token, plan, params, fields, retry, max_concurrency, write_mode, memory_mb)
+            print(f'Finished updating {api_name} to {end_date}')
+    return run.stats()
+
+
+async def update_by_code_async(engine: Engine,
+                               token: str | TokenPool,
+                               api_name: str,
+                               params: dict | None = None,
+                               fields: list[str] | None = None,
+                               end_date: datetime = datetime.now(),
+                               max_concurrency: int = 100,
+                               retry: int = 3,
+                               calls_per_minute: int | None = None,
+                               write_mode: str = 'append',
+                               resume: bool = True,
+                               mode: str = 'fixed',
+                               memory_mb: float | None = MEMORY_MB) -> dict:
+    """
+    Async variant of `update_by_code`, one request per stock code from the
+    latest date of the code to `end_date`.
+
+    :param engine: The database engine used to execute queries and perform updates.
+    :param token: The authentication token required to access the API, or a `TokenPool`.
+    :param api_name: The name of the API from which the data is being fetched.
+    :param params: Optional dictionary of additional parameters to be sent in the query.
+    :param fields: Optional list of specific fields to retrieve from the API.
+    :param end_date: The ending date for the data update. Defaults to the current datetime.
+    :param max_concurrency: The maximum number of in-flight requests. Defaults to 100.
+    :param retry: Number of retry attempts for failed API calls. Defaults to 3.
+    :param calls_per_minute: Rate limit of the API (of its VIP endpoint for a
+        by-period plan), None keeps the current setting.
+    :param write_mode: 'append' (default), 'ignore' or 'upsert', see `writer.py`.
+    :param resume: Skip the codes recorded in `sync_state` as done up to the same
+        end date by a previous (interrupted) run. Defaults to True.
+    :param mode: 'fixed' (default) or 'auto', see `update_by_code`.
+    :param memory_mb: Memory budget in MB of the downloaded frames not written yet,
+        see `update_by_date`. Defaults to `MEMORY_MB`.
+    :return: The metrics of this update, see `update_by_date`.
+    :raises ValueError: If `calls_per_minute` is given with a `TokenPool`.
+    """
+    _check_rate_limit(token, calls_per_minute)
+    SyncState.__table__.create(engine, checkfirst=True)
+
+    with get_metrics().run() as run:
+        plan = _plan_update(engine, api_name, end_date, 'by_code', mode, resume)
+        _apply_rate_limit(plan, calls_per_minute)
+        if not plan.tasks:
+            print(f'{api_name} already up to date')
+        else:
+            print(f'Start updating {api_name} to {end_date} ({len(plan.tasks)} {plan.strategy} requests)')
+            await _run(engine, token, plan, params, fields, retry, max_concurrency, write_mode, memory_mb)
+            print(f'Finished updating {api_name} to {end_date}')
+    return run.stats()
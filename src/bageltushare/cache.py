@@ -0,0 +1,209 @@
+"""
+On-disk cache of the raw Tushare responses
+Author: Yanzhong(Eric) Huang
+
+When an update fails after the download (a schema mismatch, a lock timeout),
+everything fetched so far is lost and downloaded again against the quota.
+With the cache enabled, every successful response is kept on disk, zlib
+compressed, keyed by (api_name, params, fields). A re-run is served from the
+disk without waiting for the rate limiter (see `tushare_api.py`).
+
+- `enable_cache` turns the cache on for this process and the worker processes
+  it starts (through `BAGELTUSHARE_CACHE_DIR` in the environment)
+- a response expires after the TTL of its request, `cache_ttl`:
+    - `CACHE_TTLS` per API, e.g. `trade_cal` and `stock_basic` for a day
+    - a request for dates in the past (`trade_date`, `end_date` before today)
+      never expires, the history does not change
+    - anything else, e.g. today's data or a reporting `period` that may still
+      get late filings, `DEFAULT_TTL`
+- the cache is bounded by `max_mb`, the least recently used responses are
+  evicted first (a hit refreshes the mtime of its file)
+
+Files are written to a temporary name and renamed, so the worker processes
+can share one cache directory.
+
+    enable_cache('~/.cache/bageltushare', max_mb=2048)
+    update_by_code(engine, token, 'income')  # a re-run costs no quota
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zlib
+from datetime import date
+from time import time
+
+
+CACHE_DIR = os.environ.get('BAGELTUSHARE_CACHE_DIR', '')  # empty: no cache
+CACHE_MAX_MB = float(os.environ.get('BAGELTUSHARE_CACHE_MB', 1024))
+DEFAULT_TTL = 3600.0  # seconds
+CACHE_TTLS = {
+    'trade_cal': 86400.0,
+    'stock_basic': 86400.0,
+}
+EVICT_TO = 0.9  # share of max_mb kept after an eviction
+
+# file layout: expiry timestamp (inf: never), then the compressed response
+_HEADER = struct.Struct('d')
+
+
+def cache_ttl(api_name: str, params: dict) -> float | None:
+    """
+    How long the response of a request stays valid.
+
+    :param api_name: The name of the API.
+    :param params: The params of the request.
+    :return: Seconds, None if the response never expires.
+    """
+    if api_name in CACHE_TTLS:
+        return CACHE_TTLS[api_name]
+    today = date.today().strftime('%Y%m%d')
+    dates = [params[k] for k in ('trade_date', 'end_date') if params.get(k)]
+    if dates and not params.get('period') and max(dates) < today:
+        return None
+    return DEFAULT_TTL
+
+
+class ResponseCache:
+    """
+    Compressed responses in `path`, one file per request, at most `max_mb`.
+
+    :param path: The cache directory.
+    :param max_mb: Max size of the cache in MB.
+    """
+
+    def __init__(self, path: str, max_mb: float = CACHE_MAX_MB) -> None:
+        self.path = os.path.expanduser(path)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._size: int | None = None  # estimate, rescanned on eviction
+
+    def _file(self, api_name: str, params: dict, fields: str) -> str:
+        key = json.dumps([api_name, params, fields], sort_keys=True, default=str)
+        return os.path.join(self.path, api_name, hashlib.sha1(key.encode()).hexdigest() + '.z')
+
+    def get(self, api_name: str, params: dict, fields: str) -> bytes | None:
+        """
+        Returns the cached response of a request, None if missing or expired.
+        """
+        path = self._file(api_name, params, fields)
+        try:
+            with open(path, 'rb') as f:
+                (expires,) = _HEADER.unpack(f.read(_HEADER.size))
+                raw = zlib.decompress(f.read()) if expires >= time() else None
+            if raw is None:
+                os.remove(path)
+            else:
+                os.utime(path)  # most recently used
+            return raw
+        except (OSError, struct.error, zlib.error):
+            # missing, evicted meanwhile or truncated
+            return None
+
+    def put(self, api_name: str, params: dict, fields: str, raw: bytes, ttl: float | None = None) -> None:
+        """
+        Stores the response of a request, `ttl` seconds (None: no expiry).
+        """
+        path = self._file(api_name, params, fields)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = _HEADER.pack(float('inf') if ttl is None else time() + ttl) + zlib.compress(raw, 1)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _files(self) -> list[os.DirEntry]:
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for api_dir in os.scandir(self.path):
+            if api_dir.is_dir():
+                entries += [e for e in os.scandir(api_dir.path) if e.name.endswith('.z')]
+        return entries
+
+    def size(self) -> int:
+        """
+        The size of the cache in bytes, all processes included.
+        """
+        return sum(e.stat().st_size for e in self._files())
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used responses until the cache is under
+        `EVICT_TO` of its max size.
+        """
+        files = []
+        for e in self._files():
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, e.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._size = total
+
+    def clear(self) -> None:
+        """
+        Removes every cached response.
+        """
+        for e in self._files():
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+        self._size = 0
+
+
+_cache: ResponseCache | None = ResponseCache(CACHE_DIR) if CACHE_DIR else None
+
+
+def enable_cache(path: str | None = None, max_mb: float = CACHE_MAX_MB) -> ResponseCache:
+    """
+    Caches the Tushare responses of this process (and of the worker processes
+    it starts afterwards) in `path`.
+
+    :param path: The cache directory, `BAGELTUSHARE_CACHE_DIR` or
+        `~/.cache/bageltushare` by default.
+    :param max_mb: Max size of the cache in MB.
+    :return: The cache.
+    """
+    global _cache
+    path = path or CACHE_DIR or os.path.join('~', '.cache', 'bageltushare')
+    _cache = ResponseCache(path, max_mb)
+    # spawned worker processes read the environment
+    os.environ['BAGELTUSHARE_CACHE_DIR'] = _cache.path
+    os.environ['BAGELTUSHARE_CACHE_MB'] = str(max_mb)
+    return _cache
+
+
+def disable_cache() -> None:
+    """
+    Stops caching, the cached files are kept.
+    """
+    global _cache
+    _cache = None
+    os.environ.pop('BAGELTUSHARE_CACHE_DIR', None)
+
+
+def get_cache() -> ResponseCache | None:
+    """
+    The cache of this process, None if disabled.
+    """
+    return _cache
@@ -0,0 +1,134 @@
+"""
+Adaptive concurrency controller
+Author: Yanzhong(Eric) Huang
+
+A fixed `max_workers` is either too low (Tushare answers fast) or too high
+(Tushare throttles and the extra workers only produce errors).
+`AIMDController` sets the number of in-flight requests of `update_by_date` /
+`update_by_code` from what it observes, like TCP congestion control:
+
+- additive increase: +`increase` in-flight requests per round of `concurrency`
+  successful requests, while the latency stays within `latency_tolerance`
+  times the best latency seen
+- multiplicative decrease: `concurrency * decrease` on a quota or transient
+  error (see `retry.py`), at most once per round, so one burst of errors
+  only backs off once
+
+`stats()` returns the current concurrency and the observed rates, to tune the
+limits from data:
+
+    controller = AIMDController(max_concurrency=32)
+    update_by_date(engine, token, 'daily', concurrency=controller)
+    print(controller.stats())
+"""
+
+from time import monotonic
+
+from .retry import QUOTA, TRANSIENT
+
+
+class AIMDController:
+    """
+    Additive increase / multiplicative decrease of the in-flight requests.
+
+    :param initial: The starting concurrency.
+    :param min_concurrency: The lower bound of the concurrency.
+    :param max_concurrency: The upper bound of the concurrency, also the size of
+        the worker pool.
+    :param increase: Requests added per healthy round.
+    :param decrease: Factor applied on throttling or transient errors.
+    :param latency_tolerance: A latency above this multiple of the best latency
+        seen stops the increase.
+    :param smoothing: Weight of the last request in the latency average.
+    """
+
+    def __init__(self,
+                 initial: int = 4,
+                 min_concurrency: int = 1,
+                 max_concurrency: int = 32,
+                 increase: int = 1,
+                 decrease: float = 0.5,
+                 latency_tolerance: float = 2.0,
+                 smoothing: float = 0.2) -> None:
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.concurrency = min(max(initial, min_concurrency), max_concurrency)
+
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.failed = 0
+        self.latency: float | None = None  # moving average, seconds
+        self.best_latency: float | None = None
+        self.peak_concurrency = self.concurrency
+        self._successes = 0  # successful requests in the current round
+        self._cooldown = 0  # completions to ignore errors for after a decrease
+        self._start: float | None = None
+
+    def start(self) -> None:
+        """
+        Marks the start of the update, for the throughput.
+        """
+        if self._start is None:
+            self._start = monotonic()
+
+    def record(self, latency: float, errors: list[str], ok: bool = True) -> None:
+        """
+        Records a completed request and adjusts the concurrency.
+
+        :param latency: Seconds from submit to result.
+        :param errors: The classes of the errors met by the request, retries included.
+        :param ok: Whether the request returned data in the end.
+        """
+        self.start()
+        self.requests += 1
+        self.errors += len(errors)
+        self.throttled += errors.count(QUOTA)
+        if not ok:
+            self.failed += 1
+        if self._cooldown > 0:
+            self._cooldown -= 1
+
+        if QUOTA in errors or TRANSIENT in errors:
+            if self._cooldown == 0:
+                self.concurrency = max(self.min_concurrency, int(self.concurrency * self.decrease))
+                # the requests already in flight were sent at the old concurrency
+                self._cooldown = self.concurrency
+                self._successes = 0
+            return
+        if not ok:
+            return
+
+        self.latency = latency if self.latency is None else \
+            self.smoothing * latency + (1 - self.smoothing) * self.latency
+        self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+        self._successes += 1
+        if self._successes >= self.concurrency:
+            self._successes = 0
+            if self.latency <= self.latency_tolerance * self.best_latency:
+                self.concurrency = min(self.max_concurrency, self.concurrency + self.increase)
+                self.peak_concurrency = max(self.peak_concurrency, self.concurrency)
+
+    def stats(self) -> dict:
+        """
+        Returns the current concurrency and the observed rates.
+
+        :return: A dict with `concurrency`, `peak_concurrency`, `requests`,
+            `errors`, `throttled`, `failed`, `error_rate` (errors per request),
+            `latency` (moving average, seconds) and `throughput` (requests per
+            second).
+        """
+        elapsed = monotonic() - self._start if self._start is not None else 0.0
+        return {'concurrency': self.concurrency,
+                'peak_concurrency': self.peak_concurrency,
+                'requests': self.requests,
+                'errors': self.errors,
+                'throttled': self.throttled,
+                'failed': self.failed,
+                'error_rate': self.errors / self.requests if self.requests else 0.0,
+                'latency': self.latency,
+                'throughput': self.requests / elapsed if elapsed > 0 else 0.0}
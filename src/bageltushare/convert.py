@@ -0,0 +1,135 @@
+"""
+Schema-driven type conversion
+Author: Yanzhong(Eric) Huang
+
+Tushare returns dates as 'YYYYMMDD' strings and numbers as whatever the JSON
+decoder made of them (object columns when a value is missing). Instead of
+guessing formats column by column, `convert_frame` converts a downloaded frame
+to the types of its table in `database.py`, in one pass:
+
+- `Date` columns are parsed with the explicit format `%Y%m%d` (no per-element
+  format inference), values in another format fall back to `pd.to_datetime`
+- `Float` columns become float64, or float32 with `float32=True`: the `Float`
+  columns are single precision in MySQL, so nothing stored is lost and the
+  frames in flight take half the memory
+- `Integer` columns become numbers
+- `String` columns are kept, the ones listed in `categorical` (e.g. `ts_code`)
+  become pandas categoricals, a few bytes per row instead of a Python string
+
+Columns not in the table are left as they are. For a table not in
+`database.py` (e.g. `index_daily`) only the usual date columns (`DATE_COLUMNS`)
+are parsed, so `to_sql` still creates them as dates. The defaults come from the
+environment, so the worker processes share them:
+
+- `BAGELTUSHARE_FLOAT32=1`
+- `BAGELTUSHARE_CATEGORICAL=ts_code`
+"""
+
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Date, Float, Integer, String
+
+from .database import Base
+from .planner import VIP_APIS
+
+
+DATE_FORMAT = '%Y%m%d'
+DATE_COLUMNS = ('trade_date', 'cal_date', 'pretrade_date', 'ann_date', 'f_ann_date', 'end_date')
+FLOAT32 = os.environ.get('BAGELTUSHARE_FLOAT32', '') == '1'
+CATEGORICAL = tuple(c for c in os.environ.get('BAGELTUSHARE_CATEGORICAL', '').split(',') if c)
+
+
+@lru_cache(maxsize=None)
+def table_types(table_name: str) -> dict[str, str]:
+    """
+    The type of every column of a table: 'date', 'float', 'int' or 'str'.
+
+    :param table_name: The name of the table (API), or its VIP endpoint.
+    :return: {column: type}, the `DATE_COLUMNS` as dates for a table not in
+        `database.py`.
+    """
+    table_name = {vip: api for api, vip in VIP_APIS.items()}.get(table_name, table_name)
+    table = Base.metadata.tables.get(table_name)
+    if table is None:
+        return {column: 'date' for column in DATE_COLUMNS}
+    types = {}
+    for column in table.columns:
+        if isinstance(column.type, Date):
+            types[column.name] = 'date'
+        elif isinstance(column.type, Float):
+            types[column.name] = 'float'
+        elif isinstance(column.type, Integer):
+            types[column.name] = 'int'
+        elif isinstance(column.type, String):
+            types[column.name] = 'str'
+    return types
+
+
+def _to_date(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    try:
+        return pd.to_datetime(values, format=DATE_FORMAT)
+    except (ValueError, TypeError):
+        # not all 'YYYYMMDD', e.g. '2024-01-02'
+        return pd.to_datetime(values)
+
+
+def _to_category(values: pd.Series) -> pd.Series:
+    # factorize on the object array, several times faster than astype('category') on a string column
+    codes, categories = pd.factorize(values.to_numpy(dtype=object))
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=values.index, name=values.name)
+
+
+def _float_block(df: pd.DataFrame, floats: list[str], dtype: np.dtype) -> pd.DataFrame:
+    """
+    Casts the `floats` columns with one 2-D NumPy cast and rebuilds the frame
+    once, instead of one cast and one column assignment per column (which
+    dominates on wide tables like `balancesheet`).
+    """
+    block = df[floats]
+    text = {col: pd.to_numeric(block[col], errors='coerce')
+            for col in floats if not pd.api.types.is_numeric_dtype(block[col])}
+    if text:
+        # numbers sent as strings, rare
+        block = block.assign(**text)
+    block = pd.DataFrame(block.to_numpy(dtype=dtype), columns=floats, index=df.index)
+    return pd.concat([df.drop(columns=floats), block], axis=1)[list(df.columns)]
+
+
+def convert_frame(df: pd.DataFrame,
+                  table_name: str,
+                  float32: bool | None = None,
+                  categorical: tuple[str, ...] | None = None) -> pd.DataFrame:
+    """
+    Converts the columns of a downloaded DataFrame to the types of its table.
+
+    :param df: The downloaded DataFrame, its other columns are converted in place.
+    :param table_name: The table of the rows (the API name).
+    :param float32: Downcast the `Float` columns to float32, `FLOAT32` by default.
+    :param categorical: The string columns to store as categoricals,
+        `CATEGORICAL` by default.
+    :return: The converted DataFrame.
+    """
+    float32 = FLOAT32 if float32 is None else float32
+    categorical = CATEGORICAL if categorical is None else categorical
+    float_dtype = np.dtype('float32' if float32 else 'float64')
+    types = table_types(table_name)
+    dtypes = df.dtypes
+
+    floats = [col for col in df.columns if types.get(col) == 'float']
+    if any(dtypes[col] != float_dtype for col in floats):
+        df = _float_block(df, floats, float_dtype)
+
+    for col in df.columns:
+        kind = types.get(col)
+        if kind == 'date':
+            df[col] = _to_date(df[col])
+        elif kind == 'int' and not pd.api.types.is_numeric_dtype(dtypes[col]):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        elif kind == 'str' and col in categorical and not isinstance(dtypes[col], pd.CategoricalDtype):
+            df[col] = _to_category(df[col])
+    return df
@@ -1,11 +1,29 @@
 """
 Database connection and query execution module.
+
+Tables with a surrogate `id` declare a unique key on their natural key
+(ts_code + trade_date, ts_code + f_ann_date + end_date + report_type +
+update_flag, ...), the key leads with the columns of the former (ts_code,
+date) index. With `write_mode='ignore'` or `'upsert'` (see `writer.py`)
+re-running an update over an overlapping window does not create duplicates.
+`create_all_tables` does not change an existing table: a table created before
+the keys were declared needs `create_unique_key` first, `check_unique_key`
+refuses the 'ignore' and 'upsert' writes until then.
+
+The `log` table keeps the run history: errors, retries and the rows and
+duration of every request, written in batches by the `LogSink` (see
+`log_sink.py`).
+
+The `sync_state` table records the status of every (api_name, key, window)
+of an update (a trade date, or a ts_code with its start/end dates). The
+`BatchWriter` writes it in the same transaction as the data, so an
+interrupted update resumes with only its unfinished keys.
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.engine import Engine
 from sqlalchemy.sql import text
-from sqlalchemy import Column, String, Integer, Float, Date, Index
+from sqlalchemy import Column, String, Integer, Float, Date, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship, declarative_base, Session
 from sqlalchemy import TIMESTAMP
 
@@ -27,11 +45,28 @@ def get_engine(host: str,
 class Log(Base):
     __tablename__ = 'log'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    update_table = Column(String(20), nullable=False)
-    message = Column(String(200), nullable=False)
+    update_table = Column(String(50), nullable=False)
+    message = Column(Text, nullable=False)  # full error messages and tracebacks
+    level = Column(String(10))  # info / warning / error
+    event = Column(String(20))  # fetch / write / update / download
+    sync_key = Column(String(20))  # trade_date (YYYYMMDD), ts_code or period
+    row_count = Column(Integer)
+    duration = Column(Float)  # seconds
+    error_class = Column(String(10))  # quota / transient / permanent, see retry.py
     created_at = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
 
 
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    api_name = Column(String(50), primary_key=True)
+    sync_key = Column(String(20), primary_key=True)  # trade_date (YYYYMMDD) or ts_code
+    window_start = Column(String(8), primary_key=True)  # YYYYMMDD
+    window_end = Column(String(8), primary_key=True)  # YYYYMMDD
+    status = Column(String(10), nullable=False)  # pending / done / failed
+    row_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, server_default=text('CURRENT_TIMESTAMP'))
+
+
 class StockBasic(Base):
     __tablename__ = 'stock_basic'
     ts_code = Column(String(20), primary_key=True)  # 股票代码
@@ -63,7 +98,7 @@ class TradeCal(Base):
 class Daily(Base):
     __tablename__ = 'daily'
     __table_args__ = (
-        Index('idx_daily_ts_code_trade_date', 'ts_code', 'trade_date'),
+        UniqueConstraint('ts_code', 'trade_date', name='uq_daily_ts_code_trade_date'),
         Index('idx_daily_trade_date', 'trade_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -82,7 +117,7 @@ class Daily(Base):
 class AdjFactor(Base):
     __tablename__ = 'adj_factor'
     __table_args__ = (
-        Index('idx_adjfactor_ts_code_trade_date', 'ts_code', 'trade_date'),
+        UniqueConstraint('ts_code', 'trade_date', name='uq_adjfactor_ts_code_trade_date'),
         Index('idx_adjfactor_trade_date', 'trade_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -93,7 +128,7 @@ class AdjFactor(Base):
 class DailyBasic(Base):
     __tablename__ = 'daily_basic'
     __table_args__ = (
-        Index('idx_dailybasic_ts_code_trade_date', 'ts_code', 'trade_date'),
+        UniqueConstraint('ts_code', 'trade_date', name='uq_dailybasic_ts_code_trade_date'),
         Index('idx_dailybasic_trade_date', 'trade_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -119,7 +154,8 @@ class DailyBasic(Base):
 class Income(Base):
     __tablename__ = 'income'
     __table_args__ = (
-        Index('idx_income_ts_code_f_ann_date', 'ts_code', 'f_ann_date'),
+        UniqueConstraint('ts_code', 'f_ann_date', 'end_date', 'report_type', 'update_flag',
+                         name='uq_income_natural_key'),
         Index('idx_income_f_ann_date', 'f_ann_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -221,7 +257,8 @@ class Income(Base):
 class BalanceSheet(Base):
     __tablename__ = 'balancesheet'
     __table_args__ = (
-        Index('idx_balancesheet_ts_code_f_ann_date', 'ts_code', 'f_ann_date'),
+        UniqueConstraint('ts_code', 'f_ann_date', 'end_date', 'report_type', 'update_flag',
+                         name='uq_balancesheet_natural_key'),
         Index('idx_balancesheet_f_ann_date', 'f_ann_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -388,7 +425,8 @@ class BalanceSheet(Base):
 class Cashflow(Base):
     __tablename__ = 'cashflow'
     __table_args__ = (
-        Index('idx_cashflow_ts_code_f_ann_date', 'ts_code', 'f_ann_date'),
+        UniqueConstraint('ts_code', 'f_ann_date', 'end_date', 'report_type', 'update_flag',
+                         name='uq_cashflow_natural_key'),
         Index('idx_cashflow_f_ann_date', 'f_ann_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -494,7 +532,8 @@ class Cashflow(Base):
 class FinaIndicator(Base):
     __tablename__ = 'fina_indicator'
     __table_args__ = (
-        Index('idx_finaindicator_ts_code_ann_date', 'ts_code', 'ann_date'),
+        UniqueConstraint('ts_code', 'ann_date', 'end_date', 'update_flag',
+                         name='uq_finaindicator_natural_key'),
         Index('idx_finaindicator_ann_date', 'ann_date'),
     )
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -672,6 +711,9 @@ def insert_log(engine: Engine,
             message: str) -> None:
     """
     Inserts a log entry into the `log` table using SQLAlchemy ORM.
+
+    One transaction per entry, the update functions buffer their entries in a
+    `LogSink` (see `log_sink.py`) instead.
     """
     with Session(engine) as session:
         log_entry = Log(update_table=table_name, message=message)
@@ -732,3 +774,104 @@ def create_index(engine: Engine,
                         CREATE INDEX {idx_name} ON {table_name} ({index});
                         """
                     conn.execute(text(query_create_index))
+
+
+def get_natural_key(table_name: str) -> list[str] | None:
+    """
+    Returns the natural key columns of a table declared in this module: the
+    unique key of tables with a surrogate `id`, otherwise the primary key.
+
+    :param table_name: The name of the table.
+    :return: The key columns, or None for an unknown table.
+    """
+    table = Base.metadata.tables.get(table_name)
+    if table is None:
+        return None
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            return [col.name for col in constraint.columns]
+    return [col.name for col in table.primary_key.columns]
+
+
+def _unique_keys(engine: Engine, table_name: str) -> dict[str, list[str]]:
+    """
+    The unique keys of a table in the database (primary key included), by name.
+    """
+    inspector = inspect(engine)
+    keys = {'PRIMARY': inspector.get_pk_constraint(table_name)['constrained_columns']}
+    for constraint in inspector.get_unique_constraints(table_name):
+        keys[constraint['name']] = constraint['column_names']
+    for index in inspector.get_indexes(table_name):
+        if index['unique']:
+            keys[index['name']] = index['column_names']
+    return keys
+
+
+def check_unique_key(engine: Engine, table_name: str) -> None:
+    """
+    Checks that a table has its natural unique key in the database, which the
+    'ignore' and 'upsert' write modes rely on (see `writer.py`). Without it,
+    `INSERT IGNORE` inserts every row again.
+
+    :param engine: A SQLAlchemy Engine object that connects to the database.
+    :param table_name: The name of the table.
+    :return: None
+    :raises ValueError: If the table or its unique key is missing.
+    """
+    if not inspect(engine).has_table(table_name):
+        raise ValueError(f'Table {table_name} does not exist, create it with create_all_tables(engine)')
+    key = get_natural_key(table_name)
+    keys = [set(columns) for columns in _unique_keys(engine, table_name).values() if columns]
+    if key is None:
+        # a table not declared here: any unique key
+        found = bool(keys)
+    else:
+        found = set(key) in keys
+    if found:
+        return
+    raise ValueError(f'Table {table_name} has no unique key on ({", ".join(key or [])}), '
+                     f'rows would be inserted again. Add it with '
+                     f'create_unique_key(engine, {table_name!r}, remove_duplicates=True) first')
+
+
+def create_unique_key(engine: Engine,
+                      table_name: str,
+                      remove_duplicates: bool = False) -> None:
+    """
+    Adds the natural unique key to a table created before the key was declared,
+    or replaces a key of the same name declared with other columns.
+
+    Existing duplicates make `ALTER TABLE` fail, with `remove_duplicates` the
+    rows sharing a natural key are deleted first, keeping the latest `id`.
+
+    :param engine: A SQLAlchemy Engine object that connects to the database.
+    :param table_name: The name of the table.
+    :param remove_duplicates: Delete duplicated rows before adding the key.
+    :return: None
+    """
+    table = Base.metadata.tables[table_name]
+    constraint = next((c for c in table.constraints if isinstance(c, UniqueConstraint)), None)
+    if constraint is None:
+        return
+    key = [col.name for col in constraint.columns]
+
+    existing = _unique_keys(engine, table_name).get(constraint.name)
+    if existing == key:
+        return
+
+    with engine.begin() as conn:
+        if existing is not None:
+            # declared with fewer columns, e.g. before update_flag
+            conn.execute(text(f"ALTER TABLE {table_name} DROP INDEX {constraint.name}"))
+
+        if remove_duplicates:
+            join_on = ' AND '.join(f't1.{col} = t2.{col}' for col in key)
+            conn.execute(text(f"""
+            DELETE t1 FROM {table_name} t1
+            JOIN {table_name} t2 ON {join_on} AND t1.id < t2.id
+            """))
+
+        conn.execute(text(f"""
+        ALTER TABLE {table_name}
+        ADD UNIQUE KEY {constraint.name} ({', '.join(key)})
+        """))
@@ -4,185 +4,774 @@ Author: Yanzhong(Eric) Huang
 
 The entry point of the download and update process.
 
-- `_convert_date_column` will convert the date column to datetime, including:
-    - `trade_date`
-    - `cal_date`
-    - `pretrade_date`
-    - `ann_date`
-    - `f_ann_date`
-    - `end_date`
-- `download` function will replace the table
-- `update_by_date` function will append to the table
-    - `_update_single_date` will update a single date
-    - it will multiprocess the `_update_single_date`
-- `update_by_code function will append to the table
-    - `_update_single_code` will update a single code
-    - it will multiprocess the `_update_single_code`
+- the downloaded frames are converted to the column types of their table
+  (dates parsed as YYYYMMDD, floats, optional float32 and categorical
+  `ts_code`) by `convert_frame` (see `convert.py`)
+- `download` function will insert the new rows of the table, comparing keys
+  with `query_existing_keys` instead of reading the whole table
+- `update_by_date` function will append to the table, one request per date
+- `update_by_code` function will append to the table, one request per code
+    - `_plan_update` lists the requests of the update (see `planner.py`),
+      `mode='auto'` picks by date or by code, whichever takes fewer calls
+    - `mode='period'` fetches the financial statements by reporting period
+      across all codes, instead of one request per code
+    - `_single_task` downloads a single request
+    - `_run_plan` will multiprocess the `_single_task`
+- the workers only download, the frames are written in large batches by a
+  single `BatchWriter` in the parent process (see `writer.py`)
+- every trade date / ts_code is recorded in `sync_state` with its rows, an
+  interrupted update resumes with the unfinished keys only (`resume=True`)
+- `_init_worker` builds the Tushare client and static config once per
+  worker process, tasks only carry their varying params
+- the run history (errors with their traceback, the rows and duration of every
+  request and update) is written in batches by a `LogSink` of the parent
+  process, the workers return their entries with their results (see
+  `log_sink.py`)
+- failed requests are retried with exponential backoff, permanent errors are
+  not retried (see `retry.py`)
+- `concurrency=AIMDController(...)` adapts the number of in-flight requests to
+  the latency and errors observed (see `concurrency.py`)
+- `repair_by_date` re-downloads the missing or incomplete trade dates of a
+  date-keyed table, found with one aggregated query
+- every stage (fetch, rate limiter wait, retry sleep, conversion, write) is
+  timed per API in the metrics of the process, the workers send theirs back
+  with every result (see `metrics.py`)
+- `dry_run=True` returns the plan summary (calls, rows, projected duration
+  under the rate limit) without calling Tushare or writing anything
+- `memory_mb` bounds the memory of the frames between the fetch and the
+  write: the loop sends no new request while the frames in flight (at the
+  average frame size seen) and the frames waiting for the writer exceed it,
+  a lagging database slows the fetching down (see `MemoryBudget` in
+  `writer.py`)
+- `calls_per_minute` sets the shared rate limit of the API (see `rate_limit.py`),
+  all workers pace themselves under it instead of failing on the quota. A
+  `TokenPool` is paced by the quotas of its tokens, it refuses the argument
 """
 
 
+import traceback
 import pandas as pd
-from time import sleep
 from sqlalchemy.engine import Engine
-from sqlalchemy import create_engine, text
+from sqlalchemy import inspect, text
 from datetime import datetime
-
-from .tushare_api import tushare_download
-from .database import insert_log
+from time import monotonic
+
+from .tushare_api import get_client, get_row_limit, tushare_download
+from .database import Base, SyncState, check_unique_key
+from .convert import convert_frame
+from .log_sink import LogSink, log_event, INFO, ERROR
+from .planner import Plan, VIP_APIS, plan_by_date, plan_by_code, plan_by_period, choose_plan, quarter_ends
+from .concurrency import AIMDController
+from .metrics import get_metrics, export
+from .rate_limit import set_rate_limit, get_rate_limit
+from .token_pool import TokenPool, tokens_of
+from .retry import RetryPolicy, call_with_retry, classify_error
+from .writer import BatchWriter, MemoryBudget, to_sql, mark_pending, prune_sync_state, clear_pending_dates
 from .queries import (query_trade_cal,
-                      query_latest_f_ann_date_by_ts_code,
-                      query_latest_ann_date_by_ts_code,
+                      query_latest_date_by_ts_code,
                       query_latest_trade_date_by_table_name,
-                      query_code_list)
-from concurrent.futures import ProcessPoolExecutor
+                      query_code_list,
+                      query_existing_keys,
+                      query_sync_state,
+                      query_date_coverage)
+from concurrent.futures import (ProcessPoolExecutor, Executor, Future,
+                                FIRST_COMPLETED, as_completed, wait)
+from typing import Callable, Iterable, Iterator
 
 
 START_DATE = '20000101'  # default start date for data download
+UPDATE_MODES = ('fixed', 'auto', 'period')
+PERIOD_LOOKBACK = 4  # reporting periods fetched again before the latest one, for late filings
+MEMORY_MB = 1024  # default memory budget of the frames between fetch and write
+
+
+def _update_window(engine: Engine,
+                   api_name: str,
+                   end_date: datetime) -> tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Returns the (start, end) window of a by-date update: from the day after the
+    latest trade_date in the table (or `START_DATE`) to `end_date`.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param end_date: The ending date for the data update.
+    :return: Start and end date as pandas Timestamps, start > end if up to date.
+    """
+    # latest date in database
+    latest_date = query_latest_trade_date_by_table_name(engine, api_name)
+
+    # Ensure latest_date and end_date are pandas Timestamps for comparison and arithmetic
+    latest_date = pd.to_datetime(latest_date) if latest_date is not None else pd.to_datetime(START_DATE)
+    latest_date = latest_date + pd.Timedelta(days=1)
+    return latest_date, pd.to_datetime(end_date)
+
+
+def _query_date_field(engine: Engine, api_name: str) -> str | None:
+    """
+    Determines which date field to use for a by-code incremental update.
+
+    Priority: f_ann_date > ann_date > trade_date, None if the table is empty.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :return: The date field name or None.
+    """
+    with engine.connect() as conn:
+        result = conn.execute(text(f"SELECT * FROM {api_name} LIMIT 1"))
+        row = result.fetchone()
+        if row is not None:
+            columns = result.keys()
+        else:
+            columns = []
+
+    for date_field in ('f_ann_date', 'ann_date', 'trade_date'):
+        if date_field in columns:
+            return date_field
+    return None
+
+
+def _query_start_dates(engine: Engine,
+                       api_name: str,
+                       codes: list[str],
+                       date_field: str | None) -> dict[str, str]:
+    """
+    Returns the start date (YYYYMMDD) of every code for a by-code update, the
+    day after the latest `date_field` of the code, or `START_DATE` if the code
+    has no data. One GROUP BY query covers all codes.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param codes: The stock codes.
+    :param date_field: The date field selected by `_query_date_field`.
+    :return: A dict {ts_code: start date string}.
+    """
+    latest_dates = query_latest_date_by_ts_code(engine, api_name, date_field) if date_field else {}
+    start_dates = {}
+    for ts_code in codes:
+        latest_date = latest_dates.get(ts_code)
+        if latest_date is None:
+            start_dates[ts_code] = START_DATE
+        else:
+            start_dates[ts_code] = (pd.to_datetime(latest_date) + pd.Timedelta(days=1)).strftime('%Y%m%d')
+    return start_dates
+
+
+def _new_rows(engine: Engine, api_name: str, df_new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the rows of `df_new` whose key is not in the table yet.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param df_new: The downloaded DataFrame.
+    :return: The new rows.
+    """
+    # Compare columns for new rows
+    if api_name == 'stock_basic':
+        compare_cols = ['ts_code']
+    elif 'ts_code' in df_new.columns and 'trade_date' in df_new.columns:
+        compare_cols = ['ts_code', 'trade_date']
+    elif 'ts_code' in df_new.columns:
+        compare_cols = ['ts_code']
+    else:
+        compare_cols = df_new.columns.tolist()
+
+    # Read only the existing keys, limited to the date range of the new data
+    date_ranges = {col: (df_new[col].min(), df_new[col].max())
+                   for col in compare_cols
+                   if pd.api.types.is_datetime64_any_dtype(df_new[col]) and df_new[col].notna().any()}
+    df_existing = query_existing_keys(engine, api_name, compare_cols, date_ranges)
+
+    if not df_existing.empty:
+        merged = df_new.merge(df_existing, on=compare_cols, how='left', indicator=True)
+        df_to_insert = merged[merged['_merge'] == 'left_only']
+        df_to_insert = df_to_insert[df_new.columns]
+    else:
+        df_to_insert = df_new
+    return df_to_insert
 
 
-def _convert_date_column(df: pd.DataFrame) -> pd.DataFrame:
+def _dry_run(plan: Plan,
+             token: str | TokenPool,
+             calls_per_minute: int | None,
+             max_workers: int) -> dict:
+    """
+    Prints and returns the summary of a plan, projecting its duration with
+    `calls_per_minute`, or else the rate limit set for the API (the sum of the
+    quotas for a `TokenPool`).
+    """
+    if calls_per_minute is None:
+        calls_per_minute = token.calls_per_minute if isinstance(token, TokenPool) \
+            else get_rate_limit(plan.endpoint or plan.api_name)
+    summary = plan.summary(calls_per_minute, max_workers)
+    rows = 'unknown' if summary['rows'] is None else summary['rows']
+    print(f"Dry run {plan.api_name} {plan.strategy}: {summary['requests']} requests, "
+          f"{summary['calls']} calls, {rows} rows, about {summary['seconds'] / 60:.1f} minutes "
+          f"at {calls_per_minute:g} calls per minute with {max_workers} workers")
+    return summary
+
+
+def _check_rate_limit(token: str | TokenPool, calls_per_minute: int | None) -> None:
     """
-    Converts specific columns in the provided DataFrame to datetime format.
+    Refuses `calls_per_minute` with a `TokenPool`: the calls of a pool take
+    from the bucket of each of its tokens, at the quota of the token, not from
+    the bucket of the API the value would be set on.
+    """
+    if calls_per_minute is not None and isinstance(token, TokenPool):
+        raise ValueError('calls_per_minute does not apply to a TokenPool, set the calls per minute '
+                         'of each token instead: TokenPool({token: calls_per_minute})')
 
-    This function checks for the presence of specific date-related columns in
-    the input DataFrame and converts them to pandas datetime format. The columns
-    considered for conversion include "trade_date", "cal_date",
-    "pretrade_date", "ann_date", "f_ann_date", and "end_date".
 
-    :param df: The input DataFrame containing the columns to be converted to
-        datetime format.
-    :return: A DataFrame with the specified columns converted to datetime format.
+def _apply_rate_limit(plan: Plan, calls_per_minute: int | None) -> None:
+    """
+    Sets `calls_per_minute` as the rate limit of the API the plan calls: the
+    VIP endpoint of a by-period plan (e.g. `income_vip`, its own bucket),
+    otherwise the API itself. None keeps the current setting.
     """
-    date_columns = ['trade_date', 'cal_date', 'pretrade_date', 'ann_date', 'f_ann_date', 'end_date']
-    for col in date_columns:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col])
-    return df
+    if calls_per_minute is not None:
+        set_rate_limit(plan.endpoint or plan.api_name, calls_per_minute)
 
 
 def download(engine: Engine,
-             token: str,
+             token: str | TokenPool,
              api_name: str,
              params: dict | None = None,
              fields: list[str] | None = None,
-             retry: int = 3) -> None:
+             retry: int = 3,
+             calls_per_minute: int | None = None,
+             write_mode: str = 'append',
+             dry_run: bool = False) -> dict:
     """
     Downloads data from a specified API endpoint, processes the resulting data,
     and stores it in a database table. It handles errors gracefully by logging
     any issues encountered during the download or data processing steps.
 
     :param engine: A SQLAlchemy engine instance used for connecting to the database.
-    :param token: The API authentication token required for accessing the API.
+    :param token: The API authentication token required for accessing the API, or a `TokenPool`.
     :param api_name: The name of the API endpoint from which data is to be downloaded.
     :param params: A dictionary of optional parameters to be passed to the API request.
     :param fields: A list of fields to be fetched from the API response.
-    :param retry: Retry times if download failed. Default is 3.
-    :return: None.
+    :param retry: Attempts in total if download failed, permanent errors are not
+        retried (see `retry.py`). Default is 3.
+    :param calls_per_minute: Rate limit of the API, None keeps the current setting.
+    :param write_mode: 'append' inserts the rows not found by comparing keys,
+        'ignore' or 'upsert' write every row and let the unique key of the
+        table skip or overwrite existing rows (see `check_unique_key`).
+    :param dry_run: Only return the plan summary (see `_dry_run`), without
+        calling Tushare. A capped response takes more calls (pagination).
+    :return: The plan summary if `dry_run`, else the metrics of this download
+        (see `Metrics.stats`).
+    :raises ValueError: If `calls_per_minute` is given with a `TokenPool`.
+    """
+    _check_rate_limit(token, calls_per_minute)
+    if dry_run:
+        plan = Plan(api_name, 'download', [(api_name, params or {}, (api_name, '', ''))], 1)
+        return _dry_run(plan, token, calls_per_minute, 1)
+    if write_mode != 'append':
+        check_unique_key(engine, api_name)
+    if calls_per_minute is not None:
+        set_rate_limit(api_name, calls_per_minute)
+    start = monotonic()
+    with get_metrics().run() as run, LogSink(engine) as sink:
+        _download(engine, token, api_name, params, fields, retry, write_mode, sink)
+        sink.log(api_name, f'Downloaded {api_name}', event='download', duration=monotonic() - start)
+    export()
+    return run.stats()
+
+
+def _download(engine: Engine,
+              token: str | TokenPool,
+              api_name: str,
+              params: dict | None,
+              fields: list[str] | None,
+              retry: int,
+              write_mode: str,
+              sink: LogSink) -> None:
+    """
+    The body of `download`, the rows written and the errors go to `sink`.
     """
-    try_count = 1
     try:
-        df_new = tushare_download(token, api_name, params, fields)
-        df_new = _convert_date_column(df_new)  # type: ignore
-
-        # Read existing data from database
-        try:
-            df_existing = pd.read_sql_table(api_name, engine)
-        except Exception:
-            df_existing = pd.DataFrame()
-
-
-        # Compare columns for new rows
-        if api_name == 'stock_basic':
-            compare_cols = ['ts_code']
-        elif 'ts_code' in df_new.columns and 'trade_date' in df_new.columns:
-            compare_cols = ['ts_code', 'trade_date']
-        elif 'ts_code' in df_new.columns:
-            compare_cols = ['ts_code']
-        else:
-            compare_cols = df_new.columns.tolist()
+        df_new = call_with_retry(lambda: tushare_download(token, api_name, params, fields),
+                                 RetryPolicy(max_attempts=retry), api_name, api_name=api_name)
+        with get_metrics().timer(api_name, 'convert_seconds'):
+            df_new = convert_frame(df_new, api_name)  # type: ignore
 
-        if not df_existing.empty:
-            merged = df_new.merge(df_existing, on=compare_cols, how='left', indicator=True, suffixes=('', '_dup'))
-            df_to_insert = merged[merged['_merge'] == 'left_only']
-            # Only keep columns from df_new (original columns, not _dup)
-            df_to_insert = df_to_insert[df_new.columns]
+        if write_mode == 'append':
+            df_to_insert = _new_rows(engine, api_name, df_new)
         else:
+            # the unique key of the table skips or overwrites existing rows
             df_to_insert = df_new
 
         if not df_to_insert.empty:
-            df_to_insert.to_sql(api_name, engine, if_exists='append', index=False)
+            start = monotonic()
+            to_sql(df_to_insert, api_name, engine, write_mode)
+            duration = monotonic() - start
+            get_metrics().observe(api_name, 'write_seconds', duration)
+            get_metrics().inc(api_name, 'rows_written', len(df_to_insert))
+            sink.log(api_name, f'Inserted {len(df_to_insert)} new rows into {api_name}',
+                     event='write', row_count=len(df_to_insert), duration=duration)
             print(f'Inserted {len(df_to_insert)} new rows into {api_name}')
         else:
             print(f'No new rows to insert for {api_name}')
     except Exception as e:
-        error_msg = f'Error downloading {api_name}: {e}'
-        insert_log(engine, table_name=api_name, message=error_msg)
+        error_msg = f'Error downloading {api_name} ({classify_error(e)}): {e}\n{traceback.format_exc()}'
+        sink.log(api_name, error_msg, level=ERROR, event='download', error_class=classify_error(e))
+        print(f'Error downloading {api_name}, stop retrying')
 
-        # retry in 60s
-        if try_count < retry:
-            sleep(60)
-            download(engine, token, api_name, params, fields, retry)
-        else:
-            print(f'Error downloading {api_name}, retry {retry} times, stop retrying')
 
+def _resume_dates(engine: Engine,
+                  api_name: str,
+                  trade_cal: list,
+                  end_date: datetime) -> list[pd.Timestamp]:
+    """
+    Adds the unfinished trade dates recorded in the `sync_state` table to a
+    by-date update: dates still pending (an interrupted run) or failed, up to
+    `end_date`. They may be older than the latest trade_date of the table,
+    since the writer commits dates in completion order.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param trade_cal: The trade dates from the latest date to `end_date`.
+    :param end_date: The ending date for the data update.
+    :return: The sorted trade dates to update.
+    """
+    # the records of trade dates, not of codes or periods
+    unfinished = {key for status in ('pending', 'failed')
+                  for key, window_start, window_end in query_sync_state(engine, api_name, status)
+                  if key == window_start == window_end}
+    dates = {pd.Timestamp(d).strftime('%Y%m%d') for d in trade_cal}
+    dates |= {key for key in unfinished if key <= end_date.strftime('%Y%m%d')}
+    return [pd.Timestamp(d) for d in sorted(dates)]
+
+
+def _resume_codes(engine: Engine,
+                  api_name: str,
+                  start_dates: dict[str, str],
+                  end_str: str) -> dict[str, str]:
+    """
+    Removes the codes recorded in the `sync_state` table as done up to the same
+    end date, by a previous run that was interrupted. A code is fetched in one
+    request and committed in one transaction (see `plan_by_code`), so pending
+    or failed codes have no committed rows, their start date is still correct.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param start_dates: {ts_code: start date} of the update.
+    :param end_str: The end date of the update (YYYYMMDD).
+    :return: The start dates of the unfinished codes.
+    """
+    done = {key for key, _, _ in query_sync_state(engine, api_name, 'done', end_str)}
+    return {code: start for code, start in start_dates.items() if code not in done}
+
+
+def _map_bounded(executor: Executor,
+                 fn: Callable,
+                 keys: Iterable,
+                 max_pending: int,
+                 admit: Callable[[int], bool] | None = None) -> Iterator:
+    """
+    Like `executor.map`, but keeps at most `max_pending` tasks submitted and
+    yields (key, result) pairs in completion order. Results are not buffered
+    in the executor faster than the caller consumes them.
+
+    :param executor: The executor running the tasks.
+    :param fn: The task function.
+    :param keys: The task arguments, one per task.
+    :param max_pending: The maximum number of submitted, unconsumed tasks.
+    :param admit: Called with the number of submitted tasks, whether one more
+        may be submitted (e.g. `MemoryBudget.admit`), optional. One task is
+        always submitted.
+    :return: An iterator over the (key, task result) pairs.
+    """
+    pending: dict[Future, object] = {}
+    for key in keys:
+        while pending and (len(pending) >= max_pending or (admit is not None and not admit(len(pending)))):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+        pending[executor.submit(fn, key)] = key
+    for future in as_completed(pending):
+        yield pending[future], future.result()
+
+
+def _date_keyed(engine: Engine, api_name: str) -> bool:
+    """
+    Whether the rows of the API are keyed by (ts_code, trade_date), so it can be
+    fetched by date as well as by code.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :return: True for daily price style tables.
+    """
+    inspector = inspect(engine)
+    if inspector.has_table(api_name):
+        columns = {column['name'] for column in inspector.get_columns(api_name)}
+    elif api_name in Base.metadata.tables:
+        columns = set(Base.metadata.tables[api_name].columns.keys())
+    else:
+        return False
+    return 'trade_date' in columns and not columns & {'ann_date', 'f_ann_date'}
+
+
+def _date_plan(engine: Engine,
+               api_name: str,
+               end_date: datetime,
+               resume: bool) -> Plan:
+    """
+    Plans a by-date update: the trade dates from the latest trade_date of the
+    table to `end_date`, plus the unfinished dates if `resume`.
+    """
+    latest_date, end_date = _update_window(engine, api_name, end_date)
+    trade_cal = query_trade_cal(engine, start_date=latest_date, end_date=end_date) if end_date >= latest_date else []
+    if resume:
+        trade_cal = _resume_dates(engine, api_name, trade_cal, end_date)
+    return plan_by_date(api_name, trade_cal, len(query_code_list(engine)), get_row_limit(api_name))
+
+
+def _code_plan(engine: Engine,
+               api_name: str,
+               end_date: datetime,
+               resume: bool,
+               by_trade_date: bool = False) -> Plan:
+    """
+    Plans a by-code update: every code from its latest date to `end_date`.
 
-def _single_date_update(engine_url: str,
-                        token: str,
-                        api_name: str,
-                        trade_date: datetime,
-                        params: dict | None = None,
-                        fields: list[str] | None = None,
-                        retry: int = 3) -> None:
+    With `by_trade_date` the ranges are counted (and split) on the trade
+    calendar, codes without a new trade date are skipped.
     """
-    Updates a single date entry for a given API by downloading the associated
-    data and saving it to the database. It retries the operation in case of failure
-    up to a specified number of times, logging errors as they occur.
+    codes = query_code_list(engine)
 
-    :param engine_url: URL of the database engine used to connect to the database.
-    :param token: Authentication token required to access the API.
+    # Determine which date field to use for incremental update (once per table)
+    date_field = 'trade_date' if by_trade_date else _query_date_field(engine, api_name)
+    # latest date of every code with one query
+    start_dates = _query_start_dates(engine, api_name, codes, date_field)
+
+    end_str = end_date.strftime('%Y%m%d')
+    if resume:
+        start_dates = _resume_codes(engine, api_name, start_dates, end_str)
+
+    trade_dates = None
+    if by_trade_date:
+        start = pd.to_datetime(min(start_dates.values(), default=end_str))
+        trade_dates = query_trade_cal(engine, start_date=start, end_date=pd.to_datetime(end_date))
+    return plan_by_code(api_name, start_dates, end_str, get_row_limit(api_name), trade_dates)
+
+
+def _period_plan(engine: Engine,
+                 api_name: str,
+                 end_date: datetime,
+                 resume: bool,
+                 lookback: int = PERIOD_LOOKBACK) -> Plan:
+    """
+    Plans a by-period update of a financial statement table: every reporting
+    period from `lookback` periods before the latest `end_date` of the table
+    (or from `START_DATE`) to `end_date`, across all codes. Codes without data,
+    or whose latest period is older than the first period fetched, are
+    updated one by one from their latest date.
+    """
+    codes = query_code_list(engine)
+    latest_periods = {code: pd.to_datetime(period).strftime('%Y%m%d')
+                      for code, period in query_latest_date_by_ts_code(engine, api_name, 'end_date').items()}
+    end_str = end_date.strftime('%Y%m%d')
+
+    if latest_periods:
+        window_start = (pd.to_datetime(max(latest_periods.values()))
+                        - pd.DateOffset(months=3 * lookback)).strftime('%Y%m%d')
+        gap_codes = [code for code in codes if latest_periods.get(code, '') < window_start]
+    else:
+        # empty table: the periods cover every code
+        window_start, gap_codes = START_DATE, []
+    periods = quarter_ends(window_start, end_str)
+    gap_start_dates = _query_start_dates(engine, api_name, gap_codes, _query_date_field(engine, api_name))
+
+    if resume:
+        done = {key for key, _, _ in query_sync_state(engine, api_name, 'done', end_str)}
+        periods = [period for period in periods if period not in done]
+        gap_start_dates = _resume_codes(engine, api_name, gap_start_dates, end_str)
+    return plan_by_period(api_name, periods, len(codes), get_row_limit(VIP_APIS[api_name]), end_str,
+                          gap_start_dates)
+
+
+def _plan_update(engine: Engine,
+                 api_name: str,
+                 end_date: datetime,
+                 strategy: str,
+                 mode: str = 'fixed',
+                 resume: bool = True) -> Plan:
+    """
+    Plans the requests of an update.
+
+    In 'fixed' mode the plan follows `strategy` ('by_date' or 'by_code'). In
+    'auto' mode an API keyed by trade date, or a financial statement API with
+    a VIP endpoint, gets the plan with the fewest calls (see `planner.py`),
+    other APIs keep `strategy`. 'period' fetches a financial statement API by
+    reporting period.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param end_date: The ending date for the data update.
+    :param strategy: The strategy of the calling update function.
+    :param mode: 'fixed', 'auto' or 'period'.
+    :param resume: Resume the unfinished keys of `sync_state`.
+    :return: The plan.
+    """
+    if mode not in UPDATE_MODES:
+        raise ValueError(f'Unknown mode {mode}, expected one of {UPDATE_MODES}')
+    if mode == 'period':
+        if api_name not in VIP_APIS:
+            raise ValueError(f"mode='period' supports {list(VIP_APIS)}, not {api_name}")
+        return _period_plan(engine, api_name, end_date, resume)
+    if mode == 'auto' and (api_name in VIP_APIS or _date_keyed(engine, api_name)):
+        if api_name in VIP_APIS:
+            plan = choose_plan(_period_plan(engine, api_name, end_date, resume),
+                               _code_plan(engine, api_name, end_date, resume))
+        else:
+            plan = choose_plan(_date_plan(engine, api_name, end_date, resume),
+                               _code_plan(engine, api_name, end_date, resume, by_trade_date=True))
+        print(f'Planned {api_name} {plan.strategy}: {plan.calls} calls, about {plan.rows} rows')
+        return plan
+    if strategy == 'by_date':
+        return _date_plan(engine, api_name, end_date, resume)
+    return _code_plan(engine, api_name, end_date, resume)
+
+
+def _map_adaptive(executor: Executor,
+                  fn: Callable,
+                  keys: Iterable,
+                  controller: AIMDController,
+                  admit: Callable[[int], bool] | None = None) -> Iterator:
+    """
+    Like `_map_bounded`, with the number of submitted tasks set by an
+    `AIMDController`. `fn` returns (result, error classes, ...), every
+    completed task is recorded in the controller with its latency.
+
+    :param executor: The executor running the tasks, with at least
+        `controller.max_concurrency` workers.
+    :param fn: The task function.
+    :param keys: The task arguments, one per task.
+    :param controller: The concurrency controller.
+    :param admit: See `_map_bounded`.
+    :return: An iterator over the (key, task result) pairs.
+    """
+    controller.start()
+    pending: dict[Future, tuple[object, float]] = {}
+    keys = iter(keys)
+    exhausted = False
+    while True:
+        while (not exhausted and len(pending) < controller.concurrency
+               and (not pending or admit is None or admit(len(pending)))):
+            key = next(keys, None)
+            if key is None:
+                exhausted = True
+            else:
+                pending[executor.submit(fn, key)] = (key, monotonic())
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, submitted = pending.pop(future)
+            result = future.result()
+            controller.record(monotonic() - submitted, result[1], result[0] is not None)
+            yield key, result
+
+
+# per worker process state, built once by `_init_worker`
+_worker: dict = {}
+
+
+def _init_worker(token: str | TokenPool,
+                 api_name: str,
+                 params: dict | None = None,
+                 fields: list[str] | None = None,
+                 retry: int = 3,
+                 endpoint: str | None = None) -> None:
+    """
+    Initializer of the `ProcessPoolExecutor` workers.
+
+    Builds the Tushare client once per worker process and keeps the static
+    config of the update, so every task only carries its varying parameters (a
+    trade date, or a ts_code and date range). The workers do not connect to
+    the database: the frames, metrics and log entries go back to the parent
+    process. The metrics inherited from a forked parent are cleared, the
+    worker only sends back its own.
+
+    :param token: Authentication token required to access the API, or a `TokenPool`.
     :param api_name: Name of the API to fetch data from.
-    :param trade_date: Date for which the data needs to be updated.
     :param params: Additional parameters to pass to the API request. Defaults to None.
     :param fields: Specific fields to fetch in the API response. Defaults to None.
     :param retry: Number of retry attempts in case of failure. Defaults to 3.
+    :param endpoint: The API called, if not `api_name` (e.g. `income_vip`).
     :return: None
     """
-    print(f'Updating {api_name} for {trade_date}')
-    # create a new engine using existing engine (multiprocess needs separate engine)
-    engine = create_engine(engine_url)
-
-    if params is None:
-        params = {}
-    params['trade_date'] = trade_date.strftime('%Y%m%d')
-
-    try_count = 0
-    while try_count < retry:
-        try:
-            df = tushare_download(token, api_name, params, fields)
-            df = _convert_date_column(df)  # type: ignore
-            df.to_sql(api_name, engine, if_exists='append', index=False)
-            break
-        except Exception as e:
-            print(f'Error downloading {api_name} for {trade_date}: {e}, retrying...')
-            try_count += 1
-            if try_count < retry:
-                sleep(60)
-            else:
-                error_msg = f'Error downloading {api_name} for {trade_date}: {e}'
-                insert_log(engine, table_name=api_name, message=error_msg)
-                print(f'Error downloading {api_name} for {trade_date}, retried {retry} times, giving up.')
-        finally:
-            engine.dispose()
+    get_metrics().reset()
+    for pool_token in tokens_of(token):
+        get_client(pool_token)
+
+    _worker.update(token=token,
+                   api_name=api_name,
+                   params=params or {},
+                   fields=fields,
+                   retry=retry,
+                   endpoint=endpoint or api_name)
+
+
+def _single_task(task: tuple[str, dict, tuple[str, str, str]]
+                 ) -> tuple[pd.DataFrame | None, list[str], dict, list[dict]]:
+    """
+    Downloads one planned request for the API of the worker. Failed requests
+    are retried by the `RetryPolicy` (see `retry.py`) up to `retry` attempts,
+    a permanent error fails at once and is logged. The frame is written by the
+    `BatchWriter` of the parent process, the log entry by its `LogSink`.
+
+    Runs in a worker process set up by `_init_worker`.
+
+    :param task: (label, params, sync record) from the plan, `params` (e.g. the
+        trade date, or the ts_code and its date range) are added to the static
+        params of the update.
+    :return: The downloaded DataFrame (None if all retries failed), the
+        classes of the errors met, for the concurrency controller, the
+        metrics of the task, merged by the parent process, and its log entries.
+    """
+    token, api_name = _worker['token'], _worker['api_name']
+    fields, retry, endpoint = _worker['fields'], _worker['retry'], _worker['endpoint']
+    label, task_params, (sync_key, _, _) = task
+    print(f'Updating {api_name} for {label}')
+
+    params = {**_worker['params'], **task_params}
+
+    metrics = get_metrics()
+    errors: list[str] = []
+    start = monotonic()
+    try:
+        df = call_with_retry(lambda: tushare_download(token, endpoint, params, fields),
+                             RetryPolicy(max_attempts=retry), f'{api_name} for {label}',
+                             on_error=lambda e: errors.append(classify_error(e)), api_name=endpoint)
+        with metrics.timer(endpoint, 'convert_seconds'):
+            df = convert_frame(df, api_name)  # type: ignore
+        message = f'Downloaded {api_name} for {label}' + (f' after {len(errors)} errors' if errors else '')
+        event = log_event(api_name, message, event='fetch', sync_key=sync_key,
+                          row_count=len(df), duration=monotonic() - start)
+        return df, errors, metrics.drain(), [event]
+    except Exception as e:
+        error_msg = f'Error downloading {api_name} for {label} ({classify_error(e)}): {e}'
+        print(f'Error downloading {api_name} for {label}, giving up.')
+        event = log_event(api_name, f'{error_msg}\n{traceback.format_exc()}', level=ERROR, event='fetch',
+                          sync_key=sync_key, duration=monotonic() - start, error_class=classify_error(e))
+    return None, errors, metrics.drain(), [event]
+
+
+def _prepare_run(engine: Engine,
+                 plan: Plan,
+                 write_mode: str,
+                 record_pending: bool = True) -> str:
+    """
+    Prepares a run of the plan, before anything is fetched: checks the unique
+    key the write mode needs, records the dates of a by-date plan as pending
+    (unless `record_pending` is False) and drops the older sync records of the
+    codes or periods of the other plans. Shared by `_run_plan` and the async
+    runner.
+
+    :param engine: The database engine.
+    :param plan: The plan to run.
+    :param write_mode: 'append', 'ignore' or 'upsert', see `writer.py`.
+    :param record_pending: Record the dates of a by-date plan as pending.
+    :return: The write mode of the run, 'ignore' for a by-period plan in 'append'.
+    :raises ValueError: If the write mode needs the unique key of the table and
+        it has none (see `check_unique_key`).
+    """
+    api_name = plan.api_name
+    if plan.strategy == 'by_period' and write_mode == 'append':
+        # a period overlaps the rows already stored, the unique key skips them
+        write_mode = 'ignore'
+    if write_mode != 'append':
+        # before anything is fetched or recorded
+        check_unique_key(engine, api_name)
+    if plan.strategy == 'by_date' and record_pending:
+        # record the dates as pending, an interrupted run resumes with them
+        mark_pending(engine, api_name, [record for _, _, record in plan.tasks])
+    elif plan.strategy != 'by_date':
+        records = [record for _, _, record in plan.tasks]
+        # one record per code (or period), not one more per run
+        prune_sync_state(engine, api_name, records)
+        if plan.strategy == 'by_code':
+            clear_pending_dates(engine, api_name, records)
+    return write_mode
+
+
+def _run_plan(engine: Engine,
+              token: str | TokenPool,
+              plan: Plan,
+              params: dict | None,
+              fields: list[str] | None,
+              retry: int,
+              max_workers: int,
+              write_mode: str,
+              concurrency: AIMDController | None = None,
+              record_pending: bool = True,
+              memory_mb: float | None = MEMORY_MB) -> None:
+    """
+    Downloads the tasks of a plan in a `ProcessPoolExecutor`, the frames are
+    written with their sync records by one `BatchWriter`. With a `concurrency`
+    controller the in-flight tasks follow the controller, in a pool of
+    `concurrency.max_concurrency` workers, instead of `max_workers`. The
+    metrics of the workers are merged into the metrics of this process, their
+    log entries go to one `LogSink`.
+
+    The stages stream: a task is only submitted while the `MemoryBudget` of
+    `memory_mb` admits it, a result is handed to the writer as soon as it
+    completes, and `BatchWriter.put` blocks while the frames waiting to be
+    written exceed the budget, which stops the submission of new tasks.
+    """
+    api_name = plan.api_name
+    start = monotonic()
+    write_mode = _prepare_run(engine, plan, write_mode, record_pending)
+
+    # multiprocess loop, every task only carries its varying params
+    pool_size = concurrency.max_concurrency if concurrency is not None else max_workers
+    budget = MemoryBudget(memory_mb) if memory_mb else None
+    admit = budget.admit if budget is not None else None
+    with ProcessPoolExecutor(max_workers=pool_size,
+                             initializer=_init_worker,
+                             initargs=(token, api_name, params, fields, retry, plan.endpoint)) as executor:
+        if concurrency is not None:
+            results = _map_adaptive(executor, _single_task, plan.tasks, concurrency, admit)
+        else:
+            results = _map_bounded(executor, _single_task, plan.tasks, max_workers * 2, admit)
+        metrics = get_metrics()
+        failed = 0
+        with LogSink(engine) as sink:
+            with BatchWriter(engine, api_name, write_mode=write_mode, log_sink=sink, budget=budget) as writer:
+                for (_, _, record), (df, _, task_metrics, events) in results:
+                    metrics.merge(task_metrics)
+                    sink.put(events)
+                    if df is None:
+                        failed += 1
+                        writer.fail(record)
+                    else:
+                        writer.put(df, record)
+            sink.log(api_name, f'{len(plan.tasks)} {plan.strategy} requests, {failed} failed',
+                     level=ERROR if failed else INFO, event='update', row_count=writer.rows_written,
+                     duration=monotonic() - start)
+
+    if concurrency is not None:
+        print(f'{api_name} concurrency: {concurrency.stats()}')
+    export()
 
 
 def update_by_date(engine: Engine,
-                   token: str,
+                   token: str | TokenPool,
                    api_name: str,
                    params: dict | None = None,
                    fields: list[str] | None = None,
                    end_date: datetime = datetime.now(),
                    max_workers: int = 10,
-                   retry: int = 3) -> None:
+                   retry: int = 3,
+                   calls_per_minute: int | None = None,
+                   write_mode: str = 'append',
+                   resume: bool = True,
+                   mode: str = 'fixed',
+                   concurrency: AIMDController | None = None,
+                   dry_run: bool = False,
+                   memory_mb: float | None = MEMORY_MB) -> dict:
     """
     Updates data from an API by iterating through trade dates and processing them in parallel.
 
@@ -191,133 +780,69 @@ def update_by_date(engine: Engine,
     `ProcessPoolExecutor` to process the dates in parallel for performance optimization.
 
     :param engine: The database engine used to execute queries and perform updates.
-    :param token: The authentication token required to access the API.
+    :param token: The authentication token required to access the API, or a `TokenPool`.
     :param api_name: The name of the API from which the data is being fetched.
     :param params: Optional dictionary of additional parameters to be sent in the query.
     :param fields: Optional list of specific fields to retrieve from the API.
     :param end_date: The ending date for the data update. Defaults to the current datetime.
     :param max_workers: The maximum number of parallel workers to process trade dates. Defaults to 10.
     :param retry: Number of retry attempts for failed API calls. Defaults to 3.
-    :return: This function returns nothing.
+    :param calls_per_minute: Rate limit of the API shared by all workers (of its VIP
+        endpoint for a by-period plan), None keeps the current setting.
+    :param write_mode: 'append' (default), 'ignore' or 'upsert', see `writer.py`.
+    :param resume: Resume with the keys of `sync_state` left pending or failed by a
+        previous run. Defaults to True.
+    :param mode: 'fixed' (default) requests one trade date per call, 'auto' lets the
+        planner fetch by date or by code, whichever takes fewer calls.
+    :param concurrency: An `AIMDController` adapting the in-flight requests (up to
+        its `max_concurrency`) instead of the fixed `max_workers`, optional.
+        Its `stats()` show the concurrency and rates observed.
+    :param dry_run: Only return the plan summary: the requests, API calls, rows and
+        projected duration (see `_dry_run`), without calling Tushare or writing.
+    :param memory_mb: Memory budget in MB of the downloaded frames not written yet,
+        fetching slows down when the database lags. None for no budget, only
+        the number of frames is bounded. Defaults to `MEMORY_MB`.
+    :return: The plan summary if `dry_run`, else the metrics of this update per
+        API (see `Metrics.stats`), without the earlier updates of the process.
+    :raises ValueError: If `calls_per_minute` is given with a `TokenPool`, whose
+        tokens have their own quotas.
     """
-    # latest date in database
-    latest_date = query_latest_trade_date_by_table_name(engine, api_name)
-
-    # Ensure latest_date and end_date are pandas Timestamps for comparison and arithmetic
-    latest_date = pd.to_datetime(latest_date) if latest_date is not None else pd.to_datetime(START_DATE)
-    latest_date = latest_date + pd.Timedelta(days=1)
-
-    end_date = pd.to_datetime(end_date)
-
-    if end_date < latest_date:
-        print(f'{api_name} already up to date')
-        return
-
-    # trade_cal
-    trade_cal = query_trade_cal(engine, start_date=latest_date, end_date=end_date)
-
-    print(f'Start updating {api_name} from {latest_date} to {end_date}')
-    # multiprocess loop
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        engine_urls = [engine.url for _ in trade_cal]
-        tokens = [token for _ in trade_cal]
-        api_names = [api_name for _ in trade_cal]
-        params_list = [params for _ in trade_cal]
-        fields_list = [fields for _ in trade_cal]
-        retries = [retry for _ in trade_cal]
-
-        list(executor.map(_single_date_update,
-                               engine_urls,
-                               tokens,
-                               api_names,
-                               trade_cal,
-                               params_list,
-                               fields_list,
-                               retries))
-
-
-    print(f'Finished updating {api_name} from {latest_date} to {end_date}')
-
-
-def _single_update_by_code(engine_url: str,
-                           token: str,
-                           api_name: str,
-                           ts_code: str,
-                           end_date: datetime,
-                           params: dict | None = None,
-                           fields: list[str] | None = None,
-                           retry: int = 3,
-                           date_field: str | None = None) -> None:
-    """
-    Updates a single stock code entry for a given API by downloading the associated
-    data and saving it to the database. Retries the operation in case of failure
-    up to a specified number of times, logging errors as they occur.
-
-    :param engine_url: URL of the database engine used to connect to the database.
-    :param token: Authentication token required to access the API.
-    :param api_name: Name of the API to fetch data from.
-    :param ts_code: Stock code for which the data needs to be updated.
-    :param params: Additional parameters to pass to the API request. Defaults to None.
-    :param fields: Specific fields to fetch in the API response. Defaults to None.
-    :param retry: Number of retry attempts in case of failure. Defaults to 3.
-    :return: None
-    """
-    # Create a new engine using existing engine_url (multiprocess requires separate engine)
-    engine = create_engine(engine_url)
-
-    # Determine latest date for this code using the selected date_field
-    if date_field == 'f_ann_date':
-        latest_date = query_latest_f_ann_date_by_ts_code(engine, table_name=api_name, ts_code=ts_code)
-    elif date_field == 'ann_date':
-        latest_date = query_latest_ann_date_by_ts_code(engine, table_name=api_name, ts_code=ts_code)
-    elif date_field == 'trade_date':
-        with engine.connect() as conn:
-            result = conn.execute(text(f"SELECT MAX(trade_date) FROM {api_name} WHERE ts_code = :ts_code"), {"ts_code": ts_code})
-            latest_date = result.scalar()
-    else:
-        latest_date = None
-
-    if latest_date is None:
-        start_date = START_DATE
-    else:
-        latest_date = pd.to_datetime(latest_date)
-        start_date = (latest_date + pd.Timedelta(days=1)).strftime("%Y%m%d")
-
-    print(f'Updating {api_name} for {ts_code} from {start_date} to {end_date.strftime('%Y%m%d')} (using {date_field})')
-    try_count = 0
-    if params is None:
-        params = {}
-    params['ts_code'] = ts_code
-    params['start_date'] = start_date
-    params['end_date'] = end_date.strftime('%Y%m%d')
-
-    while try_count <= retry:
-        try:
-            df = tushare_download(token, api_name, params, fields)
-            df = _convert_date_column(df)  # type: ignore
-            df.to_sql(api_name, engine, if_exists='append', index=False)
-            break
-        except Exception as e:
-            print(f'Error downloading {api_name} for {ts_code}: {e}, retrying...')
-            try_count += 1
-            if try_count < retry:
-                sleep(60)
-            else:
-                error_msg = f'Error downloading {api_name} for {ts_code}: {e}'
-                insert_log(engine, api_name, error_msg)
-                print(f'Error downloading {api_name} for {ts_code}, retried {retry} times, giving up.')
-        finally:
-            engine.dispose()
+    _check_rate_limit(token, calls_per_minute)
+    if dry_run:
+        plan = _plan_update(engine, api_name, end_date, 'by_date', mode, resume)
+        workers = concurrency.max_concurrency if concurrency is not None else max_workers
+        return _dry_run(plan, token, calls_per_minute, workers)
+
+    SyncState.__table__.create(engine, checkfirst=True)
+
+    with get_metrics().run() as run:
+        plan = _plan_update(engine, api_name, end_date, 'by_date', mode, resume)
+        _apply_rate_limit(plan, calls_per_minute)
+        if not plan.tasks:
+            print(f'{api_name} already up to date')
+        else:
+            print(f'Start updating {api_name} to {end_date} ({len(plan.tasks)} {plan.strategy} requests)')
+            _run_plan(engine, token, plan, params, fields, retry, max_workers, write_mode, concurrency,
+                      memory_mb=memory_mb)
+            print(f'Finished updating {api_name} to {end_date}')
+    return run.stats()
 
 
 def update_by_code(engine: Engine,
-                   token: str,
+                   token: str | TokenPool,
                    api_name: str,
                    params: dict | None = None,
                    fields: list[str] | None = None,
                    end_date: datetime = datetime.now(),
                    max_workers: int = 10,
-                   retry: int = 3) -> None:
+                   retry: int = 3,
+                   calls_per_minute: int | None = None,
+                   write_mode: str = 'append',
+                   resume: bool = True,
+                   mode: str = 'fixed',
+                   concurrency: AIMDController | None = None,
+                   dry_run: bool = False,
+                   memory_mb: float | None = MEMORY_MB) -> dict:
     """
     Updates data for stock codes from an API by processing them in parallel.
 
@@ -325,7 +850,7 @@ def update_by_code(engine: Engine,
     and processes updates using a `ProcessPoolExecutor` to optimize performance.
 
     :param engine: The database engine used to execute queries and perform updates.
-    :param token: The authentication token required to access the API.
+    :param token: The authentication token required to access the API, or a `TokenPool`.
     :param api_name: The name of the API from which the data is being fetched.
     :param params: Optional dictionary of additional parameters to be sent in the query.
     :param fields: Optional list of specific fields to retrieve from the API.
@@ -333,51 +858,130 @@ def update_by_code(engine: Engine,
     :param max_workers: The maximum number of parallel workers to process trade dates.
         Defaults to 10.
     :param retry: Number of retry attempts for failed API calls. Defaults to 3.
-    :return: This function returns nothing.
+    :param calls_per_minute: Rate limit of the API shared by all workers (of its VIP
+        endpoint for a by-period plan), None keeps the current setting.
+    :param write_mode: 'append' (default), 'ignore' or 'upsert', see `writer.py`.
+    :param resume: Skip the codes recorded in `sync_state` as done up to the same
+        end date by a previous (interrupted) run. Defaults to True.
+    :param mode: 'fixed' (default) requests one date range per code, 'auto' lets the
+        planner fetch by date, by code or by period, whichever takes fewer calls,
+        'period' fetches a financial statement table by reporting period on its
+        VIP endpoint (e.g. `income_vip`).
+    :param concurrency: An `AIMDController` adapting the in-flight requests (up to
+        its `max_concurrency`) instead of the fixed `max_workers`, optional.
+        Its `stats()` show the concurrency and rates observed.
+    :param dry_run: Only return the plan summary: the requests, API calls, rows and
+        projected duration (see `_dry_run`), without calling Tushare or writing.
+    :param memory_mb: Memory budget in MB of the downloaded frames not written yet,
+        fetching slows down when the database lags. None for no budget, only
+        the number of frames is bounded. Defaults to `MEMORY_MB`.
+    :return: The plan summary if `dry_run`, else the metrics of this update per
+        API (see `Metrics.stats`), without the earlier updates of the process.
+    :raises ValueError: If `calls_per_minute` is given with a `TokenPool`, whose
+        tokens have their own quotas.
     """
-    # get codes from database
-    codes = query_code_list(engine)
-
-    # Determine which date field to use for incremental update (once per table)
-    with engine.connect() as conn:
-        result = conn.execute(text(f"SELECT * FROM {api_name} LIMIT 1"))
-        row = result.fetchone()
-        if row is not None:
-            columns = result.keys()
+    _check_rate_limit(token, calls_per_minute)
+    if dry_run:
+        plan = _plan_update(engine, api_name, end_date, 'by_code', mode, resume)
+        workers = concurrency.max_concurrency if concurrency is not None else max_workers
+        return _dry_run(plan, token, calls_per_minute, workers)
+
+    SyncState.__table__.create(engine, checkfirst=True)
+
+    with get_metrics().run() as run:
+        plan = _plan_update(engine, api_name, end_date, 'by_code', mode, resume)
+        _apply_rate_limit(plan, calls_per_minute)
+        if not plan.tasks:
+            print(f'{api_name} already up to date')
         else:
-            columns = []
+            print(f'Start updating {api_name} to {end_date} ({len(plan.tasks)} {plan.strategy} requests)')
+            _run_plan(engine, token, plan, params, fields, retry, max_workers, write_mode, concurrency,
+                      memory_mb=memory_mb)
+            print(f'Finished updating {api_name} to {end_date}')
+    return run.stats()
+
+
+def _find_gaps(engine: Engine,
+               api_name: str,
+               start_date: datetime,
+               end_date: datetime,
+               min_ratio: float) -> list[pd.Timestamp]:
+    """
+    Returns the open days missing from a date-keyed table, or with fewer rows
+    than `min_ratio` times the stocks listed that day.
+    """
+    coverage = query_date_coverage(engine, api_name, start_date, end_date)
+    gaps = coverage[(coverage['row_count'] == 0)
+                    | (coverage['row_count'] < min_ratio * coverage['listed_count'])]
+    return list(gaps['cal_date'])
 
-        # Priority: f_ann_date > ann_date > trade_date
-        if 'f_ann_date' in columns:
-            date_field = 'f_ann_date'
-        elif 'ann_date' in columns:
-            date_field = 'ann_date'
-        elif 'trade_date' in columns:
-            date_field = 'trade_date'
-        else:
-            date_field = None
-
-    print(f'Start updating {api_name} to {end_date} (using {date_field})')
-
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        engine_urls = [engine.url for _ in codes]
-        tokens = [token for _ in codes]
-        api_names = [api_name for _ in codes]
-        params_list = [params for _ in codes]
-        fields_list = [fields for _ in codes]
-        retries = [retry for _ in codes]
-        date_fields = [date_field for _ in codes]
-
-        results = list(executor.map(_single_update_by_code,
-                                   engine_urls,
-                                   tokens,
-                                   api_names,
-                                   codes,
-                                   [end_date for _ in codes],
-                                   params_list,
-                                   fields_list,
-                                   retries,
-                                   date_fields
-        ))
-
-    print(f'Finished updating {api_name} to {end_date}')
+
+def repair_by_date(engine: Engine,
+                   token: str | TokenPool,
+                   api_name: str,
+                   params: dict | None = None,
+                   fields: list[str] | None = None,
+                   start_date: datetime | None = None,
+                   end_date: datetime | None = None,
+                   min_ratio: float = 0.8,
+                   max_workers: int = 10,
+                   retry: int = 3,
+                   write_mode: str = 'ignore',
+                   concurrency: AIMDController | None = None,
+                   memory_mb: float | None = MEMORY_MB) -> list[str]:
+    """
+    Finds and re-downloads the missing or incomplete trade dates of a
+    date-keyed table (e.g. `daily`, `adj_factor`, `daily_basic`).
+
+    One aggregated query (`query_date_coverage`) compares the rows of every
+    open day of `trade_cal` with the stocks listed that day in `stock_basic`.
+    Days without rows, or with fewer than `min_ratio` times the listed stocks,
+    are fetched again in parallel, the other days are not touched.
+
+    :param engine: The database engine used to execute queries and perform updates.
+    :param token: The authentication token required to access the API, or a `TokenPool`.
+    :param api_name: The name of the API (table) to repair.
+    :param params: Optional dictionary of additional parameters to be sent in the query.
+    :param fields: Optional list of specific fields to retrieve from the API.
+    :param start_date: The first date to check. Defaults to `START_DATE`.
+    :param end_date: The last date to check. Defaults to the latest trade_date
+        of the table, later dates are left to `update_by_date`.
+    :param min_ratio: A day with fewer rows than `min_ratio` times the listed
+        stocks is re-downloaded. Defaults to 0.8, suspended stocks have no rows.
+    :param max_workers: The maximum number of parallel workers. Defaults to 10.
+    :param retry: Number of retry attempts for failed API calls. Defaults to 3.
+    :param write_mode: 'ignore' (default) keeps the rows of an incomplete day
+        and adds the missing ones, 'upsert' overwrites them, see `writer.py`.
+        'append' is refused, it would insert the stored rows of the day again.
+    :param concurrency: An optional `AIMDController`, see `update_by_date`.
+    :param memory_mb: Memory budget in MB, see `update_by_date`.
+    :return: The repaired trade dates (YYYYMMDD).
+    :raises ValueError: If `write_mode` is 'append', or the table has no unique
+        key, the rows of an incomplete day would be inserted again (see
+        `check_unique_key`).
+    """
+    if write_mode == 'append':
+        raise ValueError(f"repair_by_date re-fetches whole days, write_mode 'append' would insert "
+                         f"the stored rows of {api_name} again, use 'ignore' or 'upsert'")
+    check_unique_key(engine, api_name)
+    if end_date is None:
+        end_date = query_latest_trade_date_by_table_name(engine, api_name)
+        if end_date is None:
+            print(f'{api_name} is empty, nothing to repair')
+            return []
+    start_date = pd.to_datetime(start_date if start_date is not None else START_DATE)
+    end_date = pd.to_datetime(end_date)
+
+    gaps = _find_gaps(engine, api_name, start_date, end_date, min_ratio)
+    if not gaps:
+        print(f'No gaps found in {api_name} from {start_date:%Y%m%d} to {end_date:%Y%m%d}')
+        return []
+
+    SyncState.__table__.create(engine, checkfirst=True)
+    plan = plan_by_date(api_name, gaps, len(query_code_list(engine)), get_row_limit(api_name))
+    print(f'Repairing {len(gaps)} trade dates of {api_name}')
+    # not recorded as pending, `update_by_date` would re-fetch them in 'append' mode
+    _run_plan(engine, token, plan, params, fields, retry, max_workers, write_mode, concurrency,
+              record_pending=False, memory_mb=memory_mb)
+    print(f'Finished repairing {api_name}')
+    return [gap.strftime('%Y%m%d') for gap in gaps]
@@ -0,0 +1,184 @@
+"""
+Batched log writer
+Author: Yanzhong(Eric) Huang
+
+`insert_log` opens a session and commits one row per call. During a
+throttling storm that is thousands of small transactions competing with the
+data inserts. The update functions write their run history through one
+`LogSink` instead:
+
+- `log_event` builds an entry: the table, a message, and the structured
+  fields of the `log` table (`level`, `event`, `sync_key`, `row_count`,
+  `duration`, `error_class`)
+- the worker processes do not touch the `log` table, they return their
+  entries with the result of every task, the parent puts them in its sink
+- a writer thread flushes the entries every `flush_interval` seconds, or
+  every `batch_size` entries, in one multi-row INSERT
+
+Successes are logged as well (`info`: the rows and duration of every request
+and of the whole update), retried errors as `warning`, failed requests as
+`error` with their traceback.
+
+    with LogSink(engine) as sink:
+        sink.log('daily', 'Error ...', level=ERROR, error_class='transient')
+"""
+
+import queue
+import threading
+from datetime import datetime
+from time import monotonic
+
+from sqlalchemy import insert, inspect
+from sqlalchemy.engine import Engine
+
+from .database import Log
+
+
+INFO = 'info'
+WARNING = 'warning'
+ERROR = 'error'
+
+BATCH_SIZE = 500  # entries per INSERT
+FLUSH_INTERVAL = 2.0  # seconds between two flushes
+MAX_QUEUE = 10_000  # entries waiting for the writer, newer entries are dropped
+
+_STOP = object()
+
+
+def log_event(table_name: str,
+              message: str = '',
+              level: str = INFO,
+              event: str = '',
+              sync_key: str | None = None,
+              row_count: int | None = None,
+              duration: float | None = None,
+              error_class: str | None = None) -> dict:
+    """
+    Builds an entry of the `log` table.
+
+    :param table_name: The table (API) of the entry.
+    :param message: The message, tracebacks included.
+    :param level: `INFO`, `WARNING` or `ERROR`.
+    :param event: What happened, e.g. 'fetch', 'write', 'update'.
+    :param sync_key: The trade date, ts_code or period of the request.
+    :param row_count: The rows fetched or written.
+    :param duration: Seconds.
+    :param error_class: The class of the error, see `retry.py`.
+    :return: The entry, picklable.
+    """
+    return {'update_table': table_name,
+            'message': message,
+            'level': level,
+            'event': event,
+            'sync_key': sync_key,
+            'row_count': row_count,
+            'duration': duration,
+            'error_class': error_class,
+            'created_at': datetime.now()}
+
+
+class LogSink:
+    """
+    A writer thread appending entries to the `log` table in batches. `log`
+    and `put` never block: if the database lags `max_queue` entries behind,
+    the new entries are dropped (and counted) rather than slowing the
+    download down.
+
+    :param engine: The database engine.
+    :param batch_size: Entries per INSERT.
+    :param flush_interval: Max seconds an entry waits before it is written.
+    :param max_queue: Max entries waiting for the writer.
+    """
+
+    def __init__(self,
+                 engine: Engine,
+                 batch_size: int = BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 max_queue: int = MAX_QUEUE) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+        self._columns: dict[str, int | None] | None = None
+
+    def __enter__(self) -> 'LogSink':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def log(self, table_name: str, message: str = '', **fields) -> None:
+        """
+        Queues an entry, see `log_event` for the fields.
+        """
+        self.put([log_event(table_name, message, **fields)])
+
+    def put(self, events: list[dict]) -> None:
+        """
+        Queues entries built by `log_event`, e.g. returned by a worker process.
+        """
+        for event in events:
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self) -> None:
+        """
+        Writes the remaining entries and waits for the writer thread to finish.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self.dropped:
+            print(f'{self.dropped} log entries dropped, the log table lagged behind')
+
+    def _run(self) -> None:
+        batch: list[dict] = []
+        deadline = monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size or monotonic() >= deadline:
+                if batch:
+                    self._write(batch)
+                    batch = []
+                deadline = monotonic() + self.flush_interval
+        if batch:
+            self._write(batch)
+
+    def _table_columns(self) -> dict[str, int | None]:
+        """
+        The columns of the `log` table and their max length, a table created
+        before the structured fields only gets the columns it has.
+        """
+        if self._columns is None:
+            Log.__table__.create(self.engine, checkfirst=True)
+            self._columns = {column['name']: getattr(column['type'], 'length', None)
+                             for column in inspect(self.engine).get_columns('log')}
+        return self._columns
+
+    def _write(self, batch: list[dict]) -> None:
+        try:
+            columns = self._table_columns()
+            rows = [{name: value[:columns[name]] if isinstance(value, str) and columns[name] else value
+                     for name, value in event.items() if name in columns}
+                    for event in batch]
+            with self.engine.begin() as conn:
+                conn.execute(insert(Log.__table__), rows)
+            self.written += len(rows)
+        except Exception as e:
+            # the log must never stop the download
+            print(f'Error writing {len(batch)} log entries: {e}')
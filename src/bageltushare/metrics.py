@@ -0,0 +1,293 @@
+"""
+Per-stage timing metrics
+Author: Yanzhong(Eric) Huang
+
+Every stage of a download records into the metrics registry of its process,
+per API:
+
+- `fetch_seconds` latency of one HTTP call to Tushare (`tushare_api.py`)
+- `rate_wait_seconds` time waiting for the rate limiter (`rate_limit.py`)
+- `retry_sleep_seconds` backoff before a retry (`retry.py`)
+- `convert_seconds` date conversion of a response (`download.py`)
+- `write_seconds` one batch written by the `BatchWriter` (`writer.py`)
+- `rows` / `bytes` rows and response bytes of one HTTP call
+- counters: `calls`, `retries`, `errors` (by class, see `retry.py`) and
+  `rows_written`
+
+The stages are histograms with fixed buckets, so the registries of the worker
+processes merge exactly: a worker returns the metrics of every task with its
+result (`drain`), the parent process merges them into its own registry.
+
+`get_metrics()` returns the registry of the process, which accumulates every
+update of the process. The update functions return the stats of their own run
+(recorded in a `Metrics.run()` registry as well):
+
+    stats = update_by_date(engine, token, 'daily')
+    print(stats['daily'])  # count, mean, p50, p95, max of every stage
+
+The same metrics are available in the Prometheus text format, written to a
+file (`write_prometheus`, or `BAGELTUSHARE_METRICS_FILE` after every update,
+for the textfile collector of node_exporter) or served on a local port
+(`serve_metrics`).
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Iterator
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+ROWS_BUCKETS = (0, 10, 100, 1000, 2000, 5000, 6000, 10000, 50000, 100000)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+METRICS_FILE = os.environ.get('BAGELTUSHARE_METRICS_FILE')
+PREFIX = 'bageltushare'
+
+
+def _buckets(name: str) -> tuple[float, ...]:
+    if name.endswith('seconds'):
+        return SECONDS_BUCKETS
+    return BYTES_BUCKETS if name == 'bytes' else ROWS_BUCKETS
+
+
+class Metrics:
+    """
+    Histograms and counters of one process, keyed by metric name and API.
+    Thread safe.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (name, api) -> [bucket counts (+Inf last), sum, count, max]
+        self._histograms: dict[tuple[str, str], list] = {}
+        # (name, api, kind) -> value
+        self._counters: dict[tuple[str, str, str], float] = {}
+        self._runs: list[Metrics] = []  # see `run`
+
+    def observe(self, api_name: str, name: str, value: float) -> None:
+        """
+        Records a value in the histogram `name` of the API.
+        """
+        buckets = _buckets(name)
+        with self._lock:
+            hist = self._histograms.get((name, api_name))
+            if hist is None:
+                hist = self._histograms[(name, api_name)] = [[0] * (len(buckets) + 1), 0.0, 0, 0.0]
+            hist[0][bisect_left(buckets, value)] += 1
+            hist[1] += value
+            hist[2] += 1
+            hist[3] = max(hist[3], value)
+            runs = list(self._runs)
+        for run in runs:
+            run.observe(api_name, name, value)
+
+    def inc(self, api_name: str, name: str, value: float = 1, kind: str = '') -> None:
+        """
+        Adds to the counter `name` of the API, `kind` is an optional label
+        (e.g. the class of an error).
+        """
+        with self._lock:
+            key = (name, api_name, kind)
+            self._counters[key] = self._counters.get(key, 0) + value
+            runs = list(self._runs)
+        for run in runs:
+            run.inc(api_name, name, value, kind)
+
+    @contextmanager
+    def timer(self, api_name: str, name: str) -> Iterator[None]:
+        """
+        Records the seconds spent in the block in the histogram `name`.
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(api_name, name, monotonic() - start)
+
+    def snapshot(self) -> dict:
+        """
+        Returns a picklable copy of the metrics, see `merge`.
+        """
+        with self._lock:
+            return {'histograms': {key: [list(h[0]), h[1], h[2], h[3]] for key, h in self._histograms.items()},
+                    'counters': dict(self._counters)}
+
+    def drain(self) -> dict:
+        """
+        Returns the snapshot of the metrics and resets them, for a worker
+        sending its metrics to the parent process.
+        """
+        with self._lock:
+            snapshot = {'histograms': self._histograms, 'counters': self._counters}
+            self._histograms, self._counters = {}, {}
+        return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Adds the snapshot of another registry (e.g. of a worker process).
+        """
+        with self._lock:
+            for key, (counts, total, count, peak) in snapshot['histograms'].items():
+                hist = self._histograms.get(key)
+                if hist is None:
+                    self._histograms[key] = [list(counts), total, count, peak]
+                    continue
+                hist[0] = [a + b for a, b in zip(hist[0], counts)]
+                hist[1] += total
+                hist[2] += count
+                hist[3] = max(hist[3], peak)
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            runs = list(self._runs)
+        for run in runs:
+            run.merge(snapshot)
+
+    @contextmanager
+    def run(self) -> Iterator['Metrics']:
+        """
+        Records the metrics of the block in a separate registry as well, e.g.
+        the metrics of one update, without the earlier updates of the process.
+
+        :return: The registry of the block.
+        """
+        run = Metrics()
+        with self._lock:
+            self._runs.append(run)
+        try:
+            yield run
+        finally:
+            with self._lock:
+                self._runs.remove(run)
+
+    def reset(self) -> None:
+        """
+        Clears the metrics.
+        """
+        self.drain()
+
+    def stats(self) -> dict:
+        """
+        Returns the metrics per API.
+
+        :return: {api_name: {histogram: {count, sum, mean, p50, p95, max},
+            counter: value}}, an error counter is named `errors.<class>`.
+            The percentiles are the upper bound of their bucket.
+        """
+        snapshot = self.snapshot()
+        stats: dict[str, dict] = {}
+        for (name, api_name), (counts, total, count, peak) in sorted(snapshot['histograms'].items()):
+            stats.setdefault(api_name, {})[name] = {
+                'count': count,
+                'sum': total,
+                'mean': total / count if count else 0.0,
+                'p50': _percentile(name, counts, count, peak, 0.5),
+                'p95': _percentile(name, counts, count, peak, 0.95),
+                'max': peak,
+            }
+        for (name, api_name, kind), value in sorted(snapshot['counters'].items()):
+            stats.setdefault(api_name, {})[f'{name}.{kind}' if kind else name] = value
+        return stats
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for (name, api_name), (counts, total, count, _) in sorted(snapshot['histograms'].items()):
+            metric = f'{PREFIX}_{name}'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, n in zip(_buckets(name) + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{metric}_bucket{{api="{api_name}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{api="{api_name}"}} {total:g}')
+            lines.append(f'{metric}_count{{api="{api_name}"}} {count}')
+        for (name, api_name, kind), value in sorted(snapshot['counters'].items()):
+            metric = f'{PREFIX}_{name}_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            labels = f'api="{api_name}",kind="{kind}"' if kind else f'api="{api_name}"'
+            lines.append(f'{metric}{{{labels}}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+
+def _percentile(name: str, counts: list[int], count: int, peak: float, q: float) -> float:
+    if not count:
+        return 0.0
+    cumulative = 0
+    for bound, n in zip(_buckets(name), counts):
+        cumulative += n
+        if cumulative >= q * count:
+            return min(bound, peak)
+    return peak
+
+
+# the registry of the current process
+_METRICS = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """
+    Returns the metrics registry of the current process, holding the metrics
+    of its worker processes as well.
+    """
+    return _METRICS
+
+
+def write_prometheus(path: str) -> None:
+    """
+    Writes the metrics to a file in the Prometheus text format. The file is
+    replaced atomically, a scraper never reads a partial file.
+
+    :param path: The file to write.
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(_METRICS.to_prometheus())
+    os.replace(tmp, path)
+
+
+def export() -> None:
+    """
+    Writes the metrics to `METRICS_FILE`, if set.
+    """
+    if METRICS_FILE:
+        write_prometheus(METRICS_FILE)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        body = _METRICS.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def serve_metrics(port: int = 9108, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serves the metrics of the process in the Prometheus text format, from a
+    daemon thread.
+
+    :param port: The port to listen on, 0 picks a free port.
+    :param host: The address to listen on, local only by default.
+    :return: The server, `server.shutdown()` stops it.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,220 @@
+"""
+Request planner
+Author: Yanzhong(Eric) Huang
+
+An update can fetch the same rows in two ways:
+
+- by date: one call per trade date returns every code of that date
+- by code: one call per code returns a date range of that code
+
+Which one takes fewer calls depends on how far behind the table is, and how
+many codes are behind. The planner counts the calls of both from the
+watermarks of the table, the trade calendar and the row limit of the API
+(`ROW_LIMITS` in `tushare_api.py`), and picks the cheaper one:
+
+- `plan_by_date` one task per trade date (a date returning more rows than the
+  row limit counts as several calls)
+- `plan_by_code` one task per code (a range longer than the row limit counts
+  as several calls, fetched page by page), codes already up to date are
+  skipped
+- `plan_by_period` for the financial statements: one task per reporting
+  period across all codes, on the VIP endpoint of the API (`VIP_APIS`), plus
+  one task per code for the codes with gaps before those periods
+- `choose_plan` the plan with the fewest calls
+- `Plan.summary` the calls, rows and projected duration of a plan, for a dry
+  run: the calls are paced by the rate limit of the API, and by the latency
+  of a call over the workers, whichever is slower
+
+A task is a (label, params, sync record) tuple, `params` only holds the
+varying parameters of the request (`trade_date`, or `ts_code` + `start_date`
++ `end_date`), and the sync record is written to `sync_state` (see
+`writer.py`).
+"""
+
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from math import ceil
+
+import pandas as pd
+
+
+STRATEGIES = ('by_date', 'by_code', 'by_period')
+
+# financial statement APIs and their VIP endpoint, which returns all codes of a `period`
+VIP_APIS = {
+    'income': 'income_vip',
+    'balancesheet': 'balancesheet_vip',
+    'cashflow': 'cashflow_vip',
+    'fina_indicator': 'fina_indicator_vip',
+}
+
+DEFAULT_LATENCY = 0.5  # seconds per call, typical Tushare response time
+
+
+@dataclass
+class Plan:
+    """
+    The requests of an update.
+
+    :param api_name: The name of the API (table).
+    :param strategy: 'by_date', 'by_code' or 'by_period'.
+    :param tasks: The (label, params, sync record) of every request.
+    :param calls: Estimated API calls.
+    :param rows: Estimated rows downloaded, None if unknown.
+    :param endpoint: The API called, if not `api_name` (e.g. `income_vip`).
+    """
+    api_name: str
+    strategy: str
+    tasks: list[tuple[str, dict, tuple[str, str, str]]] = field(default_factory=list)
+    calls: int = 0
+    rows: int | None = None
+    endpoint: str | None = None
+
+    def duration(self,
+                 calls_per_minute: float,
+                 max_workers: int = 1,
+                 latency: float = DEFAULT_LATENCY) -> float:
+        """
+        Projects the seconds the plan takes.
+
+        :param calls_per_minute: The rate limit of the API, 0 if unlimited.
+        :param max_workers: Requests in flight at the same time.
+        :param latency: Seconds per call.
+        :return: The projected duration in seconds.
+        """
+        by_latency = self.calls * latency / max(1, max_workers)
+        if calls_per_minute <= 0:
+            return by_latency
+        return max(by_latency, self.calls * 60 / calls_per_minute)
+
+    def summary(self,
+                calls_per_minute: float,
+                max_workers: int = 1,
+                latency: float = DEFAULT_LATENCY) -> dict:
+        """
+        Returns what the plan would do, see `duration` for the parameters.
+
+        :return: A dict with `api_name`, `endpoint`, `strategy`, `requests`,
+            `calls`, `rows` (None if unknown), `calls_per_minute`, `max_workers`
+            and `seconds` (projected duration).
+        """
+        return {'api_name': self.api_name,
+                'endpoint': self.endpoint or self.api_name,
+                'strategy': self.strategy,
+                'requests': len(self.tasks),
+                'calls': self.calls,
+                'rows': self.rows,
+                'calls_per_minute': calls_per_minute,
+                'max_workers': max_workers,
+                'seconds': self.duration(calls_per_minute, max_workers, latency)}
+
+
+def _date_str(d) -> str:
+    return pd.Timestamp(d).strftime('%Y%m%d')
+
+
+def plan_by_date(api_name: str,
+                 trade_dates: list,
+                 n_codes: int,
+                 row_limit: int) -> Plan:
+    """
+    Plans one request per trade date.
+
+    :param api_name: The name of the API (table).
+    :param trade_dates: The trade dates to update.
+    :param n_codes: Number of codes, the expected rows of one trade date.
+    :param row_limit: Max rows returned by one call.
+    :return: The plan.
+    """
+    tasks = []
+    for d in trade_dates:
+        date_str = _date_str(d)
+        tasks.append((date_str, {'trade_date': date_str}, (date_str, date_str, date_str)))
+    calls_per_date = max(1, ceil(n_codes / row_limit))
+    return Plan(api_name, 'by_date', tasks, len(tasks) * calls_per_date, n_codes * len(tasks))
+
+
+def plan_by_code(api_name: str,
+                 start_dates: dict[str, str],
+                 end_str: str,
+                 row_limit: int,
+                 trade_dates: list | None = None) -> Plan:
+    """
+    Plans the requests per code, from the start date of every code to `end_str`.
+
+    Every code gets one request. With `trade_dates` (the API is keyed by trade
+    date), codes without a trade date to update are skipped and a range longer
+    than `row_limit` trade dates counts as several calls: the request pages
+    through it (see `tushare_download`). The range is not split, so a code's
+    rows are committed in one transaction, a failed code has no rows past its
+    watermark and the next run starts it from the same date.
+
+    :param api_name: The name of the API (table).
+    :param start_dates: {ts_code: start date (YYYYMMDD)}.
+    :param end_str: The end date of the update (YYYYMMDD).
+    :param row_limit: Max rows returned by one call.
+    :param trade_dates: The trade dates up to `end_str`, optional.
+    :return: The plan.
+    """
+    if trade_dates is None:
+        tasks = [(f'{ts_code} from {start_date} to {end_str}',
+                  {'ts_code': ts_code, 'start_date': start_date, 'end_date': end_str},
+                  (ts_code, start_date, end_str))
+                 for ts_code, start_date in start_dates.items()]
+        return Plan(api_name, 'by_code', tasks, len(tasks))
+
+    dates = sorted(_date_str(d) for d in trade_dates)
+    last = bisect_right(dates, end_str)
+    tasks = []
+    calls = rows = 0
+    for ts_code, start_date in start_dates.items():
+        n_dates = last - bisect_left(dates, start_date)
+        if n_dates <= 0:
+            continue
+        tasks.append((f'{ts_code} from {start_date} to {end_str}',
+                      {'ts_code': ts_code, 'start_date': start_date, 'end_date': end_str},
+                      (ts_code, start_date, end_str)))
+        calls += ceil(n_dates / row_limit)
+        rows += n_dates
+    return Plan(api_name, 'by_code', tasks, calls, rows)
+
+
+def quarter_ends(start_date: str, end_date: str) -> list[str]:
+    """
+    Returns the reporting periods (quarter end dates, YYYYMMDD) between two
+    dates, the quarter of `end_date` only if it has ended.
+    """
+    quarters = pd.period_range(pd.Timestamp(start_date), pd.Timestamp(end_date), freq='Q')
+    return [q.end_time.strftime('%Y%m%d') for q in quarters if q.end_time.strftime('%Y%m%d') <= end_date]
+
+
+def plan_by_period(api_name: str,
+                   periods: list[str],
+                   n_codes: int,
+                   row_limit: int,
+                   end_str: str,
+                   gap_start_dates: dict[str, str] | None = None) -> Plan:
+    """
+    Plans one request per reporting period across all codes, on the VIP
+    endpoint of the API, and one request per code for `gap_start_dates`, the
+    codes whose data stops before the first period.
+
+    :param api_name: The name of the API (table), a key of `VIP_APIS`.
+    :param periods: The reporting periods (YYYYMMDD) to fetch.
+    :param n_codes: Number of codes, the expected rows of one period.
+    :param row_limit: Max rows returned by one call.
+    :param end_str: The end date of the update (YYYYMMDD).
+    :param gap_start_dates: {ts_code: start date} of the codes fetched one by one.
+    :return: The plan.
+    """
+    tasks = [(f'period {period}', {'period': period}, (period, period, end_str)) for period in periods]
+    gaps = plan_by_code(api_name, gap_start_dates or {}, end_str, row_limit)
+    calls = len(tasks) * max(1, ceil(n_codes / row_limit)) + gaps.calls
+    return Plan(api_name, 'by_period', tasks + gaps.tasks, calls, n_codes * len(tasks), VIP_APIS[api_name])
+
+
+def choose_plan(*plans: Plan) -> Plan:
+    """
+    Returns the plan with the fewest calls, the first one on a tie.
+    """
+    return min(plans, key=lambda plan: plan.calls)
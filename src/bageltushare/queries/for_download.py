@@ -13,8 +13,24 @@ In this module, we will have the queries for both of them.
 
 - query_latest_trade_date_by_table_name
 - query_latest_trade_date_by_ts_code
+
+`query_latest_date_by_ts_code` returns the latest date of every ts_code with
+one GROUP BY query, instead of one query per code.
+
+`query_sync_state` reads the keys recorded in `sync_state`, so an update
+resumes with its unfinished keys only.
+
+For "download" (replace style tables), `query_existing_keys` only reads the
+key columns needed to find the new rows.
+
+`query_date_coverage` counts the rows of every open day of a date-keyed
+table next to the number of stocks listed on that day, in one aggregated
+query, to find the missing or incomplete trade dates.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import inspect
 from sqlalchemy.engine import Engine
 from sqlalchemy.sql import text
 from sqlalchemy.exc import ProgrammingError
@@ -114,6 +130,30 @@ def query_latest_trade_date_by_ts_code(engine: Engine,
         return None
 
 
+def query_latest_date_by_ts_code(engine: Engine,
+                                 table_name: str,
+                                 date_field: str) -> dict[str, datetime]:
+    """
+    Queries the latest `date_field` of every ts_code in a table at once.
+
+    :param engine: SQLAlchemy Engine instance used to connect to the database.
+    :param table_name: The name of the table to query.
+    :param date_field: The date column, e.g. `trade_date`, `ann_date` or `f_ann_date`.
+    :return: A dict {ts_code: latest date}, codes without data are absent.
+    """
+    query = text(f"""
+    SELECT ts_code, MAX({date_field}) as latest_date
+    FROM {table_name}
+    GROUP BY ts_code
+    """)
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+    except ProgrammingError:
+        return {}
+    return {ts_code: latest_date for ts_code, latest_date in rows if latest_date}
+
+
 def query_trade_cal(engine: Engine,
                     start_date: datetime,
                     end_date: datetime) -> list[datetime]:
@@ -156,3 +196,116 @@ def query_code_list(engine: Engine) -> list[str]:
     with engine.connect() as conn:
         ts_codes = conn.execute(query).fetchall()
         return [_[0] for _ in ts_codes] if ts_codes else []
+
+
+def query_existing_keys(engine: Engine,
+                        table_name: str,
+                        key_columns: list[str],
+                        date_ranges: dict[str, tuple[datetime, datetime]] | None = None) -> pd.DataFrame:
+    """
+    Queries the distinct key columns of a table, instead of the whole table.
+
+    Date key columns listed in `date_ranges` are restricted to the (min, max)
+    range of the new data and returned as datetime64, so the result can be
+    merged with a downloaded DataFrame directly and its size scales with the
+    new data, not with the table.
+
+    :param engine: SQLAlchemy Engine instance used to connect to the database.
+    :param table_name: The name of the table to query.
+    :param key_columns: The columns identifying a row.
+    :param date_ranges: Optional {date column: (min date, max date)} filters.
+    :return: A DataFrame of the existing keys, empty if the table is not created yet.
+    """
+    date_ranges = date_ranges or {}
+    # half-open range, also correct for datetime columns
+    conditions = [f'({col} >= :{col}_min AND {col} < :{col}_end OR {col} IS NULL)' for col in date_ranges]
+    bind = {}
+    for col, (min_date, max_date) in date_ranges.items():
+        bind[f'{col}_min'] = min_date.strftime('%Y-%m-%d')
+        bind[f'{col}_end'] = (max_date + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    query = f'SELECT DISTINCT {", ".join(key_columns)} FROM {table_name}'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if not inspect(engine).has_table(table_name):
+        # table not created yet
+        return pd.DataFrame(columns=key_columns)
+    with engine.connect() as conn:
+        result = conn.execute(text(query), bind)
+        df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    for col in date_ranges:
+        df[col] = pd.to_datetime(df[col])
+    return df
+
+
+def query_date_coverage(engine: Engine,
+                        table_name: str,
+                        start_date: datetime,
+                        end_date: datetime) -> pd.DataFrame:
+    """
+    Counts the rows of a date-keyed table on every open day of `trade_cal`,
+    with the number of stocks listed that day according to `stock_basic`
+    (listed on or before the day, not delisted yet).
+
+    :param engine: SQLAlchemy Engine instance used to connect to the database.
+    :param table_name: The name of a table with a `trade_date` column.
+    :param start_date: The first date to check.
+    :param end_date: The last date to check.
+    :return: A DataFrame [cal_date, row_count, listed_count], one row per open day.
+    """
+    cal = 'SELECT DISTINCT cal_date FROM trade_cal WHERE is_open = 1 AND cal_date >= :start AND cal_date < :end'
+    query = text(f"""
+    SELECT cal.cal_date, COALESCE(counted.row_count, 0) AS row_count,
+           COALESCE(listed.listed_count, 0) AS listed_count
+    FROM ({cal}) cal
+    LEFT JOIN (
+        SELECT trade_date, COUNT(*) AS row_count FROM {table_name}
+        WHERE trade_date >= :start AND trade_date < :end
+        GROUP BY trade_date
+    ) counted ON counted.trade_date = cal.cal_date
+    LEFT JOIN (
+        SELECT c.cal_date, COUNT(*) AS listed_count
+        FROM ({cal}) c JOIN stock_basic s
+        ON s.list_date <= c.cal_date AND (s.delist_date IS NULL OR s.delist_date > c.cal_date)
+        GROUP BY c.cal_date
+    ) listed ON listed.cal_date = cal.cal_date
+    ORDER BY cal.cal_date
+    """)
+    # half-open range, also correct for datetime columns
+    bind = {'start': start_date.strftime('%Y-%m-%d'),
+            'end': (end_date + timedelta(days=1)).strftime('%Y-%m-%d')}
+    with engine.connect() as conn:
+        result = conn.execute(query, bind)
+        df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    df['cal_date'] = pd.to_datetime(df['cal_date'])
+    return df
+
+
+def query_sync_state(engine: Engine,
+                     api_name: str,
+                     status: str,
+                     window_end: str | None = None) -> list[tuple[str, str, str]]:
+    """
+    Queries the keys of an API recorded with a status in the `sync_state` table.
+
+    :param engine: SQLAlchemy Engine instance used to connect to the database.
+    :param api_name: The name of the API.
+    :param status: `pending`, `done` or `failed`.
+    :param window_end: Only the keys whose window ends on this date (YYYYMMDD), optional.
+    :return: A list of (sync_key, window_start, window_end), empty if the table
+        is not created yet.
+    """
+    if not inspect(engine).has_table('sync_state'):
+        return []
+    query = """
+    SELECT sync_key, window_start, window_end FROM sync_state
+    WHERE api_name = :api_name AND status = :status
+    """
+    bind = {'api_name': api_name, 'status': status}
+    if window_end is not None:
+        query += ' AND window_end = :window_end'
+        bind['window_end'] = window_end
+    with engine.connect() as conn:
+        rows = conn.execute(text(query), bind).fetchall()
+        return [(key, start, end) for key, start, end in rows]
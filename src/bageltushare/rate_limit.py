@@ -0,0 +1,193 @@
+"""
+Cross-process rate limiter for the Tushare quota.
+Author: Yanzhong(Eric) Huang
+
+Tushare limits the number of calls per minute for every API. Each `api_name`
+gets a token bucket stored in a small state file under `RATE_LIMIT_DIR`, all
+processes (e.g. the `ProcessPoolExecutor` workers in `download.py`) lock the
+same file before taking a token, so together they stay right under the quota.
+
+- `set_rate_limit` configures the calls per minute of an API
+- `acquire` blocks until the caller is allowed to make one call
+- `wait_time` peeks at how long a call would wait, without taking a token
+- `get_rate_limit` reads the calls per minute of an API, e.g. to estimate the
+  duration of an update (see `planner.py`)
+
+Quotas are per account: with several tokens (see `token_pool.py`) the bucket
+is keyed by (token, api), the token itself is never written to disk, only a
+short hash of it.
+
+The bucket holds at most one second of calls, so requests leave as a steady
+stream instead of bursting at the start of every minute.
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+from time import sleep, time
+
+try:
+    import fcntl
+
+    def _lock(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(f) -> None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+except ImportError:  # Windows
+    import msvcrt
+
+    def _lock(f) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+    def _unlock(f) -> None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+RATE_LIMIT_DIR = os.environ.get('BAGELTUSHARE_RATE_LIMIT_DIR',
+                                os.path.join(tempfile.gettempdir(), 'bageltushare_rate_limit'))
+DEFAULT_CALLS_PER_MINUTE = 200  # Tushare default quota for most APIs
+
+# state file layout: calls_per_minute, tokens, last refill timestamp
+_STATE = struct.Struct('ddd')
+
+
+def token_id(token: str) -> str:
+    """
+    A short, stable id of a token, safe to use in file names and logs.
+    """
+    return hashlib.sha1(token.encode()).hexdigest()[:12]
+
+
+def _state_path(api_name: str, token: str | None = None) -> str:
+    os.makedirs(RATE_LIMIT_DIR, exist_ok=True)
+    key = api_name if token is None else f'{api_name}.{token_id(token)}'
+    return os.path.join(RATE_LIMIT_DIR, f'{key}.bucket')
+
+
+def _open_state(api_name: str, token: str | None = None):
+    path = _state_path(api_name, token)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    return os.fdopen(fd, 'r+b')
+
+
+def _read(f) -> tuple[float, float, float] | None:
+    f.seek(0)
+    raw = f.read(_STATE.size)
+    if len(raw) < _STATE.size:
+        return None
+    return _STATE.unpack(raw)
+
+
+def _write(f, calls_per_minute: float, tokens: float, last: float) -> None:
+    f.seek(0)
+    f.write(_STATE.pack(calls_per_minute, tokens, last))
+    f.flush()
+
+
+def _capacity(calls_per_minute: float) -> float:
+    return max(1.0, calls_per_minute / 60)
+
+
+def set_rate_limit(api_name: str, calls_per_minute: float, token: str | None = None) -> None:
+    """
+    Sets the calls per minute allowed for an API, shared by all processes.
+
+    The limit is stored in the bucket state file, so workers started afterward
+    (or already running) use it without any argument passing.
+
+    :param api_name: The name of the Tushare API.
+    :param calls_per_minute: Allowed calls per minute, 0 disables the limit.
+    :param token: The token the quota belongs to, None for the single token setup.
+    """
+    with _open_state(api_name, token) as f:
+        _lock(f)
+        try:
+            state = _read(f)
+            tokens = _capacity(calls_per_minute) if state is None else min(state[1], _capacity(calls_per_minute))
+            _write(f, calls_per_minute, tokens, time())
+        finally:
+            _unlock(f)
+
+
+def get_rate_limit(api_name: str, token: str | None = None) -> float:
+    """
+    Returns the calls per minute allowed for an API.
+
+    :param api_name: The name of the Tushare API.
+    :param token: The token the quota belongs to, None for the single token setup.
+    :return: Calls per minute, `DEFAULT_CALLS_PER_MINUTE` if never set, 0 if unlimited.
+    """
+    with _open_state(api_name, token) as f:
+        _lock(f)
+        try:
+            state = _read(f)
+        finally:
+            _unlock(f)
+    return DEFAULT_CALLS_PER_MINUTE if state is None else state[0]
+
+
+def _refill(f, now: float) -> tuple[float, float]:
+    """
+    Returns (calls_per_minute, tokens) of the bucket at `now`.
+    """
+    state = _read(f)
+    if state is None:
+        return DEFAULT_CALLS_PER_MINUTE, _capacity(DEFAULT_CALLS_PER_MINUTE)
+    calls_per_minute, tokens, last = state
+    if calls_per_minute <= 0:
+        return calls_per_minute, tokens
+    return calls_per_minute, min(_capacity(calls_per_minute), tokens + (now - last) * calls_per_minute / 60)
+
+
+def wait_time(api_name: str, token: str | None = None) -> float:
+    """
+    Returns the seconds a call of the API would wait now, without taking a token.
+
+    :param api_name: The name of the Tushare API.
+    :param token: The token of the bucket, None for the single token setup.
+    :return: Seconds, 0 if a token is available.
+    """
+    with _open_state(api_name, token) as f:
+        _lock(f)
+        try:
+            calls_per_minute, tokens = _refill(f, time())
+        finally:
+            _unlock(f)
+    if calls_per_minute <= 0 or tokens >= 1:
+        return 0.0
+    return (1 - tokens) / (calls_per_minute / 60)
+
+
+def acquire(api_name: str, token: str | None = None) -> float:
+    """
+    Takes one token from the bucket of the API, sleeping until it is available.
+
+    A token is reserved while holding the file lock and the wait happens after
+    releasing it, so waiting workers do not block each other.
+
+    :param api_name: The name of the Tushare API.
+    :param token: The token of the bucket, None for the single token setup.
+    :return: Seconds spent waiting.
+    """
+    with _open_state(api_name, token) as f:
+        _lock(f)
+        try:
+            now = time()
+            calls_per_minute, tokens = _refill(f, now)
+            if calls_per_minute <= 0:
+                return 0.0
+
+            rate = calls_per_minute / 60  # tokens per second
+            tokens -= 1
+            _write(f, calls_per_minute, tokens, now)
+        finally:
+            _unlock(f)
+
+    wait = -tokens / rate if tokens < 0 else 0.0
+    if wait > 0:
+        sleep(wait)
+    return wait
@@ -0,0 +1,146 @@
+"""
+Retry policy of the Tushare requests
+Author: Yanzhong(Eric) Huang
+
+All download loops (`download`, `_single_task` in `download.py` and `_fetch` in
+`async_download.py`) share one `RetryPolicy` instead of a fixed `sleep(60)`.
+
+Errors are classified by `classify_error`:
+
+- `quota`: the per-minute quota of the API is used up (or HTTP 429), retried
+  after a longer delay (`quota_delay`), the rate limiter has usually caught up
+  by then
+- `transient`: network errors, timeouts, server errors (HTTP 5xx), retried with
+  exponential backoff from `base_delay`
+- `permanent`: wrong API name, invalid token, no permission, daily quota used
+  up, bad parameters. Retrying cannot help, the task fails immediately
+
+Delays double on every attempt up to `max_delay`, with full jitter so failed
+workers do not retry in lockstep, and a task gives up after `max_attempts`
+attempts or once `max_elapsed` seconds have passed.
+
+The errors (by class), retries and backoff sleeps are recorded in the metrics
+of the process (see `metrics.py`).
+"""
+
+import random
+from dataclasses import dataclass
+from time import sleep, monotonic
+from typing import Callable
+
+import requests
+
+from .metrics import get_metrics
+from .tushare_api import TushareError
+
+
+QUOTA = 'quota'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# substrings of the Tushare error messages
+_QUOTA_MESSAGES = ('每分钟最多访问',)
+_PERMANENT_MESSAGES = ('每天最多访问', '每小时最多访问', '接口名', 'token', '权限', '积分', '参数')
+
+
+def classify_error(e: Exception) -> str:
+    """
+    Classifies a download error as `QUOTA`, `TRANSIENT` or `PERMANENT`.
+
+    :param e: The exception raised by the request.
+    :return: The error class.
+    """
+    if isinstance(e, TushareError):
+        if any(m in e.msg for m in _QUOTA_MESSAGES):
+            return QUOTA
+        if any(m in e.msg for m in _PERMANENT_MESSAGES):
+            return PERMANENT
+        return TRANSIENT
+    if isinstance(e, requests.HTTPError):
+        status = e.response.status_code if e.response is not None else 500
+        if status == 429:
+            return QUOTA
+        return TRANSIENT if status >= 500 else PERMANENT
+    if isinstance(e, (requests.RequestException, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    if isinstance(e, (TypeError, KeyError, AttributeError, RuntimeError)):
+        # RuntimeError: every token of the TokenPool was rejected
+        return PERMANENT
+    return TRANSIENT
+
+
+@dataclass
+class RetryPolicy:
+    """
+    When (and whether) to retry a failed request.
+
+    :param max_attempts: Attempts in total, including the first one.
+    :param base_delay: First delay after a transient error, in seconds.
+    :param quota_delay: First delay after a quota error, in seconds.
+    :param max_delay: Upper bound of a single delay, in seconds.
+    :param max_elapsed: Give up once this many seconds passed since the first attempt.
+    """
+    max_attempts: int = 3
+    base_delay: float = 2.0
+    quota_delay: float = 20.0
+    max_delay: float = 120.0
+    max_elapsed: float = 600.0
+
+    def delay(self, attempt: int, error: Exception, elapsed: float) -> float | None:
+        """
+        Returns the seconds to wait before the next attempt, None to give up.
+
+        :param attempt: The number of the failed attempt, starting at 1.
+        :param error: The exception of the failed attempt.
+        :param elapsed: Seconds since the first attempt.
+        :return: The delay, or None.
+        """
+        kind = classify_error(error)
+        if kind == PERMANENT or attempt >= self.max_attempts:
+            return None
+        base = self.quota_delay if kind == QUOTA else self.base_delay
+        ceiling = min(self.max_delay, base * 2 ** (attempt - 1))
+        # full jitter, at least half of the ceiling for a quota error
+        low = ceiling / 2 if kind == QUOTA else 0.0
+        delay = random.uniform(low, ceiling)
+        if elapsed + delay > self.max_elapsed:
+            return None
+        return delay
+
+
+def call_with_retry(fn: Callable,
+                    policy: RetryPolicy,
+                    label: str = '',
+                    on_error: Callable[[Exception], None] | None = None,
+                    api_name: str | None = None):
+    """
+    Calls `fn()` until it succeeds or the policy gives up, then re-raises the
+    last error.
+
+    :param fn: The call, without arguments.
+    :param policy: The retry policy.
+    :param label: Printed with the errors.
+    :param on_error: Called with every error, optional.
+    :param api_name: The API of the call, the errors and retries are recorded
+        under it in the metrics (under `label` if None).
+    :return: The result of `fn()`.
+    """
+    metrics = get_metrics()
+    key = api_name or label
+    start = monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return fn()
+        except Exception as e:
+            if on_error is not None:
+                on_error(e)
+            metrics.inc(key, 'errors', kind=classify_error(e))
+            delay = policy.delay(attempt, e, monotonic() - start)
+            if delay is None:
+                raise
+            metrics.inc(key, 'retries')
+            metrics.observe(key, 'retry_sleep_seconds', delay)
+            print(f'Error downloading {label} ({classify_error(e)}): {e}, retrying in {delay:.0f}s...')
+            sleep(delay)
@@ -0,0 +1,128 @@
+"""
+Multi-token request pool
+Author: Yanzhong(Eric) Huang
+
+Tushare quotas are per account. A `TokenPool` holds several tokens, each with
+its own calls per minute, and can be passed wherever a `token` is accepted
+(`download`, `update_by_date`, `update_by_code`, `tushare_download`, ...):
+
+    pool = TokenPool({'TOKEN_A': 500, 'TOKEN_B': 200})
+    update_by_date(engine, pool, 'daily', max_workers=20)
+
+- every call goes to the least loaded token: the one whose rate limiter
+  bucket of the API (keyed by (token, api), see `rate_limit.py`) frees up
+  first, so the throughput grows with the number of tokens
+- a token rejected by Tushare (invalid or expired token) is removed from the
+  pool of every process, the call is retried with another token
+
+The pool is pickled to the worker processes, its state (the buckets and the
+removed tokens) lives in `RATE_LIMIT_DIR`, shared by all processes.
+"""
+
+import os
+import random
+import threading
+import uuid
+
+from . import rate_limit
+from .rate_limit import acquire, set_rate_limit, wait_time, token_id
+
+
+# substrings of the Tushare messages rejecting a token
+AUTH_ERRORS = ('token不对', 'token无效', 'token已过期')
+
+
+class TokenPool:
+    """
+    Several Tushare tokens, each with its own quota.
+
+    :param tokens: {token: calls per minute}, or a list of tokens using
+        `default_calls_per_minute`.
+    :param default_calls_per_minute: The quota of the tokens given as a list.
+    """
+
+    def __init__(self,
+                 tokens: dict[str, float] | list[str],
+                 default_calls_per_minute: float = rate_limit.DEFAULT_CALLS_PER_MINUTE) -> None:
+        if not isinstance(tokens, dict):
+            tokens = {token: default_calls_per_minute for token in tokens}
+        if not tokens:
+            raise ValueError('TokenPool needs at least one token')
+        self.quotas = dict(tokens)
+        # the workers unpickle the same pool_id, a new pool starts with all tokens
+        self.pool_id = uuid.uuid4().hex[:12]
+        self._configured: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {'quotas': self.quotas, 'pool_id': self.pool_id}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['quotas'])
+        self.pool_id = state['pool_id']
+
+    @property
+    def tokens(self) -> list[str]:
+        """
+        The tokens not removed yet.
+        """
+        return [token for token in self.quotas if not os.path.exists(self._removed_path(token))]
+
+    @property
+    def calls_per_minute(self) -> float:
+        """
+        The calls per minute of the pool, the sum of the quotas of its tokens.
+        """
+        return sum(self.quotas[token] for token in self.tokens)
+
+    def _removed_path(self, token: str) -> str:
+        os.makedirs(rate_limit.RATE_LIMIT_DIR, exist_ok=True)
+        return os.path.join(rate_limit.RATE_LIMIT_DIR, f'{self.pool_id}.{token_id(token)}.removed')
+
+    def _configure(self, api_name: str, token: str) -> None:
+        # the quota of (token, api) is written once per process
+        with self._lock:
+            if (api_name, token) in self._configured:
+                return
+            self._configured.add((api_name, token))
+        set_rate_limit(api_name, self.quotas[token], token)
+
+    def acquire(self, api_name: str) -> str:
+        """
+        Picks the least loaded token for a call of the API and takes one call
+        from its quota, sleeping if all tokens are busy.
+
+        :param api_name: The name of the Tushare API.
+        :return: The token to use.
+        :raises RuntimeError: If every token has been removed.
+        """
+        tokens = self.tokens
+        if not tokens:
+            raise RuntimeError('All tokens of the TokenPool were rejected by Tushare')
+        for token in tokens:
+            self._configure(api_name, token)
+        random.shuffle(tokens)  # spread the ties
+        token = min(tokens, key=lambda t: wait_time(api_name, t))
+        acquire(api_name, token)
+        return token
+
+    def remove(self, token: str) -> None:
+        """
+        Removes a token from the pool, in every process.
+        """
+        print(f'Removing token {token_id(token)} from the pool')
+        open(self._removed_path(token), 'a').close()
+
+
+def is_auth_error(e: Exception) -> bool:
+    """
+    Whether Tushare rejected the token of the call.
+    """
+    return any(m in str(e) for m in AUTH_ERRORS)
+
+
+def tokens_of(token: 'str | TokenPool') -> list[str]:
+    """
+    The tokens of a token or a pool.
+    """
+    return token.tokens if isinstance(token, TokenPool) else [token]
@@ -0,0 +1,205 @@
+"""
+Pluggable transport of the Tushare client: record and replay
+Author: Yanzhong(Eric) Huang
+
+`TushareClient` (see `tushare_api.py`) sends every query through the transport
+of the process, if one is set:
+
+- `record_to(path)` records every request and response of a real run, with
+  its latency, into an archive directory (one gzip file per process, one
+  member per call, readable even if the run is killed)
+- `replay_from(path, speed)` serves the recorded responses back without
+  network access, with the recorded latency (divided by `speed`), or as fast
+  as possible with `speed=0`
+- `set_transport` plugs in any object with a `send(api_name, payload, post)`
+  method, `post(api_name, payload)` being the HTTP call of the client
+
+The archive is keyed by (api_name, params, fields), the token is never
+recorded. A request recorded several times (retries, pages) is answered in the
+recorded order, the last answer repeats. A replayed run takes no token from the
+rate limiter (it uses no quota), only the server latency is reproduced.
+
+The transport reaches the worker processes through the environment
+(`BAGELTUSHARE_RECORD`, `BAGELTUSHARE_REPLAY`, `BAGELTUSHARE_REPLAY_SPEED`).
+
+    record_to('runs/income')
+    update_by_code(engine, token, 'income')
+
+    replay_from('runs/income', speed=0)  # offline, e.g. under a profiler
+    update_by_code(test_engine, 'any', 'income')
+"""
+
+import glob
+import gzip
+import json
+import os
+import threading
+from collections import defaultdict, deque
+from time import monotonic, sleep, time
+from typing import Callable
+
+import requests
+
+
+Post = Callable[[str, dict], bytes]
+
+
+def _key(api_name: str, payload: dict) -> str:
+    params = {k: v for k, v in (payload.get('params') or {}).items() if k != 'ts_type_name'}
+    return json.dumps([api_name, params, payload.get('fields') or ''], sort_keys=True, default=str)
+
+
+class RecordingTransport:
+    """
+    Sends the queries over HTTP and appends every call to `path`.
+
+    :param path: The archive directory.
+    """
+    uses_quota = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def send(self, api_name: str, payload: dict, post: Post) -> bytes:
+        start = monotonic()
+        call = {'api_name': api_name, 'key': _key(api_name, payload), 'time': time(), 'body': None, 'error': None}
+        try:
+            body = post(api_name, payload)
+        except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            self._write({**call, 'latency': monotonic() - start, 'error': f'{type(e).__name__}: {e}',
+                         'status': status})
+            raise
+        self._write({**call, 'latency': monotonic() - start, 'body': body.decode()})
+        return body
+
+    def _write(self, call: dict) -> None:
+        # one gzip member per call: the file stays readable if the process dies
+        data = gzip.compress(json.dumps(call, ensure_ascii=False).encode() + b'\n')
+        with self._lock, open(os.path.join(self.path, f'calls-{os.getpid()}.jsonl.gz'), 'ab') as f:
+            f.write(data)
+
+
+class ReplayError(KeyError):
+    """
+    A request missing from the archive, not retried (see `retry.py`).
+    """
+
+
+class ReplayTransport:
+    """
+    Serves the calls recorded in `path`, without network access.
+
+    :param path: The archive directory of `RecordingTransport`.
+    :param speed: Latency divisor, 1 for the recorded latency, 0 for none.
+    """
+    uses_quota = False
+
+    def __init__(self, path: str, speed: float = 1.0) -> None:
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        calls = []
+        for file in glob.glob(os.path.join(path, 'calls-*.jsonl.gz')):
+            with gzip.open(file, 'rt', encoding='utf-8') as f:
+                try:
+                    for line in f:
+                        calls.append(json.loads(line))
+                except (EOFError, json.JSONDecodeError):
+                    pass  # the last call of a killed process
+        self._calls: dict[str, deque] = defaultdict(deque)
+        for call in sorted(calls, key=lambda c: c['time']):
+            self._calls[call['key']].append(call)
+
+    def __len__(self) -> int:
+        return sum(len(calls) for calls in self._calls.values())
+
+    def send(self, api_name: str, payload: dict, post: Post) -> bytes:
+        key = _key(api_name, payload)
+        with self._lock:
+            calls = self._calls.get(key)
+            if not calls:
+                raise ReplayError(f'{key} is not in the archive {self.path}')
+            call = calls.popleft() if len(calls) > 1 else calls[0]
+        if self.speed > 0:
+            sleep(call['latency'] / self.speed)
+        if call.get('status') is not None:
+            response = requests.Response()
+            response.status_code = call['status']
+            raise requests.HTTPError(call['error'], response=response)
+        if call['error'] is not None:
+            raise requests.ConnectionError(call['error'])
+        return call['body'].encode()
+
+
+def _from_environ() -> RecordingTransport | ReplayTransport | None:
+    if os.environ.get('BAGELTUSHARE_REPLAY'):
+        return ReplayTransport(os.environ['BAGELTUSHARE_REPLAY'],
+                               float(os.environ.get('BAGELTUSHARE_REPLAY_SPEED', 1)))
+    if os.environ.get('BAGELTUSHARE_RECORD'):
+        return RecordingTransport(os.environ['BAGELTUSHARE_RECORD'])
+    return None
+
+
+_transport = _from_environ()
+
+
+def set_transport(transport) -> None:
+    """
+    Sends the queries of this process through `transport`, None for plain HTTP.
+
+    :param transport: An object with `send(api_name, payload, post)`, returning
+        the body of the response (raising `requests.HTTPError` for an HTTP
+        error status), and a
+        `uses_quota` flag (False skips the rate limiter).
+    """
+    global _transport
+    _transport = transport
+
+
+def get_transport():
+    """
+    The transport of this process, None for plain HTTP.
+    """
+    return _transport
+
+
+def record_to(path: str) -> RecordingTransport:
+    """
+    Records the calls of this process and of the worker processes it starts
+    afterwards in the archive directory `path`.
+
+    :param path: The archive directory, created if needed.
+    :return: The transport.
+    """
+    os.environ.pop('BAGELTUSHARE_REPLAY', None)
+    os.environ['BAGELTUSHARE_RECORD'] = path
+    set_transport(RecordingTransport(path))
+    return _transport
+
+
+def replay_from(path: str, speed: float = 1.0) -> ReplayTransport:
+    """
+    Answers the calls of this process and of the worker processes it starts
+    afterwards from the archive directory `path`, no network access.
+
+    :param path: The archive directory written by `record_to`.
+    :param speed: Latency divisor, 1 for the recorded latency, 0 for none.
+    :return: The transport.
+    """
+    os.environ.pop('BAGELTUSHARE_RECORD', None)
+    os.environ['BAGELTUSHARE_REPLAY'] = path
+    os.environ['BAGELTUSHARE_REPLAY_SPEED'] = str(speed)
+    set_transport(ReplayTransport(path, speed))
+    return _transport
+
+
+def reset_transport() -> None:
+    """
+    Back to plain HTTP, for this process and the worker processes it starts.
+    """
+    for name in ('BAGELTUSHARE_RECORD', 'BAGELTUSHARE_REPLAY', 'BAGELTUSHARE_REPLAY_SPEED'):
+        os.environ.pop(name, None)
+    set_transport(None)
@@ -8,29 +8,396 @@ This module provides a wrapper around the Tushare API, the function well receive
 - `params`: A dictionary of parameters to pass to the API endpoint
 - `fields`: A comma-separated string of fields to retrieve from the API
 
+Instead of building a new `tushare.pro_api(token)` (and a new HTTP connection)
+for every request, one `TushareClient` is cached per token per process. Each
+client keeps its HTTP connections alive in a bounded connection pool.
+
+Every call takes a token from the cross-process rate limiter of its API
+(see `rate_limit.py`) before hitting the network. `token` can also be a
+`TokenPool` of several tokens (see `token_pool.py`), every call then uses the
+least loaded token of the pool.
+
+`ROW_LIMITS` is the maximum number of rows one call of an API returns, the
+request planner (see `planner.py`) sizes its requests with it.
+
+A response capped at the row limit is not the whole result: `tushare_download`
+pages through the rest with `offset` / `limit`. Tushare does not return the
+total row count, so the following pages are fetched in concurrent waves (1, 2,
+4, ... up to `PAGE_CONCURRENCY` pages) until a page comes back short.
+
+Responses are decoded column by column (`decode_columns`): the row-wise
+`items` are transposed once and every column becomes one typed NumPy array,
+its type taken from the table in `database.py` (see `convert.py`), instead of a
+2-D object array that pandas has to infer column by column. With `orjson`
+installed (`pip install bagel-tushare[fast]`) the payload is parsed by orjson,
+about 3 times faster than the standard `json` module on large responses.
+
+With the response cache enabled (see `cache.py`), a request already answered
+is served from the disk before taking a token from the rate limiter, so it
+costs no quota.
+
+The HTTP call of the client can be wrapped by a transport (see
+`transport.py`), e.g. to record a run and replay it offline.
+
+Every call records its latency, rows and response bytes, and the time spent
+waiting for the rate limiter, in the metrics of the process (see `metrics.py`).
 """
 
-from pandas import DataFrame
-from tushare import pro_api
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import numpy as np
+import requests
+from pandas import DataFrame, Series, concat, to_numeric
+from requests.adapters import HTTPAdapter
+
+from .cache import cache_ttl, get_cache
+from .convert import FLOAT32, table_types, _to_date
+from .metrics import get_metrics
+from .rate_limit import acquire
+from .token_pool import TokenPool, is_auth_error, tokens_of
+from .transport import get_transport
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+
+# same endpoint as tushare.pro.client.DataApi, `BAGELTUSHARE_HTTP_URL` points the
+# clients to another server (e.g. the local stand-in of `benchmarks/`)
+HTTP_URL = os.environ.get('BAGELTUSHARE_HTTP_URL', 'http://api.waditu.com/dataapi')
+TIMEOUT = 30  # seconds
+POOL_MAXSIZE = 10  # max keep-alive connections per client
+
+# max rows returned by one call, from the Tushare API docs
+ROW_LIMITS = {
+    'daily': 6000,
+    'adj_factor': 6000,
+    'daily_basic': 6000,
+    'fina_indicator': 100,
+}
+DEFAULT_ROW_LIMIT = 5000
+PAGE_CONCURRENCY = 8  # max pages in flight while paging a capped response
+
+
+def get_row_limit(api_name: str) -> int:
+    """
+    Returns the maximum number of rows one call of the API returns.
+
+    :param api_name: The name of the Tushare API.
+    :return: The row limit, `DEFAULT_ROW_LIMIT` for an unlisted API.
+    """
+    return ROW_LIMITS.get(api_name, DEFAULT_ROW_LIMIT)
+
 
+def _column(values: tuple, kind: str | None, float_dtype: np.dtype):
+    """
+    One column of a response as a typed array, `kind` from `table_types` (for
+    an API without a table, its `DATE_COLUMNS` are dates as in `convert_frame`).
+    """
+    if kind == 'float':
+        try:
+            return np.array(values, dtype=float_dtype)  # None -> NaN
+        except (TypeError, ValueError):
+            return to_numeric(Series(values, dtype=object), errors='coerce').to_numpy(dtype=float_dtype)
+    if kind == 'int':
+        try:
+            return np.array(values, dtype=np.int64)
+        except (TypeError, ValueError):
+            # missing values
+            return to_numeric(Series(values, dtype=object), errors='coerce').to_numpy()
+    if kind == 'date':
+        return _to_date(Series(values, dtype=object)).to_numpy()
+    if kind == 'str':
+        return np.array(values, dtype=object)
+    # not in the schema, inferred like the DataFrame constructor does
+    return Series(values)
+
+
+def decode_columns(fields: list[str],
+                   items: list[list],
+                   api_name: str,
+                   float32: bool | None = None) -> DataFrame:
+    """
+    Builds the DataFrame of a response from its `fields` and row-wise `items`
+    column by column: dates as datetime64 (parsed as YYYYMMDD), `Float`
+    columns as float64 (or float32), strings as object arrays. The types come
+    from the table of the API in `database.py`. The columns of an unknown API
+    are inferred, except its date fields (`DATE_COLUMNS` in `convert.py`).
+
+    :param fields: The column names of the response.
+    :param items: The rows of the response.
+    :param api_name: The name of the API (its table, or its VIP endpoint).
+    :param float32: Decode the `Float` columns as float32, `FLOAT32` by default
+        (see `convert.py`).
+    :return: The DataFrame.
+    """
+    if not items:
+        return DataFrame(columns=fields)
+    types = table_types(api_name)
+    float_dtype = np.dtype('float32' if (FLOAT32 if float32 is None else float32) else 'float64')
+    columns = {field: _column(values, types.get(field), float_dtype)
+               for field, values in zip(fields, zip(*items))}
+    return DataFrame(columns, copy=False)
+
+
+def parse_response(raw: bytes, api_name: str) -> DataFrame:
+    """
+    Decodes the raw response of a query.
 
-def tushare_download(token: str,
+    :param raw: The body of the response.
+    :param api_name: The name of the API.
+    :return: The DataFrame.
+    :raises TushareError: If Tushare responded with a non-zero code.
+    """
+    result = _loads(raw)
+    if result['code'] != 0:
+        raise TushareError(result['code'], result['msg'])
+    data = result['data']
+    df = decode_columns(data['fields'], data['items'], api_name)
+    df.attrs['has_more'] = data.get('has_more')
+    get_metrics().observe(api_name, 'rows', len(df))
+    return df
+
+
+class TushareError(Exception):
+    """
+    An error response of Tushare (non-zero `code`), `msg` is the message of
+    the response.
+    """
+
+    def __init__(self, code: int, msg: str) -> None:
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class TushareClient:
+    """
+    A Tushare client that reuses one HTTP session for all of its requests.
+
+    The request and response format mirror `tushare.pro.client.DataApi`, the
+    difference is the `requests.Session` with a bounded connection pool, so
+    consecutive queries skip the TCP (and TLS) handshake.
+    """
+
+    def __init__(self,
+                 token: str,
+                 http_url: str | None = None,
+                 timeout: int = TIMEOUT,
+                 pool_maxsize: int = POOL_MAXSIZE) -> None:
+        self.token = token
+        self.http_url = http_url or HTTP_URL
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, api_name: str, fields: str = '', **params) -> bytes:
+        """
+        Posts a query and returns the raw response.
+
+        :param api_name: The name of the API to query data from.
+        :param fields: Comma-separated field names, empty string for all fields.
+        :param params: Query parameters of the API.
+        :return: The body of the response.
+        :raises requests.HTTPError: For an HTTP error status (429, 5xx...), to
+            be classified and retried (see `retry.py`).
+        """
+        params.setdefault('ts_type_name', self.http_url)
+        payload = {
+            'api_name': api_name,
+            'token': self.token,
+            'params': params,
+            'fields': fields,
+        }
+        metrics = get_metrics()
+        metrics.inc(api_name, 'calls')
+        transport = get_transport()
+        start = monotonic()
+        try:
+            if transport is None:
+                body = self._post(api_name, payload)
+            else:
+                body = transport.send(api_name, payload, self._post)
+        finally:
+            metrics.observe(api_name, 'fetch_seconds', monotonic() - start)
+        metrics.observe(api_name, 'bytes', len(body))
+        return body
+
+    def _post(self, api_name: str, payload: dict) -> bytes:
+        res = self.session.post(f'{self.http_url}/{api_name}', json=payload, timeout=self.timeout)
+        res.raise_for_status()
+        return res.content
+
+    def query(self, api_name: str, fields: str = '', **params) -> DataFrame:
+        """
+        Queries a Tushare API endpoint. The response is stored in the
+        response cache, if enabled.
+
+        :param api_name: The name of the API to query data from.
+        :param fields: Comma-separated field names, empty string for all fields.
+        :param params: Query parameters of the API.
+        :return: A DataFrame containing data from the query.
+        :raises TushareError: If Tushare responds with a non-zero code.
+        """
+        raw = self.request(api_name, fields, **params)
+        df = parse_response(raw, api_name)
+        cache = get_cache()
+        if cache is not None:
+            ttl = cache_ttl(api_name, params)
+            # an empty answer for today may only mean "not published yet"
+            if ttl is None or not df.empty:
+                cache.put(api_name, params, fields, raw, ttl)
+        return df
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_clients: dict[str, TushareClient] = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def get_client(token: str, pool_maxsize: int | None = None) -> TushareClient:
+    """
+    Returns the cached client for the token, creating it on first use.
+
+    Clients are cached per process: a forked worker never reuses the parent's
+    sockets, it builds its own client on the first call.
+
+    :param token: The authentication token for accessing the API.
+    :param pool_maxsize: Minimum connection pool size, the cached client is
+        rebuilt with a larger pool if needed. Defaults to `POOL_MAXSIZE`.
+    :return: The `TushareClient` of the token in the current process.
+    """
+    global _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(token)
+        if client is None or (pool_maxsize is not None and client.pool_maxsize < pool_maxsize):
+            client = TushareClient(token, HTTP_URL, pool_maxsize=max(pool_maxsize or 0, POOL_MAXSIZE))
+            _clients[token] = client
+        return client
+
+
+def _is_capped(df: DataFrame, page_size: int) -> bool:
+    """
+    Whether more rows follow the page: the `has_more` flag of the response if
+    Tushare sent one, otherwise a page filled up to `page_size` rows.
+    """
+    has_more = df.attrs.get('has_more')
+    if has_more is not None:
+        return bool(has_more)
+    return len(df) >= page_size
+
+
+def _query(token: 'str | TokenPool',
+           api_name: str,
+           field_str: str,
+           params: dict) -> DataFrame:
+    """
+    One rate limited call, with the least loaded token of a pool. A token of the
+    pool rejected by Tushare is removed and the call moves to another token.
+    A call found in the response cache, or replayed (see `transport.py`),
+    skips the rate limiter.
+    """
+    metrics = get_metrics()
+    cache = get_cache()
+    if cache is not None:
+        raw = cache.get(api_name, params, field_str)
+        if raw is not None:
+            metrics.inc(api_name, 'cache_hits')
+            return parse_response(raw, api_name)
+    transport = get_transport()
+    if transport is not None and not transport.uses_quota:
+        return get_client(tokens_of(token)[0]).query(api_name, fields=field_str, **params)
+    if not isinstance(token, TokenPool):
+        with metrics.timer(api_name, 'rate_wait_seconds'):
+            acquire(api_name)
+        return get_client(token).query(api_name, fields=field_str, **params)
+    while True:
+        with metrics.timer(api_name, 'rate_wait_seconds'):
+            pool_token = token.acquire(api_name)
+        try:
+            return get_client(pool_token).query(api_name, fields=field_str, **params)
+        except TushareError as e:
+            if not is_auth_error(e):
+                raise
+            token.remove(pool_token)
+
+
+def _query_page(token: 'str | TokenPool',
+                api_name: str,
+                field_str: str,
+                params: dict,
+                offset: int,
+                limit: int) -> DataFrame:
+    return _query(token, api_name, field_str, {**params, 'offset': offset, 'limit': limit})
+
+
+def _query_rest(token: 'str | TokenPool',
+                api_name: str,
+                field_str: str,
+                params: dict,
+                offset: int,
+                page_size: int) -> list[DataFrame]:
+    """
+    Fetches the pages after a capped response, from `offset` until a page
+    comes back short. The pages of a wave are fetched concurrently, each wave
+    twice as large as the previous one.
+    """
+    pages = []
+    wave = 1
+    with ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY) as executor:
+        while True:
+            offsets = [offset + i * page_size for i in range(wave)]
+            results = list(executor.map(lambda o: _query_page(token, api_name, field_str, params, o, page_size),
+                                        offsets))
+            for page in results:
+                pages.append(page)
+                if not _is_capped(page, page_size):
+                    return pages
+            offset += wave * page_size
+            wave = min(wave * 2, PAGE_CONCURRENCY)
+
+
+def tushare_download(token: 'str | TokenPool',
                      api_name: str,
                      params: dict | None = None,
-                     fields: list[str] | None = None) -> DataFrame | None:
+                     fields: list[str] | None = None,
+                     paginate: bool = True) -> DataFrame | None:
     """
     Downloads data by querying an API using the specified token and parameters.
 
-    :param token: The authentication token for accessing the API.
+    A response capped at the row limit of the API is completed with the
+    following pages, unless `paginate` is False or `params` sets its own
+    `offset` / `limit`.
+
+    :param token: The authentication token for accessing the API, or a `TokenPool`.
     :param api_name: The name of the API to query data from.
     :param params: Optional dictionary of query parameters to include in the API call.
     :param fields: Optional list of field names to explicitly retrieve from the API.
+    :param paginate: Fetch all pages of a capped response. Defaults to True.
     :return: A DataFrame containing data from the query, or None if no data is
         available.
     """
-    pro = pro_api(token)
-    if params is None:
-        params = {}
-    if fields is not None:
-        params['fields'] = ','.join(fields)
-    return pro.query(api_name, **params)
+    params = dict(params) if params is not None else {}
+    field_str = ','.join(fields) if fields is not None else params.pop('fields', '')
+    df = _query(token, api_name, field_str, params)
+
+    if (not paginate or 'offset' in params or 'limit' in params
+            or df.empty or not _is_capped(df, get_row_limit(api_name))):
+        return df
+    # the capped first page gives the page size of the API
+    pages = [df] + _query_rest(token, api_name, field_str, params, len(df), len(df))
+    return concat([page for page in pages if not page.empty], ignore_index=True)
@@ -0,0 +1,436 @@
+"""
+Single-writer bulk loader
+Author: Yanzhong(Eric) Huang
+
+The fetch workers in `download.py` no longer write their own (tiny) frames.
+They hand the downloaded DataFrames to one `BatchWriter`, which:
+
+- receives frames through a bounded queue, `put` blocks when the writer lags
+- coalesces them until `batch_rows` rows are buffered
+- loads each batch in one transaction with a multi-row INSERT (`chunksize` rows
+  per statement)
+
+If a batch fails, its frames are written one by one so a single bad frame does
+not drop the whole batch, and the error is logged to the `log` table. With a
+`LogSink` (see `log_sink.py`) every batch is logged as well, with its rows and
+duration. Sync records (see `sync_state` in `database.py`) are written in the
+same transaction as their rows.
+
+Write modes (`write_mode`):
+
+- `append`: plain INSERT, the default
+- `ignore`: `INSERT IGNORE`, rows whose natural key already exists are skipped
+- `upsert`: `INSERT ... ON DUPLICATE KEY UPDATE`, existing rows are overwritten
+
+`ignore` and `upsert` rely on the unique natural keys declared in
+`database.py`, so re-running an overlapping window is safe. A table created
+before its key was declared has no such key, the writer refuses these modes
+on it (see `check_unique_key`) rather than inserting the rows again.
+
+The time of every batch and the rows written are recorded in the metrics of
+the process (see `metrics.py`).
+
+With a `MemoryBudget`, the frames between the fetch and the write are bounded
+in bytes, not only in number: `put` blocks (and makes the writer flush its
+buffer at once) while the frames queued and buffered exceed the budget, and
+`MemoryBudget.admit` tells the fetch loop of `download.py` whether another
+request fits, counting the frames in flight at the average frame size seen.
+When the database lags, fetching slows down to its pace instead of piling
+frames up in memory.
+"""
+
+import queue
+import threading
+from datetime import date, datetime
+from time import monotonic
+from typing import Callable
+
+import pandas as pd
+from sqlalchemy import bindparam, insert, text
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import Engine
+
+from .database import insert_log, get_natural_key, check_unique_key
+from .log_sink import LogSink, ERROR
+from .metrics import get_metrics
+
+
+BATCH_ROWS = 50_000  # rows buffered before a batch is written
+CHUNKSIZE = 10_000  # rows per INSERT statement
+MAX_QUEUE = 32  # frames waiting for the writer before `put` blocks
+
+WRITE_MODES = ('append', 'ignore', 'upsert')
+
+STR_BYTES = 60  # estimated bytes of one string value, on top of its pointer
+
+_STOP = object()
+_FLUSH = object()
+
+
+def frame_bytes(df: pd.DataFrame | None) -> int:
+    """
+    Estimated memory of a DataFrame, without scanning its strings.
+    """
+    if df is None or df.empty:
+        return 0
+    nbytes = int(df.memory_usage(index=False).sum())
+    strings = sum(1 for dtype in df.dtypes
+                  if not (pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype)
+                          or isinstance(dtype, pd.CategoricalDtype)))
+    return nbytes + strings * len(df) * STR_BYTES
+
+
+class MemoryBudget:
+    """
+    The memory allowed to the frames between the fetch and the write.
+
+    :param max_mb: The budget in MB.
+    """
+
+    def __init__(self, max_mb: float) -> None:
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.used = 0
+        self.frame_bytes = 0.0  # moving average of the frames seen
+        self.waiting = 0  # callers blocked in `acquire`
+        self._frames = 0
+        self._cond = threading.Condition()
+
+    def admit(self, in_flight: int) -> bool:
+        """
+        Whether one more request fits, with `in_flight` requests already sent.
+        """
+        with self._cond:
+            return self.used + (in_flight + 1) * self.frame_bytes <= self.max_bytes
+
+    def acquire(self, nbytes: int, on_wait: Callable[[], None] | None = None) -> float:
+        """
+        Reserves `nbytes`, blocks while they do not fit. A frame larger than
+        the whole budget is let through once nothing else is held.
+
+        :param nbytes: The estimated bytes of the frame.
+        :param on_wait: Called (outside the lock) once the caller is counted
+            in `waiting` and before it blocks, e.g. to make the writer flush.
+        :return: The seconds waited, 0 if the frame fitted at once.
+        """
+        start = monotonic()
+        with self._cond:
+            self._frames += 1
+            self.frame_bytes += (nbytes - self.frame_bytes) / min(self._frames, 20)
+            if self._fits(nbytes):
+                self.used += nbytes
+                return 0.0
+            # counted before the flush request: a frame the writer buffers after it sees the waiter
+            self.waiting += 1
+        if on_wait is not None:
+            on_wait()
+        with self._cond:
+            while not self._fits(nbytes):
+                self._cond.wait()
+            self.used += nbytes
+            self.waiting -= 1
+        return monotonic() - start
+
+    def _fits(self, nbytes: int) -> bool:
+        return not self.used or self.used + nbytes <= self.max_bytes
+
+    def release(self, nbytes: int) -> None:
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+def _insert_ignore(table, conn, keys: list[str], data_iter) -> int:
+    """
+    `DataFrame.to_sql` method: INSERT skipping rows whose unique key exists.
+    """
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    if conn.dialect.name == 'sqlite':
+        stmt = sqlite.insert(table.table).on_conflict_do_nothing()
+    else:
+        stmt = insert(table.table).prefix_with('IGNORE')
+    return conn.execute(stmt, rows).rowcount
+
+
+def _upsert(table, conn, keys: list[str], data_iter) -> int:
+    """
+    `DataFrame.to_sql` method: INSERT overwriting rows whose unique key exists.
+    """
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    if conn.dialect.name == 'sqlite':
+        stmt = sqlite.insert(table.table)
+        natural_key = get_natural_key(table.name) or []
+        stmt = stmt.on_conflict_do_update(index_elements=natural_key,
+                                          set_={k: stmt.excluded[k] for k in keys if k not in natural_key})
+    else:
+        stmt = mysql.insert(table.table)
+        stmt = stmt.on_duplicate_key_update({k: stmt.inserted[k] for k in keys})
+    return conn.execute(stmt, rows).rowcount
+
+
+_METHODS = {'append': None, 'ignore': _insert_ignore, 'upsert': _upsert}
+
+
+def to_sql(df: pd.DataFrame,
+           table_name: str,
+           con,
+           write_mode: str = 'append',
+           chunksize: int | None = None) -> None:
+    """
+    Appends a DataFrame to a table with the given write mode.
+
+    :param df: The DataFrame to write.
+    :param table_name: The name of the table.
+    :param con: A SQLAlchemy Engine or Connection.
+    :param write_mode: One of `WRITE_MODES`.
+    :param chunksize: Rows per INSERT statement.
+    :return: None
+    """
+    if write_mode not in _METHODS:
+        raise ValueError(f'Unknown write_mode {write_mode}, expected one of {WRITE_MODES}')
+    df.to_sql(table_name, con, if_exists='append', index=False,
+              chunksize=chunksize, method=_METHODS[write_mode])
+
+
+class BatchWriter:
+    """
+    A writer thread appending the DataFrames of one table in large batches.
+
+    A frame can carry a sync record `(sync_key, window_start, window_end)`, the
+    record is written to `sync_state` in the same transaction as the frame, so
+    a key is only marked done once its rows are committed. Keys with an empty
+    result are recorded as well, as pending if their window ends today or
+    later (the data may not be published yet, a rerun fetches them again), and
+    `fail` records a key that failed to download.
+
+    Usage:
+
+        with BatchWriter(engine, 'daily') as writer:
+            for df in frames:
+                writer.put(df)
+    """
+
+    def __init__(self,
+                 engine: Engine,
+                 table_name: str,
+                 batch_rows: int = BATCH_ROWS,
+                 chunksize: int = CHUNKSIZE,
+                 max_queue: int = MAX_QUEUE,
+                 write_mode: str = 'append',
+                 log_sink: LogSink | None = None,
+                 budget: MemoryBudget | None = None) -> None:
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f'Unknown write_mode {write_mode}, expected one of {WRITE_MODES}')
+        if write_mode != 'append':
+            check_unique_key(engine, table_name)
+        self.engine = engine
+        self.table_name = table_name
+        self.batch_rows = batch_rows
+        self.chunksize = chunksize
+        self.write_mode = write_mode
+        self.log_sink = log_sink
+        self.budget = budget
+        self.rows_written = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name=f'writer-{table_name}', daemon=True)
+
+    def __enter__(self) -> 'BatchWriter':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def put(self, df: pd.DataFrame | None, record: tuple[str, str, str] | None = None) -> None:
+        """
+        Queues a DataFrame (and its sync record) for writing, blocks while the
+        queue is full, or while the frame does not fit in the memory budget.
+        """
+        if record is None and (df is None or df.empty):
+            return
+        if self.budget is not None:
+            # a frame that does not fit makes the writer write its buffer now, not at batch_rows
+            waited = self.budget.acquire(frame_bytes(df), on_wait=lambda: self._queue.put(_FLUSH))
+            if waited:
+                get_metrics().observe(self.table_name, 'memory_wait_seconds', waited)
+        status = 'done'
+        if record is not None and not _rows(df) and record[2] >= date.today().strftime('%Y%m%d'):
+            status = 'pending'
+        self._queue.put((df, record, status))
+
+    def fail(self, record: tuple[str, str, str]) -> None:
+        """
+        Queues the sync record of a key that failed to download.
+        """
+        self._queue.put((None, record, 'failed'))
+
+    def close(self) -> None:
+        """
+        Writes the remaining frames and waits for the writer thread to finish.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self) -> None:
+        items: list[tuple] = []
+        rows = 0
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            if item is _FLUSH:
+                if items:
+                    self._write(items)
+                    items, rows = [], 0
+                continue
+            items.append(item)
+            rows += _rows(item[0])
+            if rows >= self.batch_rows or (self.budget is not None and self.budget.waiting):
+                self._write(items)
+                items, rows = [], 0
+        if items:
+            self._write(items)
+
+    def _write(self, items: list[tuple]) -> None:
+        try:
+            self._write_items(items)
+        finally:
+            if self.budget is not None:
+                self.budget.release(sum(frame_bytes(df) for df, _, _ in items))
+
+    def _write_items(self, items: list[tuple]) -> None:
+        try:
+            self._to_sql(items)
+        except Exception as e:
+            if len(items) == 1:
+                self._log_error(e)
+                return
+            # retry item by item so one bad frame does not drop the batch
+            for item in items:
+                try:
+                    self._to_sql([item])
+                except Exception as e:
+                    self._log_error(e)
+
+    def _to_sql(self, items: list[tuple]) -> None:
+        frames = [df for df, _, _ in items if _rows(df)]
+        records = [(record, status, _rows(df)) for df, record, status in items if record is not None]
+        rows = sum(len(df) for df in frames)
+        metrics = get_metrics()
+        start = monotonic()
+        with self.engine.begin() as conn:
+            if frames:
+                batch = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+                to_sql(batch, self.table_name, conn, self.write_mode, self.chunksize)
+            if records:
+                to_sql(_sync_state(self.table_name, records), 'sync_state', conn, 'upsert')
+        duration = monotonic() - start
+        metrics.observe(self.table_name, 'write_seconds', duration)
+        metrics.inc(self.table_name, 'rows_written', rows)
+        self.rows_written += rows
+        if rows:
+            print(f'Inserted {rows} rows into {self.table_name}')
+            if self.log_sink is not None:
+                self.log_sink.log(self.table_name, f'Inserted {rows} rows into {self.table_name}',
+                                  event='write', row_count=rows, duration=duration)
+
+    def _log_error(self, e: Exception) -> None:
+        error_msg = f'Error writing {self.table_name}: {e}'
+        print(error_msg)
+        if self.log_sink is not None:
+            self.log_sink.log(self.table_name, error_msg, level=ERROR, event='write')
+            return
+        try:
+            insert_log(self.engine, table_name=self.table_name, message=error_msg)
+        except Exception:
+            pass
+
+
+def _rows(df: pd.DataFrame | None) -> int:
+    return 0 if df is None else len(df)
+
+
+def _sync_state(api_name: str, records: list[tuple]) -> pd.DataFrame:
+    now = datetime.now()
+    return pd.DataFrame([{'api_name': api_name,
+                          'sync_key': key,
+                          'window_start': window_start,
+                          'window_end': window_end,
+                          'status': status,
+                          'row_count': row_count,
+                          'updated_at': now}
+                         for (key, window_start, window_end), status, row_count in records])
+
+
+def mark_pending(engine: Engine, api_name: str, records: list[tuple[str, str, str]]) -> None:
+    """
+    Records the keys of an update as pending in `sync_state` before it starts,
+    the `BatchWriter` marks them done (or failed) as they complete.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param records: The (sync_key, window_start, window_end) of every key.
+    :return: None
+    """
+    if records:
+        to_sql(_sync_state(api_name, [(record, 'pending', 0) for record in records]),
+               'sync_state', engine, 'upsert', CHUNKSIZE)
+
+
+def prune_sync_state(engine: Engine, api_name: str, records: list[tuple[str, str, str]]) -> None:
+    """
+    Deletes the records of earlier runs for the keys of an update by code or by
+    period: their window ends before the window of this run, and only the
+    latest window of a key is read again. Without it, every run would add
+    one record per code.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param records: The (sync_key, window_start, window_end) of every key.
+    :return: None
+    """
+    window_ends: dict[str, str] = {}
+    for key, _, window_end in records:
+        window_ends[key] = max(window_end, window_ends.get(key, window_end))
+    keys_by_end: dict[str, list[str]] = {}
+    for key, window_end in window_ends.items():
+        keys_by_end.setdefault(window_end, []).append(key)
+
+    query = text("""
+    DELETE FROM sync_state
+    WHERE api_name = :api_name AND window_end < :window_end AND sync_key IN :keys
+    """).bindparams(bindparam('keys', expanding=True))
+    with engine.begin() as conn:
+        for window_end, keys in keys_by_end.items():
+            for i in range(0, len(keys), 1000):
+                conn.execute(query, {'api_name': api_name, 'window_end': window_end, 'keys': keys[i:i + 1000]})
+
+
+def clear_pending_dates(engine: Engine, api_name: str, records: list[tuple[str, str, str]]) -> None:
+    """
+    Deletes the trade dates left pending or failed by a by-date update that a
+    by-code update fetches for every code of its plan: from the latest start
+    date of a code to the end of the update. A later by-date update would
+    fetch them again and append the rows a second time.
+
+    :param engine: The database engine.
+    :param api_name: The name of the API (table).
+    :param records: The (ts_code, window_start, window_end) of the by-code update.
+    :return: None
+    """
+    if not records:
+        return
+    starts: dict[str, str] = {}
+    for key, window_start, _ in records:
+        starts[key] = min(window_start, starts.get(key, window_start))
+    query = text("""
+    DELETE FROM sync_state
+    WHERE api_name = :api_name AND status IN ('pending', 'failed')
+    AND sync_key = window_start AND window_start = window_end
+    AND sync_key >= :start AND sync_key <= :end
+    """)
+    with engine.begin() as conn:
+        conn.execute(query, {'api_name': api_name, 'start': max(starts.values()),
+                             'end': max(window_end for _, _, window_end in records)})
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from src.bageltushare import get_engine, create_all_tables
+from src.bageltushare import update_by_date_async, update_by_code_async
+from src.bageltushare.async_download import _run
+from src.bageltushare.planner import plan_by_date
+from src.bageltushare.writer import BatchWriter
+
+
+class TestAsyncDownload(TestCase):
+
+    def setUp(self):
+        # connect to database
+        with open("tests/test_config.json") as f:
+            config = json.load(f)
+            self.config = config["database"]
+            self.token = config["token"]
+        self.engine: Engine = get_engine(**self.config)
+
+        # create all tables
+        create_all_tables(self.engine)
+
+    def test_update_by_date_async(self):
+        asyncio.run(update_by_date_async(self.engine, self.token, "daily",
+                                         end_date=datetime(2000, 1, 31), max_concurrency=20))
+
+    def test_update_by_code_async(self):
+        asyncio.run(update_by_code_async(self.engine, self.token, "balancesheet",
+                                         end_date=datetime(2000, 12, 31), max_concurrency=20))
+
+
+class TestAsyncMemoryBudget(TestCase):
+
+    def test_frames_bounded(self):
+        """With a lagging writer, downloaded frames wait in the request slots, not in an unbounded queue."""
+        counts = {"fetched": 0, "written": 0, "max_waiting": 0}
+        lock = threading.Lock()
+        write = BatchWriter._to_sql
+
+        def fake_download(token, api_name, params, fields):
+            with lock:
+                counts["fetched"] += 1
+                counts["max_waiting"] = max(counts["max_waiting"], counts["fetched"] - counts["written"])
+            return pd.DataFrame({"ts_code": [f"{i:06d}.SZ" for i in range(2000)],
+                                 "trade_date": params["trade_date"], "close": 1.0})
+
+        def slow_write(writer, items):
+            time.sleep(0.01)
+            write(writer, items)
+            with lock:
+                counts["written"] += len(items)
+
+        dates = [d.strftime("%Y%m%d") for d in pd.bdate_range("2024-01-01", "2024-02-09")]
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'test.db')}")
+            create_all_tables(engine)
+            with (patch("src.bageltushare.async_download.tushare_download", side_effect=fake_download),
+                  patch.object(BatchWriter, "_to_sql", slow_write)):
+                # every frame is larger than the budget: the writer takes them one at a time
+                asyncio.run(_run(engine, "token", plan_by_date("daily", dates, 2000, 6000), None, None, 1,
+                                 max_concurrency=4, memory_mb=0.05))
+            self.assertEqual(pd.read_sql("SELECT COUNT(*) AS n FROM daily", engine)["n"].iloc[0], 2000 * len(dates))
+            engine.dispose()
+        # 4 slots (in flight or blocked in put) and the frame being written
+        self.assertLessEqual(counts["max_waiting"], 5)
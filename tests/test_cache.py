@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from src.bageltushare.cache import ResponseCache, cache_ttl, enable_cache, disable_cache
+from src.bageltushare.rate_limit import set_rate_limit
+from src.bageltushare.tushare_api import TushareClient, tushare_download
+
+
+def _response(n: int) -> bytes:
+    items = [[f"{i:06d}.SZ", "20240102", float(i)] for i in range(n)]
+    return json.dumps({"code": 0, "msg": "", "data": {"fields": ["ts_code", "trade_date", "close"],
+                                                      "items": items, "has_more": False}}).encode()
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        disable_cache()
+        self.tmp_dir.cleanup()
+
+    def test_ttl(self):
+        self.assertIsNone(cache_ttl("daily", {"trade_date": "20240102"}))
+        self.assertIsNone(cache_ttl("income", {"ts_code": "000001.SZ", "start_date": "20200101",
+                                               "end_date": "20241231"}))
+        self.assertEqual(cache_ttl("daily", {"trade_date": "29991231"}), 3600)
+        self.assertEqual(cache_ttl("income_vip", {"period": "20240331"}), 3600)
+        self.assertEqual(cache_ttl("trade_cal", {"end_date": "20240102"}), 86400)
+
+        cache = ResponseCache(self.tmp_dir.name)
+        cache.put("daily", {"trade_date": "20240102"}, "", b"old", ttl=-1)
+        self.assertIsNone(cache.get("daily", {"trade_date": "20240102"}, ""))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.tmp_dir.name, max_mb=0.01)
+        for i in range(20):
+            params = {"trade_date": f"202401{i:02d}"}
+            cache.put("daily", params, "", os.urandom(1000))
+            cache.get("daily", {"trade_date": "20240100"}, "")  # kept in use
+        self.assertLessEqual(cache.size(), 0.01 * 1024 * 1024)
+        self.assertIsNotNone(cache.get("daily", {"trade_date": "20240100"}, ""))
+        self.assertIsNone(cache.get("daily", {"trade_date": "20240101"}, ""))
+
+    def test_download_served_from_cache(self):
+        """A cached request is not sent again, the frames are equal."""
+        enable_cache(self.tmp_dir.name)
+        set_rate_limit("daily", 0)
+        params = {"trade_date": "20240102"}
+        with patch.object(TushareClient, "request", return_value=_response(3)) as request:
+            first = tushare_download("TOKEN", "daily", params)
+            second = tushare_download("TOKEN", "daily", params)
+            tushare_download("TOKEN", "daily", params, fields=["ts_code"])  # another key
+        self.assertEqual(request.call_count, 2)
+        self.assertTrue(first.equals(second))  # type: ignore
+        self.assertEqual(second["close"].tolist(), [0.0, 1.0, 2.0])  # type: ignore
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from src.bageltushare.concurrency import AIMDController
+from src.bageltushare.retry import QUOTA, PERMANENT
+
+
+class TestAIMDController(TestCase):
+
+    def test_increase_while_healthy(self):
+        controller = AIMDController(initial=2, max_concurrency=4)
+        for _ in range(2 + 3 + 4 + 4):
+            controller.record(0.2, [])
+        self.assertEqual(controller.concurrency, 4)  # capped at max_concurrency
+
+    def test_no_increase_when_latency_grows(self):
+        controller = AIMDController(initial=2)
+        controller.record(0.1, [])
+        for _ in range(10):
+            controller.record(1.0, [])
+        self.assertEqual(controller.concurrency, 2)
+
+    def test_decrease_once_per_round(self):
+        controller = AIMDController(initial=16)
+        for _ in range(5):
+            controller.record(0.2, [QUOTA])
+        self.assertEqual(controller.concurrency, 8)
+        self.assertEqual(controller.stats()['throttled'], 5)
+
+        # a permanent error is not a congestion signal
+        controller = AIMDController(initial=16)
+        controller.record(0.2, [PERMANENT], ok=False)
+        self.assertEqual(controller.concurrency, 16)
+        self.assertEqual(controller.stats()['failed'], 1)
@@ -0,0 +1,60 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.bageltushare.convert import convert_frame, table_types
+from src.bageltushare.writer import BatchWriter
+
+
+class TestConvert(TestCase):
+
+    def _frame(self) -> pd.DataFrame:
+        # as decoded from the Tushare JSON: dates as strings, a missing value makes an object column
+        return pd.DataFrame({"ts_code": ["000001.SZ", "000002.SZ", "000001.SZ"],
+                             "trade_date": ["20240102", "20240103", None],
+                             "close": [10.5, None, "11.25"],
+                             "extra": ["a", "b", "c"]})
+
+    def test_table_types(self):
+        types = table_types("income_vip")  # the VIP endpoint has the columns of its table
+        self.assertEqual((types["ts_code"], types["end_date"], types["revenue"]), ("str", "date", "float"))
+        self.assertEqual(table_types("unknown")["trade_date"], "date")
+        self.assertNotIn("close", table_types("unknown"))
+
+    def test_convert(self):
+        df = convert_frame(self._frame(), "daily", float32=False, categorical=())
+        self.assertEqual(df["trade_date"].tolist()[:2], [pd.Timestamp("2024-01-02"), pd.Timestamp("2024-01-03")])
+        self.assertTrue(pd.isna(df["trade_date"].iloc[2]))
+        self.assertEqual(df["close"].dtype, "float64")
+        self.assertEqual(df["close"].iloc[2], 11.25)
+        self.assertNotIsInstance(df["ts_code"].dtype, pd.CategoricalDtype)
+        self.assertEqual(df["extra"].tolist(), ["a", "b", "c"])
+
+        # other date formats still parse
+        df = convert_frame(pd.DataFrame({"trade_date": ["2024-01-02"]}), "daily")
+        self.assertEqual(df["trade_date"].iloc[0], pd.Timestamp("2024-01-02"))
+
+    def test_undeclared_api(self):
+        """The date columns of an API without a table in database.py are parsed as well."""
+        df = convert_frame(pd.DataFrame({"ts_code": ["000001.SH"], "trade_date": ["20240102"],
+                                         "close": ["3000.5"]}), "index_daily")
+        self.assertEqual(df["trade_date"].iloc[0], pd.Timestamp("2024-01-02"))
+        self.assertEqual(df["close"].iloc[0], "3000.5")
+
+    def test_compact(self):
+        """float32 and categorical frames are smaller and written unchanged."""
+        df = convert_frame(self._frame(), "daily", float32=True, categorical=("ts_code",))
+        self.assertEqual(df["close"].dtype, "float32")
+        self.assertIsInstance(df["ts_code"].dtype, pd.CategoricalDtype)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'test.db')}")
+            with BatchWriter(engine, "daily") as writer:
+                writer.put(df.drop(columns="extra"))
+            written = pd.read_sql("SELECT ts_code, close FROM daily", engine)
+            engine.dispose()
+        self.assertEqual(written["ts_code"].tolist(), ["000001.SZ", "000002.SZ", "000001.SZ"])
+        self.assertEqual(written["close"].iloc[2], 11.25)
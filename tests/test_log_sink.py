@@ -0,0 +1,47 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from src.bageltushare.log_sink import LogSink, ERROR
+
+
+class TestLogSink(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_batches(self):
+        """Entries are written in batches, with their structured fields and untruncated messages."""
+        traceback = "Traceback (most recent call last):\n" + "  File ...\n" * 100
+        with LogSink(self.engine, batch_size=10, flush_interval=60) as sink:
+            for i in range(25):
+                sink.log("daily", f"Downloaded daily for {i}", event="fetch", sync_key=str(i), row_count=i,
+                         duration=0.1)
+            sink.log("daily", traceback, level=ERROR, event="fetch", error_class="transient")
+        self.assertEqual(sink.written, 26)
+
+        df = pd.read_sql("SELECT * FROM log ORDER BY id", self.engine)
+        self.assertEqual(len(df), 26)
+        self.assertEqual(df["row_count"].iloc[24], 24)
+        self.assertEqual(df["message"].iloc[-1], traceback)
+        self.assertEqual(df["error_class"].iloc[-1], "transient")
+
+    def test_legacy_table(self):
+        """A log table created before the structured fields keeps working."""
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE log (id INTEGER PRIMARY KEY, update_table VARCHAR(20), "
+                              "message VARCHAR(200), created_at TIMESTAMP)"))
+        with LogSink(self.engine) as sink:
+            sink.log("daily", "x" * 500, level=ERROR)
+
+        df = pd.read_sql("SELECT * FROM log", self.engine)
+        self.assertEqual(list(df.columns), ["id", "update_table", "message", "created_at"])
+        self.assertEqual(len(df["message"].iloc[0]), 200)
@@ -0,0 +1,72 @@
+import pickle
+from unittest import TestCase
+from urllib.request import urlopen
+
+from src.bageltushare.metrics import Metrics, get_metrics, serve_metrics
+
+
+class TestMetrics(TestCase):
+
+    def test_stats(self):
+        metrics = Metrics()
+        for latency in (0.02, 0.04, 0.3, 3.0):
+            metrics.observe("daily", "fetch_seconds", latency)
+        metrics.inc("daily", "errors", kind="quota")
+        metrics.inc("daily", "errors", kind="quota")
+
+        stats = metrics.stats()["daily"]
+        self.assertEqual(stats["fetch_seconds"]["count"], 4)
+        self.assertAlmostEqual(stats["fetch_seconds"]["mean"], 0.84)
+        self.assertEqual(stats["fetch_seconds"]["p50"], 0.05)  # upper bound of the bucket
+        self.assertEqual(stats["fetch_seconds"]["max"], 3.0)
+        self.assertEqual(stats["errors.quota"], 2)
+
+    def test_merge_worker_snapshots(self):
+        parent, worker = Metrics(), Metrics()
+        parent.observe("daily", "rows", 6000)
+        worker.observe("daily", "rows", 3000)
+        worker.inc("daily", "calls", 2)
+
+        # the snapshot travels back from the worker process pickled
+        parent.merge(pickle.loads(pickle.dumps(worker.drain())))
+        self.assertEqual(worker.stats(), {})
+        stats = parent.stats()["daily"]
+        self.assertEqual((stats["rows"]["count"], stats["rows"]["sum"]), (2, 9000))
+        self.assertEqual(stats["calls"], 2)
+
+    def test_prometheus(self):
+        metrics = get_metrics()
+        metrics.reset()
+        metrics.observe("daily", "fetch_seconds", 0.3)
+        metrics.observe("daily", "fetch_seconds", 200)
+        metrics.inc("daily", "errors", kind="transient")
+
+        server = serve_metrics(port=0)
+        try:
+            with urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as res:
+                text = res.read().decode()
+        finally:
+            server.shutdown()
+            metrics.reset()
+        self.assertIn('bageltushare_fetch_seconds_bucket{api="daily",le="0.5"} 1', text)
+        self.assertIn('bageltushare_fetch_seconds_bucket{api="daily",le="+Inf"} 2', text)
+        self.assertIn('bageltushare_fetch_seconds_count{api="daily"} 2', text)
+        self.assertIn('bageltushare_errors_total{api="daily",kind="transient"} 1', text)
+
+    def test_run(self):
+        metrics = Metrics()
+        metrics.observe("daily", "rows", 6000)
+        with metrics.run() as run:
+            metrics.observe("daily", "rows", 3000)
+            metrics.inc("daily", "calls")
+            worker = Metrics()
+            worker.inc("daily", "calls", 2)
+            metrics.merge(worker.drain())
+        metrics.inc("daily", "calls")
+
+        stats = run.stats()["daily"]
+        self.assertEqual((stats["rows"]["count"], stats["rows"]["sum"]), (1, 3000))
+        self.assertEqual(stats["calls"], 3)
+        stats = metrics.stats()["daily"]
+        self.assertEqual((stats["rows"]["count"], stats["rows"]["sum"]), (2, 9000))
+        self.assertEqual(stats["calls"], 4)
@@ -0,0 +1,82 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.bageltushare.download import _run_plan
+from src.bageltushare.planner import plan_by_date, plan_by_code, plan_by_period, choose_plan, quarter_ends
+
+
+class TestPlanner(TestCase):
+
+    def setUp(self):
+        self.trade_dates = [d.strftime('%Y%m%d') for d in pd.bdate_range('2024-01-01', '2024-03-29')]
+
+    def test_plan_by_date(self):
+        plan = plan_by_date('daily', self.trade_dates[:3], n_codes=5000, row_limit=6000)
+        self.assertEqual(plan.calls, 3)
+        self.assertEqual(plan.tasks[0], ('20240101', {'trade_date': '20240101'}, ('20240101',) * 3))
+
+        # a date returning more rows than the row limit takes several calls
+        plan = plan_by_date('daily', self.trade_dates[:3], n_codes=5000, row_limit=2000)
+        self.assertEqual(plan.calls, 9)
+
+    def test_plan_by_code_pages_ranges(self):
+        start_dates = {'A': '20240101', 'B': '20240325', 'C': '20240401'}
+        plan = plan_by_code('daily', start_dates, '20240329', 20, self.trade_dates)
+
+        # 65 dates of A in one request of 4 pages, 5 dates of B in 1, C is up to date
+        self.assertEqual(plan.calls, 5)
+        self.assertEqual(plan.rows, 70)
+        self.assertEqual(plan.tasks[0], ('A from 20240101 to 20240329',
+                                         {'ts_code': 'A', 'start_date': '20240101', 'end_date': '20240329'},
+                                         ('A', '20240101', '20240329')))
+        self.assertEqual([params['ts_code'] for _, params, _ in plan.tasks], ['A', 'B'])
+
+    def test_plan_by_code_without_calendar(self):
+        plan = plan_by_code('income', {'A': '20240101', 'B': '20240401'}, '20240329', 100)
+        self.assertEqual(plan.calls, 2)
+        self.assertIsNone(plan.rows)
+
+    def test_choose_plan(self):
+        by_date = plan_by_date('daily', self.trade_dates[:2], n_codes=5000, row_limit=6000)
+        by_code = plan_by_code('daily', {'A': '20240101'}, '20240329', 6000, self.trade_dates)
+        self.assertEqual(choose_plan(by_date, by_code).strategy, 'by_code')
+
+        by_code = plan_by_code('daily', {f'C{i}': '20240328' for i in range(100)}, '20240329', 6000,
+                               self.trade_dates)
+        self.assertEqual(choose_plan(by_date, by_code).strategy, 'by_date')
+
+    def test_plan_by_period(self):
+        periods = quarter_ends('20230101', '20240815')
+        self.assertEqual(periods, ['20230331', '20230630', '20230930', '20231231', '20240331', '20240630'])
+
+        plan = plan_by_period('income', periods, n_codes=5000, row_limit=5000, end_str='20240815',
+                              gap_start_dates={'A': '20200101'})
+        self.assertEqual(plan.endpoint, 'income_vip')
+        self.assertEqual(plan.calls, 7)
+        self.assertEqual(plan.tasks[0][1], {'period': '20230331'})
+        self.assertEqual(plan.tasks[-1][1], {'ts_code': 'A', 'start_date': '20200101', 'end_date': '20240815'})
+
+    def test_period_needs_unique_key(self):
+        """A by-period plan is refused on a table created before its unique key, before any call."""
+        plan = plan_by_period('income', ['20240331'], n_codes=5000, row_limit=5000, end_str='20240815')
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'test.db')}")
+            pd.DataFrame({'ts_code': ['A'], 'end_date': [pd.Timestamp('2023-12-31')]}).to_sql(
+                'income', engine, index=False)
+            with self.assertRaisesRegex(ValueError, 'create_unique_key'):
+                _run_plan(engine, 'token', plan, None, None, 1, 1, 'append')
+            engine.dispose()
+
+    def test_plan_duration(self):
+        plan = plan_by_date('daily', self.trade_dates[:60], n_codes=5000, row_limit=6000)
+        # 60 calls at 120 calls per minute take 30s, 10 workers at 0.5s per call only 3s
+        self.assertEqual(plan.duration(120, max_workers=10), 30)
+        self.assertEqual(plan.duration(0, max_workers=10), 3)
+
+        summary = plan.summary(120, max_workers=10)
+        self.assertEqual((summary['requests'], summary['calls'], summary['rows']), (60, 60, 300000))
+        self.assertEqual(summary['seconds'], 30)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+from time import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+from src.bageltushare import rate_limit
+from src.bageltushare.rate_limit import set_rate_limit, acquire, get_rate_limit
+from src.bageltushare.download import update_by_code
+from src.bageltushare.planner import plan_by_period
+
+
+class TestRateLimit(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.default_dir = rate_limit.RATE_LIMIT_DIR
+        rate_limit.RATE_LIMIT_DIR = self.tmp_dir.name
+
+    def tearDown(self):
+        rate_limit.RATE_LIMIT_DIR = self.default_dir
+        self.tmp_dir.cleanup()
+
+    def test_acquire_paces_calls(self):
+        """600 calls/minute allows a burst of 10, then one call every 0.1s."""
+        set_rate_limit("daily", 600)
+        start = time()
+        for _ in range(15):
+            acquire("daily")
+        self.assertGreaterEqual(time() - start, 0.45)
+
+    def test_unlimited(self):
+        set_rate_limit("daily", 0)
+        for _ in range(100):
+            self.assertEqual(acquire("daily"), 0.0)
+
+    def test_period_plan_limits_vip_endpoint(self):
+        """calls_per_minute applies to the bucket the by-period fetches acquire, income_vip."""
+        plan = plan_by_period("income", ["20240331"], n_codes=5000, row_limit=5000, end_str="20240815")
+        acquired = {}
+
+        def run_plan(engine, token, plan, *args, **kwargs):
+            acquired[plan.endpoint] = get_rate_limit(plan.endpoint)
+
+        engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+        with patch("src.bageltushare.download._plan_update", return_value=plan), \
+                patch("src.bageltushare.download._run_plan", side_effect=run_plan):
+            update_by_code(engine, "TOKEN", "income", calls_per_minute=10, mode="period")
+        engine.dispose()
+        self.assertEqual(acquired, {"income_vip": 10})
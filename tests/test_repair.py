@@ -0,0 +1,70 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.bageltushare.database import Daily, StockBasic, TradeCal
+from src.bageltushare.download import repair_by_date
+from src.bageltushare.queries import query_date_coverage
+
+
+class TestDateCoverage(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+        for table in (Daily, StockBasic, TradeCal):
+            table.__table__.create(self.engine)
+
+        days = pd.bdate_range("2024-01-01", "2024-01-12")
+        for exchange in ("SSE", "SZSE"):
+            pd.DataFrame({"exchange": exchange, "cal_date": days, "is_open": 1}).to_sql(
+                "trade_cal", self.engine, index=False, if_exists="append")
+        pd.DataFrame({"ts_code": ["A", "B", "C"],
+                      "list_date": pd.to_datetime(["2023-01-01", "2023-01-01", "2024-01-08"])}).to_sql(
+            "stock_basic", self.engine, index=False, if_exists="append")
+        rows = [{"ts_code": code, "trade_date": day}
+                for day in days if day != pd.Timestamp("2024-01-03")
+                for code in ("A", "B", "C") if code != "C" or day >= pd.Timestamp("2024-01-08")]
+        pd.DataFrame(rows).to_sql("daily", self.engine, index=False, if_exists="append")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_query_date_coverage(self):
+        df = query_date_coverage(self.engine, "daily", pd.Timestamp("2024-01-01"), pd.Timestamp("2024-01-12"))
+        self.assertEqual(len(df), 10)  # one row per open day, not per exchange
+        coverage = df.set_index("cal_date")
+        self.assertEqual(coverage.loc["2024-01-03", "row_count"], 0)
+        self.assertEqual(coverage.loc["2024-01-05", "listed_count"], 2)
+        self.assertEqual(coverage.loc["2024-01-08", "row_count"], 3)
+        self.assertEqual(coverage.loc["2024-01-08", "listed_count"], 3)
+
+    def test_repair_needs_unique_key(self):
+        """Repairing a table without its unique key is refused, INSERT IGNORE would duplicate the day."""
+        daily = pd.read_sql("SELECT ts_code, trade_date FROM daily", self.engine)
+        daily.to_sql("daily", self.engine, index=False, if_exists="replace")  # no unique key
+        with self.assertRaisesRegex(ValueError, "create_unique_key"):
+            repair_by_date(self.engine, "token", "daily", end_date=pd.Timestamp("2024-01-12"))
+
+    def test_repair_partly_stored_day(self):
+        """A partly stored day gets its missing rows, the stored ones are not inserted again."""
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM daily WHERE ts_code = 'B' AND trade_date LIKE '2024-01-05%'")
+
+        def fetch(token, api_name, params=None, fields=None):
+            codes = ["A", "B"] if params["trade_date"] < "20240108" else ["A", "B", "C"]
+            return pd.DataFrame({"ts_code": codes, "trade_date": params["trade_date"]})
+
+        with self.assertRaisesRegex(ValueError, "append"):
+            repair_by_date(self.engine, "token", "daily", end_date=pd.Timestamp("2024-01-12"), write_mode="append")
+        with patch("src.bageltushare.download.tushare_download", side_effect=fetch):
+            repaired = repair_by_date(self.engine, "token", "daily", end_date=pd.Timestamp("2024-01-12"),
+                                      max_workers=1, memory_mb=None)
+        self.assertEqual(repaired, ["20240103", "20240105"])
+        counts = pd.read_sql("SELECT trade_date, COUNT(*) n FROM daily GROUP BY trade_date", self.engine)
+        self.assertEqual(counts["n"].tolist(), [2] * 5 + [3] * 5)
@@ -0,0 +1,80 @@
+import json
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from src.bageltushare.rate_limit import set_rate_limit
+from src.bageltushare.retry import (RetryPolicy, call_with_retry, classify_error,
+                                    QUOTA, TRANSIENT, PERMANENT)
+from src.bageltushare.tushare_api import TushareError, tushare_download
+
+
+def _response(status: int, body: dict | None = None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res._content = json.dumps(body or {}).encode()
+    return res
+
+
+def _http_error(status: int) -> requests.HTTPError:
+    return requests.HTTPError(response=_response(status))
+
+
+class TestRetry(TestCase):
+
+    def test_classify_error(self):
+        self.assertEqual(classify_error(TushareError(40203, '抱歉，您每分钟最多访问该接口200次')), QUOTA)
+        self.assertEqual(classify_error(TushareError(-2001, '请指定正确的接口名')), PERMANENT)
+        self.assertEqual(classify_error(TushareError(40101, '您的token不对，请确认。')), PERMANENT)
+        self.assertEqual(classify_error(requests.ConnectionError()), TRANSIENT)
+        self.assertEqual(classify_error(requests.Timeout()), TRANSIENT)
+        self.assertEqual(classify_error(_http_error(429)), QUOTA)
+        self.assertEqual(classify_error(_http_error(503)), TRANSIENT)
+        self.assertEqual(classify_error(_http_error(404)), PERMANENT)
+
+    def test_delay(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, quota_delay=20, max_delay=30)
+        for attempt in range(1, 5):
+            delay = policy.delay(attempt, requests.Timeout(), 0)
+            self.assertLessEqual(delay, min(30, 2 ** (attempt - 1)))  # type: ignore
+        self.assertGreaterEqual(policy.delay(1, TushareError(0, '每分钟最多访问'), 0), 10)  # type: ignore
+        self.assertIsNone(policy.delay(5, requests.Timeout(), 0))  # out of attempts
+        self.assertIsNone(policy.delay(1, requests.Timeout(), 600))  # out of time
+
+    def test_permanent_error_not_retried(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            raise TushareError(-2001, '请指定正确的接口名')
+
+        with self.assertRaises(TushareError):
+            call_with_retry(fn, RetryPolicy(max_attempts=3, base_delay=0))
+        self.assertEqual(len(calls), 1)
+
+    def test_transient_error_retried(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            if len(calls) < 3:
+                raise requests.ConnectionError()
+            return 'ok'
+
+        self.assertEqual(call_with_retry(fn, RetryPolicy(max_attempts=3, base_delay=0)), 'ok')
+        self.assertEqual(len(calls), 3)
+
+    def test_http_error_retried(self):
+        """An HTTP error status raises and is retried, instead of returning an empty frame."""
+        set_rate_limit("daily", 0)
+        ok = {"code": 0, "msg": "", "data": {"fields": ["ts_code"], "items": [["000001.SZ"]]}}
+        responses = [_response(503), _response(429), _response(200, ok)]
+        errors = []
+        with patch("requests.Session.post", side_effect=responses) as post:
+            df = call_with_retry(lambda: tushare_download("token", "daily", {"trade_date": "20240102"}),
+                                 RetryPolicy(max_attempts=3, base_delay=0, quota_delay=0),
+                                 on_error=lambda e: errors.append(classify_error(e)))
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(errors, [TRANSIENT, QUOTA])
+        self.assertEqual(df["ts_code"].tolist(), ["000001.SZ"])  # type: ignore
@@ -0,0 +1,66 @@
+import pickle
+import tempfile
+from time import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from pandas import DataFrame
+
+from src.bageltushare import rate_limit
+from src.bageltushare.download import update_by_code, update_by_date
+from src.bageltushare.token_pool import TokenPool
+from src.bageltushare.tushare_api import TushareError, tushare_download
+
+
+class FakeClient:
+
+    def __init__(self, token: str, calls: list):
+        self.token, self.calls = token, calls
+
+    def query(self, api_name, fields='', **params):
+        self.calls.append(self.token)
+        if self.token == 'BAD':
+            raise TushareError(40101, '您的token不对，请确认。')
+        return DataFrame({'token': [self.token]})
+
+
+class TestTokenPool(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.default_dir = rate_limit.RATE_LIMIT_DIR
+        rate_limit.RATE_LIMIT_DIR = self.tmp_dir.name
+        self.calls = []
+
+    def tearDown(self):
+        rate_limit.RATE_LIMIT_DIR = self.default_dir
+        self.tmp_dir.cleanup()
+
+    def download(self, pool: TokenPool, n: int) -> None:
+        with patch('src.bageltushare.tushare_api.get_client', lambda t: FakeClient(t, self.calls)):
+            for _ in range(n):
+                tushare_download(pool, 'daily')  # type: ignore
+
+    def test_quota_per_token(self):
+        """Two tokens of 600 calls/minute make 30 calls twice as fast as one."""
+        start = time()
+        self.download(TokenPool({'A': 600, 'B': 600}), 30)
+        self.assertLess(time() - start, 1.5)
+        self.assertGreaterEqual(self.calls.count('A'), 12)
+        self.assertGreaterEqual(self.calls.count('B'), 12)
+
+    def test_rejected_token_removed(self):
+        pool = TokenPool(['BAD', 'GOOD'], default_calls_per_minute=0)
+        self.download(pool, 10)
+        self.assertEqual(self.calls.count('BAD'), 1)
+        self.assertEqual(self.calls.count('GOOD'), 10)
+        # removed for the workers too
+        self.assertEqual(pickle.loads(pickle.dumps(pool)).tokens, ['GOOD'])
+
+    def test_calls_per_minute_refused(self):
+        """The quotas of the pool are its rate limit, a calls_per_minute would be silently ignored."""
+        pool = TokenPool(['A', 'B'])
+        with self.assertRaisesRegex(ValueError, 'TokenPool'):
+            update_by_date(None, pool, 'daily', calls_per_minute=100)  # type: ignore
+        with self.assertRaisesRegex(ValueError, 'TokenPool'):
+            update_by_code(None, pool, 'daily', calls_per_minute=100, dry_run=True)  # type: ignore
@@ -0,0 +1,64 @@
+import glob
+import gzip
+import json
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import requests
+
+from src.bageltushare.rate_limit import set_rate_limit
+from src.bageltushare.transport import ReplayError, record_to, replay_from, reset_transport
+from src.bageltushare.tushare_api import TushareClient, tushare_download
+
+
+def _post(api_name, payload):
+    trade_date = payload["params"]["trade_date"]
+    items = [["000001.SZ", trade_date, 10.5], ["000002.SZ", trade_date, None]]
+    return json.dumps({"code": 0, "msg": "", "data": {"fields": ["ts_code", "trade_date", "close"],
+                                                      "items": items}}).encode()
+
+
+class TestTransport(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        set_rate_limit("daily", 0)
+
+    def tearDown(self):
+        reset_transport()
+        self.tmp_dir.cleanup()
+
+    def test_record_replay(self):
+        """A recorded run is replayed offline with the same frames."""
+        record_to(self.tmp_dir.name)
+        with patch.object(TushareClient, "_post", side_effect=_post):
+            recorded = [tushare_download("SECRET_TOKEN", "daily", {"trade_date": d})
+                        for d in ("20240102", "20240103")]
+        archive = "".join(gzip.open(f, "rt").read() for f in glob.glob(f"{self.tmp_dir.name}/*.gz"))
+        self.assertEqual(archive.count("\n"), 2)
+        self.assertNotIn("SECRET_TOKEN", archive)
+
+        transport = replay_from(self.tmp_dir.name, speed=0)
+        self.assertEqual(len(transport), 2)
+        with patch.object(TushareClient, "_post", side_effect=AssertionError("network access")):
+            replayed = [tushare_download("OTHER_TOKEN", "daily", {"trade_date": d})
+                        for d in ("20240102", "20240103")]
+            with self.assertRaises(ReplayError):
+                tushare_download("OTHER_TOKEN", "daily", {"trade_date": "20240104"})
+        for a, b in zip(recorded, replayed):
+            self.assertTrue(a.equals(b))  # type: ignore
+
+    def test_replay_http_error(self):
+        """A recorded HTTP error status is replayed as the same HTTPError."""
+        error = requests.Response()
+        error.status_code = 503
+        record_to(self.tmp_dir.name)
+        with patch.object(TushareClient, "_post", side_effect=requests.HTTPError("503", response=error)):
+            with self.assertRaises(requests.HTTPError):
+                tushare_download("token", "daily", {"trade_date": "20240102"})
+
+        replay_from(self.tmp_dir.name, speed=0)
+        with self.assertRaises(requests.HTTPError) as raised:
+            tushare_download("token", "daily", {"trade_date": "20240102"})
+        self.assertEqual(raised.exception.response.status_code, 503)  # type: ignore
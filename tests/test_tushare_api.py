@@ -1,7 +1,12 @@
 import json
 from unittest import TestCase
+from unittest.mock import patch
+
+from pandas import DataFrame, Timestamp, isna
 
 from src.bageltushare import tushare_download
+from src.bageltushare.rate_limit import set_rate_limit
+from src.bageltushare.tushare_api import get_client, decode_columns
 
 
 class TestTushareAPI(TestCase):
@@ -35,3 +40,73 @@ class TestTushareAPI(TestCase):
         invalid_token = "INVALID_TOKEN"
         with self.assertRaises(Exception):
             tushare_download(invalid_token, api_name, params)
+
+
+class TestTushareClient(TestCase):
+
+    def test_get_client_cached(self):
+        """The same client (and HTTP session) is reused for a token."""
+        client = get_client("TOKEN_A")
+        self.assertIs(client, get_client("TOKEN_A"))
+        self.assertIsNot(client, get_client("TOKEN_B"))
+
+
+class FakeClient:
+    """Serves `total` rows, at most `cap` rows per call."""
+
+    def __init__(self, total: int, cap: int):
+        self.total, self.cap = total, cap
+        self.calls = []
+
+    def query(self, api_name, fields='', offset=0, limit=None, **params):
+        self.calls.append(offset)
+        end = min(self.total, offset + min(limit or self.cap, self.cap))
+        return DataFrame({'n': range(offset, end)})
+
+
+class TestPagination(TestCase):
+
+    def setUp(self):
+        set_rate_limit("fake_api", 0)
+
+    def test_capped_response_is_paged(self):
+        client = FakeClient(total=23000, cap=5000)
+        with patch("src.bageltushare.tushare_api.get_client", return_value=client):
+            df = tushare_download("TOKEN", "fake_api", {"start_date": "20000101"})
+        self.assertEqual(df["n"].tolist(), list(range(23000)))  # type: ignore
+        # waves of 1, 2 and 4 pages after the first call
+        self.assertEqual(sorted(client.calls), [0, 5000, 10000, 15000, 20000, 25000, 30000, 35000])
+
+    def test_short_response_is_not_paged(self):
+        client = FakeClient(total=100, cap=5000)
+        with patch("src.bageltushare.tushare_api.get_client", return_value=client):
+            df = tushare_download("TOKEN", "fake_api")
+        self.assertEqual(len(df), 100)  # type: ignore
+        self.assertEqual(client.calls, [0])
+
+
+class TestDecodeColumns(TestCase):
+
+    def test_decode(self):
+        fields = ["ts_code", "trade_date", "close", "vol", "unknown"]
+        items = [["000001.SZ", "20240102", 10.5, 100, "a"],
+                 ["000002.SZ", "20240102", None, "200.5", "b"]]
+        df = decode_columns(fields, items, "daily")
+        self.assertEqual(list(df.columns), fields)
+        self.assertEqual(df["trade_date"].iloc[0], Timestamp("2024-01-02"))
+        self.assertEqual(df["close"].dtype, "float64")
+        self.assertTrue(isna(df["close"].iloc[1]))
+        self.assertEqual(df["vol"].tolist(), [100.0, 200.5])
+        self.assertEqual(df["unknown"].tolist(), ["a", "b"])
+
+        self.assertEqual(decode_columns(fields, items, "daily", float32=True)["close"].dtype, "float32")
+        empty = decode_columns(fields, [], "daily")
+        self.assertTrue(empty.empty)
+        self.assertEqual(list(empty.columns), fields)
+
+    def test_decode_undeclared_api(self):
+        """The date fields of an API without a table in database.py are parsed as well."""
+        df = decode_columns(["ts_code", "trade_date", "close"], [["000001.SH", "20240102", 3000.5]], "index_daily")
+        self.assertEqual(df["trade_date"].dtype.kind, "M")
+        self.assertEqual(df["trade_date"].iloc[0], Timestamp("2024-01-02"))
+        self.assertEqual(df["close"].iloc[0], 3000.5)
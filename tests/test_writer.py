@@ -0,0 +1,133 @@
+import os
+import tempfile
+from datetime import date
+from unittest import TestCase
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.bageltushare.database import Daily, Income, SyncState
+from src.bageltushare.download import _resume_dates
+from src.bageltushare.queries import query_sync_state
+from src.bageltushare.writer import (BatchWriter, MemoryBudget, frame_bytes, mark_pending, prune_sync_state,
+                                     clear_pending_dates)
+
+
+class TestBatchWriter(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'test.db')}")
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_coalesce(self):
+        """All frames are written, in batches of at least batch_rows rows."""
+        with BatchWriter(self.engine, "daily", batch_rows=5) as writer:
+            for i in range(12):
+                writer.put(pd.DataFrame({"ts_code": ["000001.SZ"], "close": [float(i)]}))
+            writer.put(pd.DataFrame())
+            writer.put(None)
+        self.assertEqual(writer.rows_written, 12)
+        df = pd.read_sql("SELECT * FROM daily", self.engine)
+        self.assertEqual(len(df), 12)
+
+    def test_bad_frame(self):
+        """A frame that fails does not drop the other frames of its batch."""
+        pd.DataFrame({"ts_code": ["000000.SZ"], "close": [0.0]}).to_sql("daily", self.engine, index=False)
+        with BatchWriter(self.engine, "daily") as writer:
+            writer.put(pd.DataFrame({"ts_code": ["000001.SZ"], "close": [1.0]}))
+            writer.put(pd.DataFrame({"ts_code": ["000002.SZ"], "unknown_column": [1.0]}))
+            writer.put(pd.DataFrame({"ts_code": ["000003.SZ"], "close": [3.0]}))
+        df = pd.read_sql("SELECT * FROM daily", self.engine)
+        self.assertEqual(df["ts_code"].tolist(), ["000000.SZ", "000001.SZ", "000003.SZ"])
+
+    def _write_twice(self, write_mode: str) -> pd.DataFrame:
+        Daily.__table__.create(self.engine)
+        for close in (1.0, 2.0):
+            with BatchWriter(self.engine, "daily", write_mode=write_mode) as writer:
+                writer.put(pd.DataFrame({"ts_code": ["000001.SZ"], "trade_date": [pd.Timestamp("2025-03-25")],
+                                         "close": [close]}))
+        return pd.read_sql("SELECT * FROM daily", self.engine)
+
+    def test_ignore(self):
+        """Rows with an existing natural key are skipped."""
+        df = self._write_twice("ignore")
+        self.assertEqual(df["close"].tolist(), [1.0])
+
+    def test_upsert(self):
+        """Rows with an existing natural key are overwritten."""
+        df = self._write_twice("upsert")
+        self.assertEqual(df["close"].tolist(), [2.0])
+
+    def test_no_unique_key(self):
+        """'ignore' and 'upsert' are refused on a table without its unique key."""
+        pd.DataFrame({"ts_code": ["000001.SZ"], "trade_date": [pd.Timestamp("2025-03-25")]}).to_sql(
+            "daily", self.engine, index=False)
+        for write_mode in ("ignore", "upsert"):
+            with self.assertRaisesRegex(ValueError, "create_unique_key"):
+                BatchWriter(self.engine, "daily", write_mode=write_mode)
+
+    def test_corrected_report(self):
+        """An original report and its correction (update_flag) are both stored."""
+        Income.__table__.create(self.engine)
+        df = pd.DataFrame({"ts_code": ["000001.SZ"] * 2, "f_ann_date": [pd.Timestamp("2025-03-25")] * 2,
+                           "end_date": [pd.Timestamp("2024-12-31")] * 2, "report_type": ["1"] * 2,
+                           "update_flag": ["0", "1"], "revenue": [1.0, 2.0]})
+        with BatchWriter(self.engine, "income") as writer:
+            writer.put(df)
+        with BatchWriter(self.engine, "income", write_mode="ignore") as writer:
+            writer.put(df)
+        written = pd.read_sql("SELECT update_flag, revenue FROM income", self.engine)
+        self.assertEqual(written["revenue"].tolist(), [1.0, 2.0])
+
+    def test_sync_state(self):
+        """Sync records are written with their frames, empty results and failures included."""
+        SyncState.__table__.create(self.engine)
+        with BatchWriter(self.engine, "daily") as writer:
+            writer.put(pd.DataFrame({"ts_code": ["000001.SZ"], "close": [1.0]}), ("000001.SZ", "20250101", "20250325"))
+            writer.put(pd.DataFrame(), ("000002.SZ", "20250101", "20250325"))
+            writer.fail(("000003.SZ", "20250101", "20250325"))
+        df = pd.read_sql("SELECT * FROM sync_state ORDER BY sync_key", self.engine)
+        self.assertEqual(df["status"].tolist(), ["done", "done", "failed"])
+        self.assertEqual(df["row_count"].tolist(), [1, 0, 0])
+
+    def test_sync_state_pruned(self):
+        """One record per code: earlier windows are pruned, an empty result for today is not done."""
+        SyncState.__table__.create(self.engine)
+        today = date.today().strftime("%Y%m%d")
+        with BatchWriter(self.engine, "daily") as writer:
+            writer.put(pd.DataFrame(), ("000001.SZ", "20250101", "20250325"))
+            writer.put(pd.DataFrame(), ("000002.SZ", "20250101", "20250325"))
+        records = [("000001.SZ", "20250326", today)]
+        prune_sync_state(self.engine, "daily", records)
+        with BatchWriter(self.engine, "daily") as writer:
+            writer.put(pd.DataFrame(), records[0])
+        self.assertEqual(query_sync_state(self.engine, "daily", "done"), [("000002.SZ", "20250101", "20250325")])
+        self.assertEqual(query_sync_state(self.engine, "daily", "pending", today), records)
+        # a by-date update resumes trade dates only
+        dates = _resume_dates(self.engine, "daily", [], pd.Timestamp(today))
+        self.assertEqual(dates, [])
+
+    def test_clear_pending_dates(self):
+        """The unfinished dates of a by-date run fetched by a by-code run for every code are cleared."""
+        SyncState.__table__.create(self.engine)
+        mark_pending(self.engine, "daily", [(d, d, d) for d in ("20250103", "20250106", "20250107")])
+        clear_pending_dates(self.engine, "daily", [("000001.SZ", "20250103", "20250107"),
+                                                   ("000002.SZ", "20250106", "20250107")])
+        self.assertEqual(query_sync_state(self.engine, "daily", "pending"), [("20250103", "20250103", "20250103")])
+
+    def test_memory_budget(self):
+        """Frames beyond the budget wait for the writer, which flushes before batch_rows."""
+        budget = MemoryBudget(max_mb=0.05)
+        frame = pd.DataFrame({"ts_code": ["000001.SZ"] * 100, "close": [1.0] * 100})
+        self.assertGreater(frame_bytes(frame) * 10, budget.max_bytes)
+        with BatchWriter(self.engine, "daily", batch_rows=1_000_000, budget=budget) as writer:
+            for _ in range(50):
+                writer.put(frame)
+                self.assertLessEqual(budget.used, budget.max_bytes)
+        self.assertEqual(writer.rows_written, 5000)
+        self.assertEqual(budget.used, 0)
+        self.assertFalse(budget.admit(int(budget.max_bytes / frame_bytes(frame))))